@@ -1,67 +1,306 @@
+import asyncio
+import concurrent.futures
+import functools
+import hashlib
 import io
+import mmap
 import os
 import queue
+import shutil
+import sqlite3
 import time
-from concurrent.futures import ThreadPoolExecutor
-from tempfile import TemporaryDirectory
-from threading import Event, Semaphore, Thread
-from typing import Optional
+from collections import Counter
+from contextlib import suppress
+from threading import Event, Lock, Semaphore, Thread
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Set, Tuple
 from urllib.parse import quote_plus
 
-import multivolumefile
-import py7zr
 import simplebot
 from deltachat import Message
 from simplebot.bot import DeltaBot, Replies
-from todus.client import ToDusClient
 from todus.errors import AbortError
-from todus.util import ResultProcess
 
+from . import lazy
+from .archive import VolumeWriter
+from .bandwidth import BandwidthManager, TokenBucket
 from .db import DBManager
-from .util import download_file, download_ytvideo, get_db, is_ytlink, parse_phone
-from .errors import FileTooBig
+from .engine import Engine
+from .metrics import Metrics, serve
+from .packing import (
+    DIRECT,
+    INITIAL_THROUGHPUT,
+    ThroughputEstimator,
+    get_filters,
+    plan_packing,
+)
+from .progress import CountingReader, Rate
+from .registry import JobRegistry
+from .retry import AUTH, FATAL, THROTTLE, CircuitBreaker, RetryPolicy, classify
+from .scheduler import Scheduler
+from .spool import Spool
+from .tokens import TokenCache
+from .util import (
+    RateLimiter,
+    download_file,
+    download_ytvideo,
+    get_cached_ytinfo,
+    get_db,
+    get_spool_dir,
+    get_urls_key,
+    is_ytlink,
+    parse_phone,
+    parse_urls,
+    probe_url,
+    probe_ytvideo,
+    safe_filename,
+)
+from .verify import verify_part
+from .workers import Task, WorkerPool
+from .errors import CorruptUpload, FileTooBig, TaskAborted
+
+if TYPE_CHECKING:
+    from todus.client import ToDusClient
 
 __version__ = "1.0.0"
 DEF_MAX_SIZE = str(1024 * 1024 * 200)
 DEF_DOWNLOAD_TIMEOUT = str(60 * 60 * 2)
 DEF_PART_SIZE = str(1024 * 1024 * 15)
-queue_size = 50
-delay = 60 * 2
-pool = ThreadPoolExecutor(max_workers=10)
-petitions = dict()
-downloading = set()
+DEF_DOWNLOAD_SEGMENTS = "4"
+DEF_MAX_URLS = "20"
+DEF_BATCH_DOWNLOADS = "3"
+DEF_MAX_UPLOADS = "3"
+DEF_UPLOAD_DELAY = "20"
+DEF_TOKEN_TTL = str(60 * 30)
+DEF_MAX_WORKERS = "10"
+DEF_QUEUE_SIZE = "50"
+DEF_DOWNLOAD_WORKERS = "5"
+DEF_ARCHIVE_WORKERS = "2"
+DEF_UPLOAD_WORKERS = "5"
+DEF_WORKER_MAX_JOBS = "20"
+DEF_CACHE_TTL = str(60 * 60 * 24 * 3)
+DEF_CACHE_SIZE = "1000"
+DEF_METRICS_PORT = "0"
+DEF_MAX_ATTEMPTS = "5"
+DEF_RETRY_DELAY = "5"
+DEF_MAX_RETRY_DELAY = str(60 * 5)
+DEF_USER_QUOTA = DEF_MAX_SIZE
+DEF_WARM_UP = "0"
+DEF_MIN_FREE_SPACE = str(1024 * 1024 * 500)
+DEF_SPOOL_SIZE = "0"
+DEF_DOWNLOAD_RATE = "0"
+DEF_UPLOAD_RATE = "0"
+DEF_VERIFY_UPLOADS = "0"
+PROGRESS_INTERVAL = 2
+# seconds the settings read by _getcached() are kept
+SETTINGS_TTL = 60
+# I/O threads for logins and codes, besides the ones for uploads
+IO_THREADS_EXTRA = 4
+ACTIVE_STATES = ("downloading", "archiving", "uploading")
+upload_limiter = RateLimiter(int(DEF_UPLOAD_DELAY))
+metrics = Metrics()
+upload_speed = ThroughputEstimator(INITIAL_THROUGHPUT)
+retries = RetryPolicy(
+    int(DEF_MAX_ATTEMPTS),
+    int(DEF_RETRY_DELAY),
+    int(DEF_MAX_RETRY_DELAY),
+    CircuitBreaker(threshold=10, cooldown=60),
+)
+tokens = TokenCache(int(DEF_TOKEN_TTL), refresh_margin=60)
+inbound = BandwidthManager(int(DEF_DOWNLOAD_RATE))
+outbound = BandwidthManager(int(DEF_UPLOAD_RATE))
+jobs = JobRegistry()
+_settings: Dict[str, Tuple[float, str]] = {}
 db: DBManager = None
+engine: Engine = None
+scheduler: Scheduler = None
+spool: Spool = None
+workers: WorkerPool = None
 
 
 class Download:
-    def __init__(self, addr: str) -> None:
+    def __init__(self, addr: str, job_id: int, state: str = "queued") -> None:
         self.addr = addr
+        self.job_id = job_id
+        self.state = state
+        # expected size of the petition before it is downloaded
+        self.expected_size: Optional[int] = None
+        # waiting in the queue for disk space
+        self.held = False
         self.step = -2.0
         self.parts = 0
         self.size = 0
+        self.downloaded = Rate()
+        self.uploaded = Rate()
+        self.upload_total = -1
+        self._downloads_done = (0, 0)
+        self._part_bytes: Dict[int, int] = {}
         self.canceled = Event()
-        self.client = ToDusClient()
-        self.download_process: Optional[ResultProcess] = None
+        self.clients: Set["ToDusClient"] = set()
+        self.download_tasks: Set[Task] = set()
+        self.tasks: Set[concurrent.futures.Future] = set()
+        # bandwidth shares, 0 means no limit
+        self.download_rate = 0.0
+        self.upload_bucket = TokenBucket()
+        self._lock = Lock()
+
+    def advance(self, step: float) -> None:
+        with self._lock:
+            self.step += step
+
+    def end_download_task(self, task: Task) -> None:
+        with self._lock:
+            self.download_tasks.discard(task)
+            done, total = task.get_progress()
+            self._downloads_done = (
+                self._downloads_done[0] + done,
+                self._downloads_done[1] + max(done, total),
+            )
+
+    def set_download_rate(self, rate: float) -> None:
+        """Split the download rate of the petition between its downloads."""
+        with self._lock:
+            self.download_rate = rate
+            tasks = list(self.download_tasks)
+        for task in tasks:
+            task.set_rate(rate / len(tasks))
+
+    def set_part_bytes(self, number: int, count: int) -> None:
+        with self._lock:
+            self._part_bytes[number] = count
+
+    def get_download_size(self) -> int:
+        """Bytes downloaded, counting the whole size of the files of known size."""
+        with self._lock:
+            size = self._downloads_done[1]
+            tasks = list(self.download_tasks)
+        for task in tasks:
+            done, total = task.get_progress()
+            size += max(done, total)
+        return size
+
+    def sample(self) -> None:
+        """Update the transfer rates with the current byte counts."""
+        with self._lock:
+            done, total = self._downloads_done
+            tasks = list(self.download_tasks)
+            uploaded = sum(self._part_bytes.values())
+        for task in tasks:
+            task_done, task_total = task.get_progress()
+            done += task_done
+            total = -1 if task_total < 0 or total < 0 else total + task_total
+        if self.step < 0:
+            self.downloaded.update(done, total)
+        self.uploaded.update(uploaded, self.upload_total)
+
+    def get_eta(self) -> Optional[float]:
+        """Estimate the seconds left to finish the petition."""
+        if self.step >= 0:
+            return self.uploaded.get_eta()
+        eta = self.downloaded.get_eta()
+        if eta is None:
+            return None
+        return eta + (self.downloaded.total or 0) / upload_speed.value
 
     def abort(self) -> None:
         self.canceled.set()
-        self.client.abort()
-        p = self.download_process
-        if p is not None:
-            self.download_process = None
-            p.kill()
-            p.abort()
+        for client in list(self.clients):
+            client.abort()
+        for task in list(self.tasks):
+            task.cancel()
+        for task in list(self.download_tasks):
+            task.kill()
 
     def __repr__(self) -> str:
-        return f"<{self.addr} {self.step}/{self.parts}>"
+        return f"<#{self.job_id} {self.addr} {self.state} {self.step}/{self.parts}>"
 
 
 @simplebot.hookimpl
 def deltabot_init(bot: DeltaBot) -> None:
-    global db
+    global db, engine, scheduler, spool, workers
+    start = time.perf_counter()
     db = get_db(bot)
-    _getdefault(bot, "max_size", DEF_MAX_SIZE)
+    spool = Spool(
+        get_spool_dir(bot),
+        min_free=int(_getdefault(bot, "min_free_space", DEF_MIN_FREE_SPACE)),
+        max_size=int(_getdefault(bot, "spool_size", DEF_SPOOL_SIZE)),
+    )
+    max_size = int(_getdefault(bot, "max_size", DEF_MAX_SIZE))
     _getdefault(bot, "download_timeout", DEF_DOWNLOAD_TIMEOUT)
+    _getdefault(bot, "max_uploads", DEF_MAX_UPLOADS)
+    upload_limiter.interval = float(_getdefault(bot, "upload_delay", DEF_UPLOAD_DELAY))
+    tokens.ttl = float(_getdefault(bot, "token_ttl", DEF_TOKEN_TTL))
+    tokens.login = _login
+    retries.attempts = int(_getdefault(bot, "max_attempts", DEF_MAX_ATTEMPTS))
+    retries.base_delay = float(_getdefault(bot, "retry_delay", DEF_RETRY_DELAY))
+    retries.max_delay = float(_getdefault(bot, "max_retry_delay", DEF_MAX_RETRY_DELAY))
+    inbound.limit = int(_getdefault(bot, "download_rate", DEF_DOWNLOAD_RATE))
+    outbound.limit = int(_getdefault(bot, "upload_rate", DEF_UPLOAD_RATE))
+    _getdefault(bot, "verify_uploads", DEF_VERIFY_UPLOADS)
+    _getdefault(bot, "user_quota", DEF_USER_QUOTA)
+    scheduler = Scheduler(
+        workers=int(_getdefault(bot, "max_workers", DEF_MAX_WORKERS)),
+        queue_size=int(_getdefault(bot, "queue_size", DEF_QUEUE_SIZE)),
+        stages={
+            "download": int(_getdefault(bot, "download_workers", DEF_DOWNLOAD_WORKERS)),
+            "archive": int(_getdefault(bot, "archive_workers", DEF_ARCHIVE_WORKERS)),
+            "upload": int(_getdefault(bot, "upload_workers", DEF_UPLOAD_WORKERS)),
+        },
+        default_weight=max_size / 2,
+        logger=bot.logger,
+        remaining=_get_remaining,
+        admit=lambda job_id: _reserve_spool(bot, job_id),
+    )
+    engine = Engine(
+        io_threads=int(_getdefault(bot, "upload_workers", DEF_UPLOAD_WORKERS))
+        * int(_getdefault(bot, "max_uploads", DEF_MAX_UPLOADS))
+        + IO_THREADS_EXTRA
+    )
+    tokens.submit = lambda func, *args: engine.submit(engine.run(func, *args))
+    workers = WorkerPool(
+        size=int(_getdefault(bot, "download_workers", DEF_DOWNLOAD_WORKERS)),
+        max_jobs=int(_getdefault(bot, "worker_max_jobs", DEF_WORKER_MAX_JOBS)),
+    )
+    _init_metrics(bot)
+    # download workers don't inherit the modules of the plugin process, only
+    # the petitions that run here need them
+    if _getdefault(bot, "warm_up", DEF_WARM_UP) == "1":
+        lazy.warm_up(logger=bot.logger)
+    elapsed = time.perf_counter() - start
+    metrics.observe("todus_stage_seconds", elapsed, stage="startup")
+    bot.logger.debug("Plugin initialized in %.3fs", elapsed)
+
+
+@simplebot.hookimpl
+def deltabot_start(bot: DeltaBot) -> None:
+    engine.submit(_sample_progress(bot))
+    db.delete_jobs(["done", "failed"])
+    pending = db.get_jobs(["queued", "downloading", "archiving", "uploading"])
+    count, size = spool.cleanup(job["id"] for job in pending)
+    if count:
+        bot.logger.info(
+            "Removed %s orphaned spool files (%s)", count, _format_size(size)
+        )
+    for job in pending:
+        try:
+            msg = bot.account.get_message_by_id(job["msg_id"])
+        except Exception as ex:
+            bot.logger.exception(ex)
+            db.set_job_state(job["id"], "failed")
+            continue
+        bot.logger.info("Resuming petition #%s (%s)", job["id"], job["state"])
+        d = Download(job["addr"], job["id"])
+        d.expected_size = job["size"]
+        jobs.add(d)
+        scheduler.submit(
+            job["id"],
+            _process_request,
+            bot,
+            msg,
+            job["id"],
+            time.monotonic(),
+            weight=job["size"],
+            force=True,
+        )
 
 
 @simplebot.filter
@@ -79,20 +318,23 @@ def filter_messages(bot: DeltaBot, message: Message, replies: Replies) -> None:
             replies.add(text="❌ Ya verificaste tu número de teléfono")
             return
 
-        def task():
+        async def task():
             replies = Replies(message, logger=bot.logger)
             try:
-                password = ToDusClient().validate_code(acc["phone"], str(code))
-                db.set_password(acc["addr"], password)
+                client = _new_client()
+                password = await retries.call(
+                    lambda: engine.run(client.validate_code, acc["phone"], str(code))
+                )
+                await engine.run(db.set_password, acc["addr"], password)
                 replies.add(
                     text=f"☑️ Tu cuenta ha sido verificada! ya puedes comenzar a pedir contenido.\n\nContraseña:\n{password}"
                 )
             except Exception as ex:
                 bot.logger.exception(ex)
                 replies.add(text=f"❌ Falló la verificación: {ex}")
-            replies.send_reply_messages()
+            await engine.run(replies.send_reply_messages)
 
-        Thread(target=task).start()
+        engine.submit(task())
 
 
 @simplebot.command
@@ -106,21 +348,22 @@ def s3_login(bot: DeltaBot, payload: str, message: Message, replies: Replies) ->
         )
         return
 
-    def task():
+    async def task():
         replies = Replies(message, logger=bot.logger)
         try:
             phone = parse_phone(payload)
-            db.add_account(addr, phone)
-            ToDusClient().request_code(phone)
+            await engine.run(db.add_account, addr, phone)
+            client = _new_client()
+            await retries.call(lambda: engine.run(client.request_code, phone))
             replies.add(text="Debes recibir un código SMS, envíalo aquí")
         except Exception as ex:
             bot.logger.exception(ex)
             replies.add(
                 text=f"❌ Ocurrió un error, verifica que pusiste el número correctamente. {ex}"
             )
-        replies.send_reply_messages()
+        await engine.run(replies.send_reply_messages)
 
-    Thread(target=task).start()
+    engine.submit(task())
 
 
 @simplebot.command
@@ -134,13 +377,17 @@ def s3_login2(bot: DeltaBot, payload: str, message: Message, replies: Replies) -
         )
         return
 
-    def task():
+    async def task():
         replies = Replies(message, logger=bot.logger)
         try:
             phone, password = payload.rsplit(maxsplit=1)
             phone = parse_phone(phone)
-            ToDusClient().login(phone, password)
-            db.add_account(addr, phone, password)
+            client = _new_client()
+            token = await retries.call(
+                lambda: engine.run(_login, client, phone, password)
+            )
+            await engine.run(db.add_account, addr, phone, password)
+            tokens.put(phone, password, token)
             replies.add(
                 text=f"☑️ Tu cuenta ha sido verificada! ya puedes comenzar a pedir contenido.\n\nContraseña:\n{password}"
             )
@@ -149,24 +396,25 @@ def s3_login2(bot: DeltaBot, payload: str, message: Message, replies: Replies) -
             replies.add(
                 text=f"❌ Ocurrió un error, verifica que pusiste el número y contraseña correctamente. {ex}"
             )
-        replies.send_reply_messages()
+        await engine.run(replies.send_reply_messages)
 
-    Thread(target=task).start()
+    engine.submit(task())
 
 
 @simplebot.command
 def s3_logout(bot: DeltaBot, message: Message, replies: Replies) -> None:
     """Darte baja del bot y olvidar tu cuenta."""
     addr = message.get_sender_contact().addr
-    if addr in petitions:
+    if jobs.has_jobs(addr):
         replies.add(
-            text="❌ Tienes una petición pendiente en cola, espera a que tu descarga termine para darte baja.",
+            text="❌ Tienes peticiones pendientes en cola, espera a que tus descargas terminen o cancélalas con /s3_cancel para darte baja.",
             quote=message,
         )
         return
     acc = db.get_account(addr)
     if acc:
         db.delete_account(addr)
+        tokens.invalidate(acc["phone"])
         replies.add(
             text="🗑️ Tu cuenta ha sido desvinculada.\n\n**⚠️ATENCIÓN:** No se estén dando de baja y logueando otra vez constantemente si no quieren que ToDus bloquee su cuenta. No pueden la misma cuenta de ToDus en varios dispositivos por eso la app del ToDus les dejará de funcionar, tienen que o dejar de usar la apk o usar alguna que les deje establecer el password (el token que les envía el bot cuando inician sesión)"
         )
@@ -176,52 +424,81 @@ def s3_logout(bot: DeltaBot, message: Message, replies: Replies) -> None:
 
 @simplebot.command
 def s3_status(bot: DeltaBot, payload: str, message: Message, replies: Replies) -> None:
-    """Muestra el estado de tu descarga."""
+    """Muestra el estado de tus descargas."""
     addr = message.get_sender_contact().addr
-    in_queue = addr in petitions
-    d = None
-    for download in list(downloading):
-        if download.addr == addr:
-            d = download
-            break
-    if d and d.parts:
-        step = max(int(d.step), 0)
-        percent = step / d.parts
-        progress = ("🟩" * round(10 * percent)).ljust(10, "⬜")
-        text = f"⬆️ Tu petición se está subiendo...\n\n{progress}\n**{step}/{d.parts} ({d.size//1024:,}KB)**"
-    elif d:
-        text = f"⬇️ Tu petición se está descargando..."
-    elif in_queue:
-        text = "⏳ Tu petición está pendiente en cola, espera tu turno."
-    else:
-        text = "❌ No tienes ninguna petición pendiente en cola."
-    replies.add(text=text)
+    texts = []
+    user_jobs = jobs.get_by_addr(addr)
+    for d in user_jobs:
+        text = _get_status(d)
+        if len(user_jobs) > 1:
+            text = f"**#{d.job_id}** {text}"
+        texts.append(text)
+    if not texts:
+        texts.append("❌ No tienes ninguna petición pendiente en cola.")
+    replies.add(text="\n\n―――\n\n".join(texts))
 
 
 @simplebot.command
 def s3_get(bot: DeltaBot, payload: str, message: Message, replies: Replies) -> None:
-    """Obtén un archivo de internet como enlace de descarga gratis de s3, debes estar registrado para usar este comando."""
+    """Obtén un archivo de internet como enlace de descarga gratis de s3, debes estar registrado para usar este comando. Puedes pedir varios archivos a la vez separando las URLs con espacios o en líneas diferentes."""
     addr = message.get_sender_contact().addr
     acc = db.get_account(addr)
     if acc and acc["password"]:
-        if not payload:
+        try:
+            urls = parse_urls(payload)
+        except ValueError as ex:
+            replies.add(text=f"❌ {ex}", quote=message)
+            return
+        max_urls = int(_getdefault(bot, "max_urls", DEF_MAX_URLS))
+        cached = urls and _get_cached(bot, get_urls_key(urls))
+        if not urls:
             replies.add(
                 text="❌ Ehhh... no me pasaste la URL de internet que quieres descargar, por ejemplo: /s3_get https://fsf.org",
                 quote=message,
             )
-        elif addr in petitions:
+        elif len(urls) > max_urls:
             replies.add(
-                text="❌ Ya tienes una petición pendiente en cola, espera a que tu descarga termine, solo puedes hacer una petición a la vez.",
+                text=f"❌ Puedes pedir como máximo {max_urls} URLs a la vez.",
                 quote=message,
             )
-        elif len(petitions) >= queue_size:
+        elif cached:
+            metrics.inc("todus_cache_hits_total", kind="url")
+            _add_index(
+                replies, message, cached["filename"], cached["size"], cached["parts"]
+            )
+        elif not _has_quota(bot, addr):
+            replies.add(
+                text="❌ Tus peticiones pendientes ya alcanzan el límite de tamaño, espera a que tus descargas terminen para hacer otra petición.",
+                quote=message,
+            )
+        elif scheduler.is_full():
             replies.add(
                 text="⏸️ Ya hay muchas peticiones pendientes en cola, intenta más tarde.",
                 quote=message,
             )
         else:
-            petitions[addr] = payload
-            pool.submit(_process_request, bot, message, addr, acc, payload)
+            job_id = db.add_job(addr, "\n".join(urls), message.id)
+            jobs.add(Download(addr, job_id))
+            scheduler.submit(
+                job_id,
+                _process_request,
+                bot,
+                message,
+                job_id,
+                time.monotonic(),
+                force=True,
+            )
+            max_size = int(_getdefault(bot, "max_size", DEF_MAX_SIZE))
+            engine.submit(
+                engine.run(
+                    _probe_size,
+                    bot,
+                    message,
+                    job_id,
+                    urls,
+                    None if bot.is_admin(addr) else max_size,
+                )
+            )
             replies.add(
                 text="⏳ Tu petición ha sido puesta en la cola de descargas, por favor, espera.",
                 quote=message,
@@ -231,20 +508,25 @@ def s3_get(bot: DeltaBot, payload: str, message: Message, replies: Replies) -> N
 
 
 @simplebot.command
-def s3_cancel(message: Message, replies: Replies) -> None:
-    """Cancela la descarga de tu petición."""
+def s3_cancel(bot: DeltaBot, payload: str, message: Message, replies: Replies) -> None:
+    """Cancela tus peticiones, o solo la indicada. Ejemplo: /s3_cancel 25"""
     addr = message.get_sender_contact().addr
-    download = None
-    for d in list(downloading):
-        if d.addr == addr:
-            download = d
-    if download:
-        download.abort()
-    else:
+    user_jobs = jobs.get_by_addr(addr)
+    if payload:
+        user_jobs = [d for d in user_jobs if str(d.job_id) == payload.strip("# ")]
+    if not user_jobs:
         replies.add(
-            text="❌ No tienes ninguna descarga en curso. Si tienes una petición en la cola, debes esperar a que tu descarga comience para cancelarla",
-            quote=message,
+            text="❌ No tienes ninguna petición pendiente en cola.", quote=message
         )
+    for d in user_jobs:
+        if scheduler.remove(d.job_id):
+            # the petition didn't start yet, just forget it
+            jobs.remove(d.job_id)
+            db.set_job_state(d.job_id, "failed")
+            metrics.inc("todus_jobs_total", result="failed", cause="canceled")
+            replies.add(text=f"🗑️ Petición #{d.job_id} cancelada.", quote=message)
+        else:
+            d.abort()
 
 
 @simplebot.command
@@ -263,16 +545,78 @@ def s3_token(bot: DeltaBot, message: Message, replies: Replies) -> None:
     acc = db.get_account(message.get_sender_contact().addr)
     if acc and acc["password"]:
 
-        def task():
+        async def task():
             replies = Replies(message, logger=bot.logger)
-            replies.add(ToDusClient().login(acc["phone"], acc["password"]))
-            replies.send_reply_messages()
+            try:
+                token = await retries.call(
+                    lambda: engine.run(tokens.get, acc["phone"], acc["password"])
+                )
+                replies.add(text=token)
+            except Exception as ex:
+                bot.logger.exception(ex)
+                replies.add(text=f"❌ Falló el inicio de sesión: {ex}")
+            await engine.run(replies.send_reply_messages)
 
-        Thread(target=task).start()
+        engine.submit(task())
     else:
         replies.add(text="❌ No estás registrado", quote=message)
 
 
+@simplebot.command(admin=True)
+def s3_jobs(message: Message, replies: Replies) -> None:
+    """Muestra el progreso de todas las peticiones en curso."""
+    queued, running = scheduler.get_load()
+    lines = []
+    download_speed = upload_speed_total = 0.0
+    # one view of all the petitions, so the counts match the listed ones
+    snapshot = [(d, d.state) for d in jobs.snapshot()]
+    counts = Counter(state for _, state in snapshot)
+    for d, state in snapshot:
+        if state not in ACTIVE_STATES:
+            continue
+        d.sample()
+        if d.parts:
+            icon, rate = "⬆️", d.uploaded
+            upload_speed_total += rate.get_speed()
+        else:
+            icon, rate = "⬇️", d.downloaded
+            download_speed += rate.get_speed()
+        line = f"#{d.job_id} {d.addr} {icon} {_format_size(rate.done)}"
+        if rate.total:
+            line += f"/{_format_size(rate.total)}"
+        line += f" {_format_size(rate.get_speed())}/s"
+        eta = d.get_eta()
+        if eta is not None:
+            line += f" ~{_format_time(eta)}"
+        lines.append(line)
+    text = (
+        f"En curso: {running}, en cola: {queued}\n"
+        f"Descargando: {counts['downloading']}, "
+        f"empaquetando: {counts['archiving']}, "
+        f"subiendo: {counts['uploading']}\n"
+        f"⬇️ {_format_size(download_speed)}/s ⬆️ {_format_size(upload_speed_total)}/s"
+    )
+    if lines:
+        text += "\n\n" + "\n".join(lines)
+    replies.add(text=text, quote=message)
+
+
+@simplebot.command(admin=True)
+def s3_stats(message: Message, replies: Replies) -> None:
+    """Muestra estadísticas de rendimiento del bot."""
+    text = metrics.summary() or "No hay datos todavía."
+    used, reserved, free = spool.get_usage()
+    text += (
+        f"\n\nDisco: {_format_size(used)} usados, {_format_size(reserved)}"
+        f" reservados, {_format_size(free)} libres"
+    )
+    text += "\n\nImportaciones:\n" + "\n".join(
+        f"{name}: {'sin cargar' if cost is None else f'{cost * 1000:.0f}ms'}"
+        for name, cost in lazy.get_costs().items()
+    )
+    replies.add(text=text, quote=message)
+
+
 def _getdefault(bot: DeltaBot, key: str, value: str = None) -> str:
     val = bot.get(key, scope=__name__)
     if val is None and value is not None:
@@ -281,92 +625,754 @@ def _getdefault(bot: DeltaBot, key: str, value: str = None) -> str:
     return val
 
 
-def _process_request(
-    bot: DeltaBot, msg: Message, addr: str, acc: dict, url: str
+def _getcached(bot: DeltaBot, key: str, value: str = None) -> str:
+    """Like _getdefault() but the value is kept for SETTINGS_TTL seconds.
+
+    For hot paths, reading a setting queries the bot's database.
+    """
+    now = time.monotonic()
+    entry = _settings.get(key)
+    if entry is None or entry[0] < now:
+        entry = _settings[key] = (now + SETTINGS_TTL, _getdefault(bot, key, value))
+    return entry[1]
+
+
+def _new_client() -> "ToDusClient":
+    return lazy.load("todus.client").ToDusClient()
+
+
+def _login(client: "ToDusClient", phone: str, password: str) -> str:
+    with metrics.timer("todus_stage_seconds", stage="login"):
+        return client.login(phone, password)
+
+
+def _init_metrics(bot: DeltaBot) -> None:
+    metrics.describe("todus_stage_seconds", "Time spent in each stage of a petition")
+    metrics.describe("todus_bytes_total", "Bytes downloaded from origins and uploaded")
+    metrics.describe("todus_upload_retries_total", "Part uploads that were retried")
+    metrics.describe("todus_jobs_total", "Finished petitions by result and cause")
+    metrics.describe("todus_cache_hits_total", "Petitions answered from the cache")
+    metrics.describe("todus_verified_parts_total", "Uploaded parts checked, by result")
+    metrics.gauge("todus_circuit_open", lambda: float(retries.breaker.is_open()))
+    metrics.gauge("todus_queue_depth", lambda: scheduler.get_load()[0])
+    metrics.gauge("todus_jobs_running", lambda: scheduler.get_load()[1])
+    metrics.gauge("todus_download_workers_busy", workers.get_busy)
+    metrics.gauge("todus_download_workers", lambda: workers.size)
+    metrics.gauge("todus_spool_used_bytes", lambda: spool.get_usage()[0])
+    metrics.gauge("todus_spool_reserved_bytes", lambda: spool.get_usage()[1])
+    metrics.gauge("todus_spool_free_bytes", lambda: spool.get_usage()[2])
+    port = int(_getdefault(bot, "metrics_port", DEF_METRICS_PORT))
+    if port:
+        serve(metrics, port)
+        bot.logger.info("Serving metrics at http://127.0.0.1:%s/metrics", port)
+
+
+def _format_size(size: float) -> str:
+    if size >= 1024**2:
+        return f"{size / 1024**2:,.1f}MB"
+    return f"{size / 1024:,.0f}KB"
+
+
+def _format_rate(rate: Rate) -> str:
+    text = f"\n\n{_format_size(rate.done)}"
+    if rate.total:
+        text += f"/{_format_size(rate.total)} ({min(rate.done / rate.total, 1):.0%})"
+    speed = rate.get_speed()
+    if speed:
+        text += f"\nVelocidad: {_format_size(speed)}/s"
+    eta = rate.get_eta()
+    if eta is not None:
+        text += f"\nTiempo restante: {_format_time(eta)}"
+    return text
+
+
+def _get_status(d: Download) -> str:
+    if d.state == "queued":
+        text = "⏳ Tu petición está pendiente en cola, espera tu turno."
+        if d.held:
+            text += "\nEl bot está esperando a tener espacio libre en disco."
+        position = scheduler.get_position(d.job_id)
+        if position:
+            pos, eta = position
+            text += f"\n\nPosición en la cola: {pos + 1}"
+            if eta is not None:
+                text += f"\nTiempo estimado de espera: {_format_time(eta)}"
+        return text
+    d.sample()
+    if d.parts:
+        step = max(int(d.step), 0)
+        percent = step / d.parts
+        progress = ("🟩" * round(10 * percent)).ljust(10, "⬜")
+        text = f"⬆️ Tu petición se está subiendo...\n\n{progress}\n**{step}/{d.parts} ({d.size//1024:,}KB)**"
+        return text + _format_rate(d.uploaded)
+    return "⬇️ Tu petición se está descargando..." + _format_rate(d.downloaded)
+
+
+def _has_quota(bot: DeltaBot, addr: str) -> bool:
+    """Tell if the user can queue another petition.
+
+    Users can have several petitions at once as long as their expected
+    total size doesn't exceed ``user_quota``, a petition of unknown size
+    counts as half ``max_size``.
+    """
+    user_jobs = jobs.get_by_addr(addr)
+    if not user_jobs or bot.is_admin(addr):
+        return True
+    max_size = int(_getdefault(bot, "max_size", DEF_MAX_SIZE))
+    quota = int(_getdefault(bot, "user_quota", DEF_USER_QUOTA))
+    pending = sum(d.size or d.expected_size or max_size / 2 for d in user_jobs)
+    return pending + max_size / 2 <= quota
+
+
+def _get_spool_need(bot: DeltaBot, d: Download) -> int:
+    """Estimate the disk space a petition needs: the file and its volumes."""
+    size = d.expected_size or int(_getcached(bot, "max_size", DEF_MAX_SIZE))
+    # volumes are removed once uploaded, only a few exist at the same time
+    volumes = int(_getcached(bot, "part_size", DEF_PART_SIZE)) * (
+        int(_getcached(bot, "max_uploads", DEF_MAX_UPLOADS)) + 2
+    )
+    return size + min(size, volumes)
+
+
+def _reserve_spool(bot: DeltaBot, job_id: int) -> bool:
+    d = jobs.get(job_id)
+    if d is None:
+        return True
+    if spool.reserve(job_id, _get_spool_need(bot, d)):
+        return True
+    if not d.held:
+        d.held = True
+        bot.logger.info("Petition #%s waits for disk space", job_id)
+    return False
+
+
+def _set_state(d: Download, state: str) -> None:
+    db.set_job_state(d.job_id, state)
+    jobs.set_state(d.job_id, state)
+
+
+def _get_remaining(job_id: int) -> Optional[float]:
+    d = jobs.get(job_id)
+    return d.get_eta() if d and d.state != "queued" else None
+
+
+async def _sample_progress(bot: DeltaBot) -> None:
+    while True:
+        for d in jobs.get_by_state(*ACTIVE_STATES):
+            d.sample()
+        try:
+            # settings and admins are read from the bot's database
+            await engine.run(_shape_traffic, bot)
+        except Exception as ex:
+            bot.logger.exception(ex)
+        await asyncio.sleep(PROGRESS_INTERVAL)
+
+
+def _shape_traffic(bot: DeltaBot) -> None:
+    """Split the download and upload budgets between the running petitions."""
+    small = int(_getcached(bot, "part_size", DEF_PART_SIZE))
+    downloading = [d for d in jobs.get_by_state("downloading") if d.download_tasks]
+    rates = inbound.split(
+        {
+            d.job_id: (
+                _get_priority(bot, d, small),
+                d.downloaded.get_speed(),
+                d.download_rate,
+            )
+            for d in downloading
+        }
+    )
+    for d in downloading:
+        d.set_download_rate(rates[d.job_id])
+    uploading = jobs.get_by_state("uploading")
+    rates = outbound.split(
+        {
+            d.job_id: (
+                _get_priority(bot, d, small),
+                d.uploaded.get_speed(),
+                d.upload_bucket.rate,
+            )
+            for d in uploading
+        }
+    )
+    for d in uploading:
+        d.upload_bucket.rate = rates[d.job_id]
+
+
+def _get_priority(bot: DeltaBot, d: Download, small: int) -> float:
+    """Weight of the petition in the bandwidth split, admins and small files first."""
+    weight = 1.0
+    if bot.is_admin(d.addr):
+        weight *= 2
+    size = d.size or d.expected_size
+    if size and size <= small:
+        weight *= 2
+    return weight
+
+
+def _get_upload_speed() -> float:
+    return sum(d.uploaded.get_speed() for d in jobs.get_by_state("uploading"))
+
+
+def _format_time(seconds: float) -> str:
+    minutes = round(seconds / 60)
+    if minutes < 60:
+        return f"{max(minutes, 1)} min"
+    return f"{minutes // 60}h {minutes % 60:02}min"
+
+
+def _plan_packing(bot: DeltaBot, job: dict) -> dict:
+    method, part_count, part_size = plan_packing(
+        _get_files(job),
+        int(_getdefault(bot, "part_size", DEF_PART_SIZE)),
+        int(_getdefault(bot, "max_uploads", DEF_MAX_UPLOADS)),
+        upload_limiter.interval,
+        upload_speed.value,
+    )
+    bot.logger.debug(
+        "Petition #%s packing: %s, %s parts of %s bytes",
+        job["id"],
+        method,
+        part_count,
+        part_size,
+    )
+    return dict(method=method, part_count=part_count, part_size=part_size)
+
+
+def _get_files(job: dict) -> List[Tuple[str, str]]:
+    """Return the path and name of the downloaded files of a petition."""
+    if os.path.isdir(job["path"]):
+        return [
+            (os.path.join(job["path"], name), name)
+            for name in sorted(os.listdir(job["path"]))
+        ]
+    return [(job["path"], job["filename"])]
+
+
+def _probe_size(
+    bot: DeltaBot, msg: Message, job_id: int, urls: List[str], max_size: Optional[int]
 ) -> None:
-    bot.logger.debug("Processing petition: %s - %s", addr, url)
-    d = Download(addr)
-    downloading.add(d)
+    """Estimate the size of a queued petition, fail it now if it is too big."""
+    total = None
+    try:
+        for url in urls:
+            if is_ytlink(url):
+                size = probe_ytvideo(url, max_size)
+            else:
+                size = probe_url(url)[0]
+            if size is not None:
+                total = (total or 0) + size
+                if max_size is not None and total > max_size:
+                    raise FileTooBig()
+    except FileTooBig:
+        # if it already started, the download fails the same way
+        if scheduler.remove(job_id):
+            jobs.remove(job_id)
+            db.set_job_state(job_id, "failed")
+            metrics.inc("todus_jobs_total", result="failed", cause="FileTooBig")
+            replies = Replies(msg, logger=bot.logger)
+            replies.add(text="❌ La descarga falló. Archivo muy grande", quote=msg)
+            replies.send_reply_messages()
+        return
+    if total is not None:
+        d = jobs.get(job_id)
+        if d:
+            d.expected_size = total
+        scheduler.set_weight(job_id, total)
+
+
+def _archive(
+    files: List[Tuple[str, str]],
+    filename: str,
+    folder: str,
+    method: str,
+    part_size: int,
+    volumes: queue.Queue,
+    stop: Event,
+) -> None:
+    slot: Optional[Semaphore] = None
+
+    def put(item) -> None:
+        # don't hold the archive slot while waiting for the uploader
+        if slot:
+            slot.release()
+        try:
+            while not stop.is_set():
+                try:
+                    volumes.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    pass
+            raise AbortError()
+        finally:
+            if slot:
+                slot.acquire()
+
+    # the spool files are named here, the names given by the origin server
+    # are only used in the index and inside the archive
+    if method == DIRECT:
+        try:
+            path, name = files[0]
+            part_path = os.path.join(folder, "part.0001")
+            try:
+                os.link(path, part_path)
+            except OSError:
+                shutil.copyfile(path, part_path)
+            put((1, part_path, name))
+            put(1)
+        except Exception as ex:
+            try:
+                put(ex)
+            except AbortError:
+                pass
+        return
+
+    writer = VolumeWriter(
+        os.path.join(folder, "part"),
+        part_size,
+        lambda index, part_path: put(
+            (index, part_path, filename + ".7z" + os.path.splitext(part_path)[1])
+        ),
+    )
+    try:
+        with scheduler.stage("archive") as slot, metrics.timer(
+            "todus_stage_seconds", stage="archive", method=method
+        ):
+            py7zr = lazy.load("py7zr")
+            with py7zr.SevenZipFile(writer, "w", filters=get_filters(method)) as a:
+                for path, name in files:
+                    a.write(path, name)
+            writer.close()
+        slot = None
+        put(writer.volumes)
+    except Exception as ex:
+        slot = None
+        writer.discard()
+        try:
+            put(ex)
+        except AbortError:
+            pass
+
+
+async def _upload_part(
+    bot: DeltaBot,
+    d: Download,
+    acc: dict,
+    job_id: int,
+    i: int,
+    path: str,
+    name: str,
+    verify: bool,
+) -> tuple:
     cancel_err = ValueError("Descarga cancelada.")
+    client = _new_client()
+    d.clients.add(client)
     try:
-        is_admin = bot.is_admin(addr)
-        max_size = int(_getdefault(bot, "max_size", DEF_MAX_SIZE))
-        process = ResultProcess(
-            target=download_ytvideo if is_ytlink(url) else download_file,
-            args=(url, max_size, is_admin),
-        )
-        process.start()
-        d.download_process = process
-        filename, data, size = process.get_result(
-            int(_getdefault(bot, "download_timeout", DEF_DOWNLOAD_TIMEOUT))
-        )
-        bot.logger.debug(f"Downloaded {size//1024:,}KB: {url}")
+        with open(path, "rb") as file, mmap.mmap(
+            file.fileno(), 0, access=mmap.ACCESS_READ
+        ) as part:
+            await asyncio.sleep(upload_limiter.reserve(acc["phone"]))
+            if d.canceled.is_set():
+                raise cancel_err
+            bot.logger.debug("Uploading part %s/%s of %s", i, d.parts, d.addr)
+            logged = False
+            token: Optional[str] = None
+            md5 = ""
+
+            async def upload() -> str:
+                nonlocal logged, token, md5
+                token = None
+                token = await engine.run(tokens.get, acc["phone"], acc["password"])
+                if not logged:
+                    logged = True
+                    d.advance(0.5)
+                start = time.monotonic()
+                data = CountingReader(
+                    part, lambda count: d.set_part_bytes(i, count), d.upload_bucket
+                )
+                with metrics.timer("todus_stage_seconds", stage="upload_part"):
+                    url = await engine.run(client.upload_file, token, data, len(part))
+                upload_speed.update(len(part), time.monotonic() - start)
+                outbound.recover(_get_upload_speed())
+                md5 = data.get_md5()
+                if verify:
+                    with metrics.timer("todus_stage_seconds", stage="verify"):
+                        ok = await engine.run(
+                            verify_part,
+                            functools.partial(client.download_file, token, url),
+                            path + ".check",
+                            len(part),
+                            md5,
+                        )
+                    metrics.inc("todus_verified_parts_total", result=str(ok).lower())
+                    # only this part is uploaded again
+                    if ok is False:
+                        raise CorruptUpload(f"la parte {i} se subió incompleta")
+                return url
+
+            def classify_error(ex: Exception) -> str:
+                kind = classify(ex)
+                if d.canceled.is_set():
+                    return FATAL
+                # a rejected login won't be fixed logging in again
+                if kind == AUTH and token is None:
+                    return FATAL
+                return kind
+
+            def on_retry(ex: Exception, kind: str, wait: float) -> None:
+                bot.logger.warning(
+                    "Part %s/%s of %s failed (%s), retrying in %.1fs: %r",
+                    i,
+                    d.parts,
+                    d.addr,
+                    kind,
+                    wait,
+                    ex,
+                )
+                metrics.inc("todus_upload_retries_total", kind=kind)
+                if kind == AUTH:
+                    tokens.invalidate(acc["phone"], token)
+                elif kind == THROTTLE:
+                    outbound.backoff(_get_upload_speed())
+
+            try:
+                down_url = await retries.call(
+                    upload, retry_auth=True, classify=classify_error, on_retry=on_retry
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                if d.canceled.is_set() or isinstance(ex, AbortError):
+                    raise cancel_err
+                bot.logger.exception(ex)
+                if classify(ex) == AUTH:
+                    tokens.invalidate(acc["phone"], token)
+                raise ValueError(f"Fallo al subir parte {i} ({len(part):,}B): {ex}")
+            metrics.inc("todus_bytes_total", len(part), direction="upload")
+            d.advance(0.5)
+            await engine.run(db.add_part, job_id, i, name, down_url, md5)
+            return down_url, name, md5
+    finally:
+        d.clients.discard(client)
+        # the spool folder could be already removed if the petition was canceled
+        with suppress(FileNotFoundError):
+            os.remove(path)
+
+
+def _download(bot: DeltaBot, d: Download, url: str, folder: str) -> tuple:
+    if d.canceled.is_set():
+        raise ValueError("Descarga cancelada.")
+    is_admin = bot.is_admin(d.addr)
+    # max_size limits the whole petition, other files could be downloading
+    max_size = int(_getdefault(bot, "max_size", DEF_MAX_SIZE)) - d.get_download_size()
+    if not is_admin and max_size < 0:
+        raise FileTooBig()
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+    if is_ytlink(url):
+        info = get_cached_ytinfo(url)
+        func, args = download_ytvideo, (url, folder, max_size, is_admin, info)
+    else:
+        segments = int(_getdefault(bot, "download_segments", DEF_DOWNLOAD_SEGMENTS))
+        func, args = download_file, (url, folder, max_size, is_admin, segments)
+    timeout = int(_getdefault(bot, "download_timeout", DEF_DOWNLOAD_TIMEOUT))
+    task = Task()
+    d.download_tasks.add(task)
+    d.set_download_rate(d.download_rate)
+    try:
+        with metrics.timer("todus_stage_seconds", stage="download"):
+            result = workers.run(func, args, timeout, task)
+    except TaskAborted:
+        raise ValueError("Descarga cancelada.")
+    except TimeoutError:
+        raise ValueError("Se agotó el tiempo de descarga.")
+    finally:
+        d.end_download_task(task)
+    bot.logger.debug(f"Downloaded {result[2]//1024:,}KB: {url}")
+    metrics.inc("todus_bytes_total", result[2], direction="download")
+    return result
+
+
+def _download_batch(
+    bot: DeltaBot, d: Download, job_id: int, urls: List[str], folder: str
+) -> tuple:
+    """Download several URLs at once and put the files together in one folder.
+
+    The files share the ``max_size`` budget, the downloads are stopped as
+    soon as the downloaded bytes and the known sizes exceed it.
+    """
+    max_size = int(_getdefault(bot, "max_size", DEF_MAX_SIZE))
+    is_admin = bot.is_admin(d.addr)
+    max_downloads = int(_getdefault(bot, "batch_downloads", DEF_BATCH_DOWNLOADS))
+    shutil.rmtree(folder, ignore_errors=True)
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(max_downloads, len(urls))
+    ) as pool:
+        futures = [
+            pool.submit(_download, bot, d, url, os.path.join(folder, str(i)))
+            for i, url in enumerate(urls)
+        ]
+        pending = set(futures)
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, timeout=1, return_when=concurrent.futures.FIRST_EXCEPTION
+            )
+            errors = [fut.exception() for fut in done if fut.exception()]
+            if not errors and not is_admin and d.get_download_size() > max_size:
+                errors.append(FileTooBig())
+            if errors:
+                # one failed download fails the whole petition, stop the others
+                for fut in futures:
+                    fut.cancel()
+                for task in list(d.download_tasks):
+                    task.kill()
+                raise errors[0]
+        results = [fut.result() for fut in futures]
+    batch = os.path.join(folder, "files")
+    os.makedirs(batch)
+    total = 0
+    digests = []
+    for filename, path, size, digest, _ in results:
+        # the name comes from the download worker, never trust it with paths
+        filename = safe_filename(filename) or "file"
+        name, ext = os.path.splitext(filename)
+        count = 1
+        while os.path.exists(os.path.join(batch, filename)):
+            count += 1
+            filename = f"{name} ({count}){ext}"
+        os.replace(path, os.path.join(batch, filename))
+        total += size
+        digests.append(f"{filename}\t{digest}")
+    if not is_admin and total > max_size:
+        raise FileTooBig()
+    digest = hashlib.sha256("\n".join(sorted(digests)).encode()).hexdigest()
+    return f"archivos-{job_id}", batch, total, digest, None
+
+
+def _upload(bot: DeltaBot, d: Download, acc: dict, job: dict, folder: str) -> dict:
+    cancel_err = ValueError("Descarga cancelada.")
+    uploaded = {part["number"]: part for part in db.get_parts(job["id"])}
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+    d.parts = job["part_count"]
+    d.upload_total = job["part_count"] * job["part_size"]
+    volumes: queue.Queue = queue.Queue(maxsize=1)
+    stop = Event()
+    archiver = Thread(
+        target=_archive,
+        args=(
+            _get_files(job),
+            job["filename"],
+            folder,
+            job["method"],
+            job["part_size"],
+            volumes,
+            stop,
+        ),
+        daemon=True,
+    )
+    archiver.start()
+    parts = {}
+    max_uploads = int(_getdefault(bot, "max_uploads", DEF_MAX_UPLOADS))
+    verify = _getdefault(bot, "verify_uploads", DEF_VERIFY_UPLOADS) == "1"
+    slots = Semaphore(max_uploads)
+    futures: dict = {}
+    try:
+        while True:
+            for fut in futures.values():
+                if fut.done() and not fut.cancelled() and fut.exception():
+                    raise fut.exception()
+            if d.canceled.is_set():
+                raise cancel_err
+            if not slots.acquire(timeout=1):
+                continue
+            item = volumes.get()
+            if isinstance(item, Exception):
+                raise item
+            if isinstance(item, int):
+                d.parts = item
+                break
+            i, part_path, name = item
+            if i in uploaded:
+                bot.logger.debug("Part %s of job #%s already uploaded", i, job["id"])
+                parts[i] = (uploaded[i]["url"], uploaded[i]["name"], uploaded[i]["md5"])
+                d.set_part_bytes(i, os.path.getsize(part_path))
+                os.remove(part_path)
+                d.advance(1)
+                slots.release()
+                continue
+            if d.state != "uploading":
+                _set_state(d, "uploading")
+            futures[i] = engine.submit(
+                _upload_part(bot, d, acc, job["id"], i, part_path, name, verify)
+            )
+            d.tasks.add(futures[i])
+            futures[i].add_done_callback(lambda _: slots.release())
+        for i, fut in futures.items():
+            try:
+                parts[i] = fut.result()
+            except concurrent.futures.CancelledError:
+                raise cancel_err
+    except Exception:
+        d.abort()
+        raise
+    finally:
+        stop.set()
+        archiver.join()
+    return parts
+
+
+def _process_request(bot: DeltaBot, msg: Message, job_id: int, queued: float) -> None:
+    start = time.monotonic()
+    metrics.observe("todus_stage_seconds", start - queued, stage="queue")
+    job = dict(db.get_job(job_id))
+    addr, url = job["addr"], job["url"]
+    bot.logger.debug("Processing petition #%s: %s - %s", job_id, addr, url)
+    d = jobs.get(job_id)
+    cancel_err = ValueError("Descarga cancelada.")
+    spooldir = spool.get_path(job_id)
+    urls = url.split()
+    jobs.set_state(job_id, "downloading", expected=["queued"])
+    try:
+        # petitions saved by older versions could have invalid URLs
+        url_key = get_urls_key(urls)
+        if d.canceled.is_set():
+            raise cancel_err
+        acc = db.get_account(addr)
+        if not acc or not acc["password"]:
+            raise ValueError("No estás registrado")
+        if job["path"] and os.path.exists(job["path"]):
+            bot.logger.debug("Resuming petition #%s from spooled file", job_id)
+        else:
+            cached = _revalidate_cached(bot, url_key, url)
+            if cached:
+                metrics.inc("todus_cache_hits_total", kind="revalidated")
+                _set_state(d, "done")
+                _send_index(
+                    bot, msg, cached["filename"], cached["size"], cached["parts"]
+                )
+                return
+            with scheduler.stage("download"):
+                _set_state(d, "downloading")
+                if len(urls) == 1:
+                    result = _download(bot, d, url, os.path.join(spooldir, "download"))
+                else:
+                    result = _download_batch(
+                        bot, d, job_id, urls, os.path.join(spooldir, "download")
+                    )
+                filename, path, size, digest, validator = result
+            d.expected_size = size
+            spool.reserve(job_id, _get_spool_need(bot, d), force=True)
+            db.set_job_file(job_id, filename, path, size, digest, validator)
+            job.update(
+                filename=filename,
+                path=path,
+                size=size,
+                method=None,
+                digest=digest,
+                validator=validator,
+            )
 
         if d.canceled.is_set():
             raise cancel_err
 
-        d.size = size
-        d.step += 1  # step == -1
-        with TemporaryDirectory() as tempdir:
-            with multivolumefile.open(
-                os.path.join(tempdir, filename + ".7z"),
-                "wb",
-                volume=int(_getdefault(bot, "part_size", DEF_PART_SIZE)),
-            ) as vol:
-                with py7zr.SevenZipFile(
-                    vol, "w", filters=[{"id": py7zr.FILTER_COPY}]
-                ) as a:
-                    a.writestr(data, filename)
-            del data
-            parts = sorted(os.listdir(tempdir))
-            urls = []
-            d.parts = len(parts)
+        cached = _get_cached(bot, "sha256:" + job["digest"])
+        if cached:
+            bot.logger.debug("Petition #%s content already uploaded", job_id)
+            metrics.inc("todus_cache_hits_total", kind="content")
+            txt = cached["parts"]
+        else:
+            if not job["method"]:
+                job.update(_plan_packing(bot, job))
+                db.set_job_packing(
+                    job_id, job["method"], job["part_count"], job["part_size"]
+                )
+            d.size = job["size"]
+            d.step += 1  # step == -1
+            _set_state(d, "archiving")
             d.step += 1  # step == 0
-            for i, name in enumerate(parts, 1):
-                time.sleep(delay)
-                if d.canceled.is_set():
-                    raise cancel_err
-                bot.logger.debug("Uploading %s/%s: %s", i, d.parts, url)
-                with open(os.path.join(tempdir, name), "rb") as file:
-                    part = file.read()
-                try:
-                    token = d.client.login(acc["phone"], acc["password"])
-                    d.step += 0.5
-                    urls.append(d.client.upload_file(token, part, len(part)))
-                except AbortError:
-                    raise cancel_err
-                except Exception as ex:
-                    bot.logger.exception(ex)
-                    time.sleep(delay)
-                    try:
-                        token = d.client.login(acc["phone"], acc["password"])
-                        if d.step.is_integer():
-                            d.step += 0.5
-                        urls.append(d.client.upload_file(token, part, len(part)))
-                    except AbortError:
-                        raise cancel_err
-                    except Exception as ex:
-                        bot.logger.exception(ex)
-                        raise ValueError(
-                            f"Fallo al subir parte {i} ({len(part):,}B): {ex}"
-                        )
-                d.step += 0.5
-        txt = "\n".join(f"{down_url}\t{name}" for down_url, name in zip(urls, parts))
-        replies = Replies(msg, logger=bot.logger)
-        replies.add(
-            text=f"{filename} **({size//1024:,}KB)**",
-            filename=filename.encode(encoding="ascii", errors="ignore").decode()
-            + ".txt",
-            bytefile=io.BytesIO(txt.encode()),
-            quote=msg,
-        )
-        replies.send_reply_messages()
+            with scheduler.stage("upload"):
+                parts = _upload(bot, d, acc, job, os.path.join(spooldir, "parts"))
+            txt = "\n".join("\t".join(parts[i]) for i in sorted(parts))
+        _set_state(d, "done")
+        metrics.inc("todus_jobs_total", result="done")
+        _add_cached(bot, [url_key, "sha256:" + job["digest"]], job, txt)
+        files = [(name, os.path.getsize(path)) for path, name in _get_files(job)]
+        _send_index(bot, msg, job["filename"], job["size"], txt, files)
     except Exception as ex:
         bot.logger.exception(ex)
+        _set_state(d, "failed")
+        cause = "canceled" if d.canceled.is_set() else type(ex).__name__
+        metrics.inc("todus_jobs_total", result="failed", cause=cause)
         replies = Replies(msg, logger=bot.logger)
         error_msg = "Archivo muy grande" if isinstance(ex, FileTooBig) else str(ex)
         replies.add(text=f"❌ La descarga falló. {error_msg}", quote=msg)
         replies.send_reply_messages()
     finally:
-        downloading.discard(d)
-        del petitions[addr]
+        metrics.observe("todus_stage_seconds", time.monotonic() - start, stage="job")
+        shutil.rmtree(spooldir, ignore_errors=True)
+        spool.release(job_id)
+        jobs.remove(job_id)
+
+
+def _send_index(
+    bot: DeltaBot,
+    msg: Message,
+    filename: str,
+    size: int,
+    txt: str,
+    files: Sequence[Tuple[str, int]] = (),
+) -> None:
+    replies = Replies(msg, logger=bot.logger)
+    _add_index(replies, msg, filename, size, txt, files)
+    replies.send_reply_messages()
+
+
+def _add_index(
+    replies: Replies,
+    quote: Message,
+    filename: str,
+    size: int,
+    txt: str,
+    files: Sequence[Tuple[str, int]] = (),
+) -> None:
+    text = f"{filename} **({size//1024:,}KB)**"
+    if len(files) > 1:
+        text += "".join(f"\n• {name} ({fsize//1024:,}KB)" for name, fsize in files)
+    replies.add(
+        text=text,
+        filename=filename.encode(encoding="ascii", errors="ignore").decode() + ".txt",
+        bytefile=io.BytesIO(txt.encode()),
+        quote=quote,
+    )
+
+
+def _get_cached(bot: DeltaBot, key: str) -> Optional[sqlite3.Row]:
+    now = time.time()
+    cache_ttl = float(_getdefault(bot, "cache_ttl", DEF_CACHE_TTL))
+    cached = db.get_cached(key, now - cache_ttl)
+    if cached:
+        db.touch_cached(key, now)
+    return cached
+
+
+def _revalidate_cached(bot: DeltaBot, key: str, url: str) -> Optional[sqlite3.Row]:
+    """Reuse an expired cache entry if the origin says the file didn't change."""
+    cached = db.get_cached(key, 0)
+    if not cached or not cached["validator"] or is_ytlink(url):
+        return None
+    validator = probe_url(url)[1]
+    if validator != cached["validator"]:
+        return None
+    now = time.time()
+    db.touch_cached(key, now, created=now)
+    return cached
+
+
+def _add_cached(bot: DeltaBot, keys: List[str], job: dict, txt: str) -> None:
+    now = time.time()
+    cache_ttl = float(_getdefault(bot, "cache_ttl", DEF_CACHE_TTL))
+    db.add_cached(keys, job["filename"], job["size"], txt, job["validator"], now)
+    db.evict_cached(
+        now - cache_ttl, int(_getdefault(bot, "cache_size", DEF_CACHE_SIZE))
+    )
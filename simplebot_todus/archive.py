@@ -0,0 +1,108 @@
+import io
+from typing import BinaryIO, Callable, Dict, Optional
+
+# the 7z signature header at the start of the first volume is rewritten
+# when the archive is closed, so that volume is published last
+HEADER_VOLUME = 1
+
+
+class VolumeWriter(io.RawIOBase):
+    """Seekable file object that splits its content in volumes of fixed size.
+
+    Every volume is handed to ``on_volume(index, path)`` as soon as it is
+    complete, so it can be uploaded while the rest of the archive is
+    still being written.
+    """
+
+    def __init__(
+        self,
+        basename: str,
+        volume_size: int,
+        on_volume: Callable[[int, str], None],
+        ext_digits: int = 4,
+    ) -> None:
+        super().__init__()
+        self.basename = basename
+        self.volume_size = volume_size
+        self.on_volume = on_volume
+        self.ext_digits = ext_digits
+        self.volumes = 0
+        self._pos = 0
+        self._size = 0
+        self._files: Dict[int, BinaryIO] = {}
+        self._current = 0
+
+    def get_path(self, index: int) -> str:
+        return "{}.{:0{}d}".format(self.basename, index, self.ext_digits)
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise ValueError(f"negative seek position {offset}")
+        self._pos = offset
+        return offset
+
+    def write(self, data) -> int:
+        view = memoryview(data).cast("B")
+        written = 0
+        while written < len(view):
+            index, offset = divmod(self._pos, self.volume_size)
+            index += 1
+            file = self._get_file(index)
+            file.seek(offset)
+            count = min(self.volume_size - offset, len(view) - written)
+            file.write(view[written : written + count])
+            written += count
+            self._pos += count
+            self._size = max(self._size, self._pos)
+        return written
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            for index in sorted(self._files):
+                self._publish(index)
+        finally:
+            super().close()
+
+    def discard(self) -> None:
+        """Close the writer without publishing the pending volumes."""
+        for file in self._files.values():
+            file.close()
+        self._files.clear()
+        super().close()
+
+    def _get_file(self, index: int) -> BinaryIO:
+        file = self._files.get(index)
+        if file is not None:
+            return file
+        if index <= self._current:
+            raise io.UnsupportedOperation(
+                f"volume {index} was already published, can't write to it"
+            )
+        if self._current and self._current != HEADER_VOLUME:
+            self._publish(self._current)
+        self._current = index
+        self.volumes = max(self.volumes, index)
+        file = self._files[index] = open(self.get_path(index), "w+b")
+        return file
+
+    def _publish(self, index: int) -> None:
+        file: Optional[BinaryIO] = self._files.pop(index, None)
+        if file is None:
+            return
+        file.close()
+        self.on_volume(index, self.get_path(index))
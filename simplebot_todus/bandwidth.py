@@ -0,0 +1,135 @@
+import time
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+# never give a transfer less than this, bytes/second
+MIN_RATE = 16 * 1024
+
+
+class TokenBucket:
+    """Limit a transfer to ``rate`` bytes/second, 0 means no limit.
+
+    Up to ``burst`` seconds worth of unused bytes can be sent at once.
+    """
+
+    def __init__(self, rate: float = 0, burst: float = 1) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = 0.0
+        self._last = time.monotonic()
+        self._lock = Lock()
+
+    def consume(self, count: int) -> float:
+        """Take ``count`` bytes, return the seconds to wait before sending them."""
+        with self._lock:
+            now = time.monotonic()
+            rate = self.rate
+            if rate <= 0:
+                self._tokens = 0.0
+                self._last = now
+                return 0
+            self._tokens = min(
+                self._tokens + (now - self._last) * rate, rate * self.burst
+            )
+            self._last = now
+            self._tokens -= count
+            return -self._tokens / rate if self._tokens < 0 else 0
+
+    def throttle(self, count: int) -> None:
+        wait = self.consume(count)
+        if wait > 0:
+            time.sleep(wait)
+
+
+def allocate(
+    budget: float, weights: Dict[int, float], demands: Dict[int, float]
+) -> Dict[int, float]:
+    """Split the budget in proportion to the weights, max-min fair.
+
+    Keys that need less than their share get what they need and what is
+    left is split between the others.
+    """
+    shares: Dict[int, float] = {}
+    pending = dict(weights)
+    while pending:
+        total = sum(pending.values())
+        capped = [
+            key
+            for key, weight in pending.items()
+            if demands.get(key, float("inf")) < budget * weight / total
+        ]
+        if not capped:
+            for key, weight in pending.items():
+                shares[key] = max(budget * weight / total, MIN_RATE)
+            break
+        for key in capped:
+            shares[key] = max(demands[key], MIN_RATE)
+            budget -= demands[key]
+            del pending[key]
+    return shares
+
+
+class BandwidthManager:
+    """Budget of bytes/second shared by the transfers of one direction.
+
+    ``limit`` is the configured budget, 0 means no limit. When the server
+    throttles us, ``backoff()`` lowers the budget below the measured
+    speed, and ``recover()`` raises it again little by little while the
+    transfers succeed, so the link is used as much as the server allows.
+    """
+
+    def __init__(self, limit: float = 0) -> None:
+        self.limit = limit
+        self.ceiling: Optional[float] = None
+        self._lock = Lock()
+
+    def get_budget(self) -> float:
+        """Return the current budget, 0 if there is no limit."""
+        with self._lock:
+            if self.ceiling is None:
+                return self.limit
+            if self.limit:
+                return min(self.limit, self.ceiling)
+            return self.ceiling
+
+    def backoff(self, speed: float) -> None:
+        """The server throttled us while sending at ``speed`` bytes/second."""
+        with self._lock:
+            current = self.ceiling or self.limit or speed
+            if speed:
+                current = min(current, speed)
+            self.ceiling = max(current * 0.7, MIN_RATE)
+
+    def recover(self, speed: float) -> None:
+        """A transfer succeeded while sending at ``speed`` bytes/second."""
+        with self._lock:
+            if self.ceiling is None:
+                return
+            self.ceiling *= 1.1
+            # the ceiling no longer limits anything
+            if (self.limit and self.ceiling >= self.limit) or (
+                not self.limit and speed and self.ceiling > 2 * speed
+            ):
+                self.ceiling = None
+
+    def split(
+        self, transfers: Dict[int, Tuple[float, float, float]]
+    ) -> Dict[int, float]:
+        """Return the rate of each transfer, 0 means no limit.
+
+        ``transfers`` maps every active transfer to its weight, its
+        measured speed and its current rate. A transfer that is slower
+        than its rate is limited by something else (e.g. a slow origin),
+        it only gets a bit more than its speed so it can grow and the
+        rest of its share goes to the others.
+        """
+        budget = self.get_budget()
+        if not budget:
+            return {key: 0.0 for key in transfers}
+        weights = {key: weight for key, (weight, _, _) in transfers.items()}
+        demands = {
+            key: speed * 1.25 + MIN_RATE
+            for key, (_, speed, rate) in transfers.items()
+            if rate and speed < rate * 0.9
+        }
+        return allocate(budget, weights, demands)
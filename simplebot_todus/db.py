@@ -1,11 +1,25 @@
 import sqlite3
+from collections import OrderedDict
+from threading import Lock, local
 from typing import List, Optional
 
 
 class DBManager:
-    def __init__(self, db_path: str) -> None:
-        self.db = sqlite3.connect(db_path, check_same_thread=False)
-        self.db.row_factory = sqlite3.Row
+    """Plugin database, safe to use from any thread.
+
+    Every thread gets its own connection, the database is in WAL mode
+    so readers don't block the writer, and accounts are kept in a LRU
+    cache of ``cache_size`` entries.
+    """
+
+    def __init__(self, db_path: str, cache_size: int = 1024) -> None:
+        self.db_path = db_path
+        self.cache_size = cache_size
+        self._local = local()
+        self._accounts: "OrderedDict[str, Optional[sqlite3.Row]]" = OrderedDict()
+        self._accounts_lock = Lock()
+        self._accounts_version = 0
+        self.db.execute("PRAGMA journal_mode=WAL")
         with self.db:
             self.db.execute(
                 """CREATE TABLE IF NOT EXISTS accounts
@@ -13,24 +27,208 @@ class DBManager:
                 phone TEXT NOT NULL,
                 password TEXT)"""
             )
+            self.db.execute(
+                """CREATE TABLE IF NOT EXISTS jobs
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                addr TEXT NOT NULL,
+                url TEXT NOT NULL,
+                msg_id INTEGER NOT NULL,
+                state TEXT NOT NULL,
+                filename TEXT,
+                path TEXT,
+                size INTEGER,
+                method TEXT,
+                part_count INTEGER,
+                part_size INTEGER,
+                digest TEXT,
+                validator TEXT)"""
+            )
+            self.db.execute(
+                """CREATE TABLE IF NOT EXISTS parts
+                (job_id INTEGER NOT NULL,
+                number INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                url TEXT NOT NULL,
+                md5 TEXT,
+                PRIMARY KEY(job_id, number))"""
+            )
+            self.db.execute(
+                """CREATE TABLE IF NOT EXISTS cache
+                (key TEXT PRIMARY KEY,
+                filename TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                parts TEXT NOT NULL,
+                validator TEXT,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL)"""
+            )
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        """The connection of the current thread."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
 
     def add_account(self, addr: str, phone: str, password: str = None) -> None:
+        try:
+            with self.db:
+                self.db.execute(
+                    "INSERT INTO accounts VALUES (?,?,?)",
+                    (addr, phone, password or ""),
+                )
+        finally:
+            self._forget_account(addr)
+
+    def get_account(self, addr: str) -> Optional[sqlite3.Row]:
+        with self._accounts_lock:
+            if addr in self._accounts:
+                self._accounts.move_to_end(addr)
+                return self._accounts[addr]
+            version = self._accounts_version
+        acc = self.db.execute("SELECT * FROM accounts WHERE addr=?", (addr,)).fetchone()
+        with self._accounts_lock:
+            # don't cache the result if the account changed meanwhile
+            if version == self._accounts_version:
+                self._accounts[addr] = acc
+                if len(self._accounts) > self.cache_size:
+                    self._accounts.popitem(last=False)
+        return acc
+
+    def set_password(self, addr: str, password: str) -> None:
+        try:
+            with self.db:
+                self.db.execute(
+                    "UPDATE accounts SET password=? WHERE addr=?", (password, addr)
+                )
+        finally:
+            self._forget_account(addr)
+
+    def delete_account(self, addr) -> None:
+        try:
+            with self.db:
+                self.db.execute("DELETE FROM accounts WHERE addr=?", (addr,))
+        finally:
+            self._forget_account(addr)
+
+    def _forget_account(self, addr: str) -> None:
+        with self._accounts_lock:
+            self._accounts.pop(addr, None)
+            self._accounts_version += 1
+
+    def add_job(self, addr: str, url: str, msg_id: int) -> int:
+        with self.db:
+            return self.db.execute(
+                "INSERT INTO jobs (addr, url, msg_id, state) VALUES (?,?,?,?)",
+                (addr, url, msg_id, "queued"),
+            ).lastrowid
+
+    def get_job(self, job_id: int) -> Optional[sqlite3.Row]:
+        return self.db.execute("SELECT * FROM jobs WHERE id=?", (job_id,)).fetchone()
+
+    def get_jobs(self, states: List[str]) -> List[sqlite3.Row]:
+        return self.db.execute(
+            f"SELECT * FROM jobs WHERE state IN ({','.join('?' * len(states))})"
+            " ORDER BY id",
+            states,
+        ).fetchall()
+
+    def set_job_state(self, job_id: int, state: str) -> None:
+        with self.db:
+            self.db.execute("UPDATE jobs SET state=? WHERE id=?", (state, job_id))
+
+    def set_job_file(
+        self,
+        job_id: int,
+        filename: str,
+        path: str,
+        size: int,
+        digest: str,
+        validator: Optional[str],
+    ) -> None:
         with self.db:
             self.db.execute(
-                "INSERT INTO accounts VALUES (?,?,?)", (addr, phone, password or "")
+                "UPDATE jobs SET filename=?, path=?, size=?, digest=?, validator=?"
+                " WHERE id=?",
+                (filename, path, size, digest, validator, job_id),
             )
 
-    def get_account(self, addr: str) -> Optional[sqlite3.Row]:
+    def set_job_packing(
+        self, job_id: int, method: str, part_count: int, part_size: int
+    ) -> None:
+        with self.db:
+            self.db.execute(
+                "UPDATE jobs SET method=?, part_count=?, part_size=? WHERE id=?",
+                (method, part_count, part_size, job_id),
+            )
+
+    def delete_jobs(self, states: List[str]) -> None:
+        with self.db:
+            query = (
+                f"SELECT id FROM jobs WHERE state IN ({','.join('?' * len(states))})"
+            )
+            self.db.execute(f"DELETE FROM parts WHERE job_id IN ({query})", states)
+            self.db.execute(
+                f"DELETE FROM jobs WHERE state IN ({','.join('?' * len(states))})",
+                states,
+            )
+
+    def add_part(self, job_id: int, number: int, name: str, url: str, md5: str) -> None:
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO parts VALUES (?,?,?,?,?)",
+                (job_id, number, name, url, md5),
+            )
+
+    def get_parts(self, job_id: int) -> List[sqlite3.Row]:
+        return self.db.execute(
+            "SELECT * FROM parts WHERE job_id=? ORDER BY number", (job_id,)
+        ).fetchall()
+
+    def get_cached(self, key: str, min_created: float) -> Optional[sqlite3.Row]:
         return self.db.execute(
-            "SELECT * FROM accounts WHERE addr=?", (addr,)
+            "SELECT * FROM cache WHERE key=? AND created>=?", (key, min_created)
         ).fetchone()
 
-    def set_password(self, addr: str, password: str) -> None:
+    def add_cached(
+        self,
+        keys: List[str],
+        filename: str,
+        size: int,
+        parts: str,
+        validator: Optional[str],
+        created: float,
+    ) -> None:
         with self.db:
-            self.db.execute(
-                "UPDATE accounts SET password=? WHERE addr=?", (password, addr)
+            self.db.executemany(
+                "INSERT OR REPLACE INTO cache VALUES (?,?,?,?,?,?,?)",
+                [
+                    (key, filename, size, parts, validator, created, created)
+                    for key in keys
+                ],
             )
 
-    def delete_account(self, addr) -> None:
+    def touch_cached(self, key: str, last_used: float, created: float = None) -> None:
+        with self.db:
+            if created is None:
+                self.db.execute(
+                    "UPDATE cache SET last_used=? WHERE key=?", (last_used, key)
+                )
+            else:
+                self.db.execute(
+                    "UPDATE cache SET last_used=?, created=? WHERE key=?",
+                    (last_used, created, key),
+                )
+
+    def evict_cached(self, min_created: float, max_entries: int) -> None:
         with self.db:
-            self.db.execute("DELETE FROM accounts WHERE addr=?", (addr,))
+            self.db.execute("DELETE FROM cache WHERE created<?", (min_created,))
+            self.db.execute(
+                "DELETE FROM cache WHERE key NOT IN"
+                " (SELECT key FROM cache ORDER BY last_used DESC LIMIT ?)",
+                (max_entries,),
+            )
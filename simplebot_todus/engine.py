@@ -0,0 +1,54 @@
+import asyncio
+import concurrent.futures
+from threading import Thread
+from typing import Any, Awaitable, Callable
+
+
+class Engine:
+    """Event loop running in its own thread that does all the ToDus I/O.
+
+    Coroutines are submitted from any thread with ``submit()``. The ToDus
+    client and the database are blocking, so their calls run with ``run()``
+    in a fixed pool of ``io_threads`` threads; a petition waiting for its turn to upload or
+    for a retry is just a suspended coroutine, and the number of threads
+    doesn't grow with the traffic.
+    """
+
+    def __init__(self, io_threads: int) -> None:
+        self.loop = asyncio.new_event_loop()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=io_threads, thread_name_prefix="todus-io"
+        )
+        self.loop.set_default_executor(self._executor)
+        self._thread = Thread(target=self._run, name="todus-engine", daemon=True)
+        self._thread.start()
+
+    def submit(self, coro: Awaitable) -> concurrent.futures.Future:
+        """Schedule a coroutine in the event loop, thread-safe.
+
+        Cancelling the returned future cancels the coroutine.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def run(self, func: Callable, *args) -> Any:
+        """Run a blocking function in the I/O threads and wait for its result.
+
+        Blocking calls can't be interrupted, if the coroutine is cancelled
+        the cancellation waits until the call returns, so the arguments
+        (like memory maps) aren't released while still in use.
+        """
+        fut = self.loop.run_in_executor(self._executor, func, *args)
+        try:
+            return await asyncio.shield(fut)
+        except asyncio.CancelledError:
+            await asyncio.wait([fut])
+            raise
+
+    def stop(self) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self._executor.shutdown(wait=False)
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
@@ -1,2 +1,14 @@
 class FileTooBig(Exception):
     pass
+
+
+class TaskAborted(Exception):
+    pass
+
+
+class CorruptUpload(Exception):
+    pass
+
+
+class RangeIgnored(IOError):
+    pass
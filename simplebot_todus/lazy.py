@@ -0,0 +1,54 @@
+import importlib
+import logging
+import sys
+import time
+from threading import Thread
+from types import ModuleType
+from typing import Dict, Iterable, Optional
+
+# dependencies that are slow to import and only needed by some petitions
+HEAVY_MODULES = ("todus.client", "py7zr", "youtube_dl")
+_costs: Dict[str, float] = {}
+
+
+def load(name: str) -> ModuleType:
+    """Import a module the first time it is needed and record how long it took."""
+    # always go through the import system, if another thread is importing
+    # the module it waits until the module is fully initialized
+    loaded = name in sys.modules
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    if not loaded:
+        _costs.setdefault(name, time.perf_counter() - start)
+    return module
+
+
+def warm_up(
+    names: Iterable[str] = HEAVY_MODULES, logger: Optional[logging.Logger] = None
+) -> Thread:
+    """Import the given modules in a background thread."""
+    logger = logger or logging.getLogger(__name__)
+
+    def run() -> None:
+        for name in names:
+            try:
+                load(name)
+            except Exception as ex:  # noqa
+                logger.warning("Failed to preload %s: %r", name, ex)
+        logger.debug("Preloaded modules: %s", get_costs())
+
+    thread = Thread(target=run, name="todus-warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+def get_costs() -> Dict[str, Optional[float]]:
+    """Seconds it took to import each heavy module, None if not loaded yet.
+
+    Modules imported by someone else before ``load()`` was called are
+    reported with a cost of zero.
+    """
+    return {
+        name: _costs.get(name, 0.0) if name in sys.modules else None
+        for name in HEAVY_MODULES
+    }
@@ -0,0 +1,156 @@
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
+from typing import Callable, Dict, Iterator, List, Tuple
+
+DURATION_BUCKETS = (0.1, 0.5, 1, 5, 15, 60, 300, 900, 3600, float("inf"))
+_Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+# http.server.ThreadingHTTPServer is only available since Python 3.7
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Histogram:
+    def __init__(self, buckets: Tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class Metrics:
+    """Counters, gauges and histograms in the Prometheus text format."""
+
+    def __init__(self) -> None:
+        self._counters: Dict[_Key, float] = {}
+        self._histograms: Dict[_Key, _Histogram] = {}
+        self._gauges: Dict[str, Callable[[], float]] = {}
+        self._help: Dict[str, str] = {}
+        self._lock = Lock()
+
+    def describe(self, name: str, text: str) -> None:
+        self._help[name] = text
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(DURATION_BUCKETS)
+            histogram.observe(value)
+
+    def gauge(self, name: str, func: Callable[[], float]) -> None:
+        """Register a gauge whose value is read when the metrics are rendered."""
+        self._gauges[name] = func
+
+    @contextmanager
+    def timer(self, name: str, **labels: str) -> Iterator[None]:
+        """Observe the time the block takes, in seconds."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda i: i[0])
+            histograms = [
+                (key, h.buckets, list(h.counts), h.count, h.sum)
+                for key, h in histograms
+            ]
+        done = set()
+        for (name, labels), value in counters:
+            self._render_header(lines, name, "counter", done)
+            lines.append(f"{name}{_labels(labels)} {value:g}")
+        for (name, labels), buckets, counts, count, total in histograms:
+            self._render_header(lines, name, "histogram", done)
+            for bound, bucket_count in zip(buckets, counts):
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lbls = _labels(labels + (("le", le),))
+                lines.append(f"{name}_bucket{lbls} {bucket_count}")
+            lines.append(f"{name}_sum{_labels(labels)} {total:g}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+        for name, func in sorted(self._gauges.items()):
+            self._render_header(lines, name, "gauge", done)
+            lines.append(f"{name} {func():g}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """Human readable summary of the collected metrics."""
+        lines: List[str] = []
+        with self._lock:
+            for (name, labels), h in sorted(
+                self._histograms.items(), key=lambda i: i[0]
+            ):
+                avg = h.sum / h.count if h.count else 0
+                lines.append(
+                    f"{name}{_labels(labels)}: {h.count} (avg {avg:.1f}s,"
+                    f" max {h.max:.1f}s)"
+                )
+            for (name, labels), value in sorted(self._counters.items()):
+                lines.append(f"{name}{_labels(labels)}: {value:,g}")
+        for name, func in sorted(self._gauges.items()):
+            lines.append(f"{name}: {func():g}")
+        return "\n".join(lines)
+
+    def _render_header(self, lines: list, name: str, kind: str, done: set) -> None:
+        if name in done:
+            return
+        done.add(name)
+        if name in self._help:
+            lines.append(f"# HELP {name} {self._help[name]}")
+        lines.append(f"# TYPE {name} {kind}")
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    text = ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in labels
+    )
+    return "{" + text + "}"
+
+
+def serve(metrics: Metrics, port: int, host: str = "127.0.0.1") -> HTTPServer:
+    """Expose the metrics at http://host:port/metrics in a background thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:  # noqa
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args) -> None:  # noqa
+            pass
+
+    server = _ThreadingHTTPServer((host, port), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,180 @@
+import mimetypes
+import os
+import zlib
+from typing import List, Tuple
+
+from . import lazy
+
+DIRECT = "direct"
+COPY = "copy"
+COMPRESS = "compress"
+
+# compress only if the probe saves at least this fraction of the size
+MIN_SAVING = 0.1
+PROBE_SAMPLES = 8
+PROBE_SAMPLE_SIZE = 128 * 1024
+# LZMA2 compresses better than the zlib probe, but leave some margin
+ESTIMATE_MARGIN = 1.05
+# 7z headers, plus some slack so the archive doesn't spill into a tiny volume
+ARCHIVE_OVERHEAD = 64 * 1024
+MIN_PART_SIZE = 1024 * 1024
+INITIAL_THROUGHPUT = 100 * 1024
+
+_SIGNATURES = (
+    (0, b"PK\x03\x04"),  # zip, docx, apk, jar...
+    (0, b"7z\xbc\xaf\x27\x1c"),
+    (0, b"Rar!\x1a\x07"),
+    (0, b"\x1f\x8b"),  # gzip
+    (0, b"BZh"),
+    (0, b"\xfd7zXZ\x00"),
+    (0, b"\x28\xb5\x2f\xfd"),  # zstd
+    (0, b"\x89PNG"),
+    (0, b"\xff\xd8\xff"),  # jpeg
+    (0, b"GIF8"),
+    (0, b"RIFF"),  # webp, avi
+    (0, b"\x1a\x45\xdf\xa3"),  # mkv, webm
+    (0, b"OggS"),
+    (0, b"ID3"),  # mp3
+    (0, b"fLaC"),
+    (4, b"ftyp"),  # mp4, m4a, 3gp, heic
+)
+_COMPRESSED_TYPES = (
+    "video/",
+    "audio/",
+    "image/jpeg",
+    "image/png",
+    "image/gif",
+    "image/webp",
+    "application/zip",
+    "application/gzip",
+    "application/x-7z-compressed",
+    "application/x-rar-compressed",
+    "application/vnd.rar",
+    "application/x-bzip2",
+    "application/x-xz",
+    "application/vnd.android.package-archive",
+    "application/epub+zip",
+    "application/java-archive",
+)
+
+
+def get_filters(method: str) -> List[dict]:
+    """Return the py7zr filters of the given packing method."""
+    py7zr = lazy.load("py7zr")
+    filters = {
+        COPY: [{"id": py7zr.FILTER_COPY}],
+        COMPRESS: [{"id": py7zr.FILTER_LZMA2, "preset": 1}],
+    }
+    return filters[method]
+
+
+def is_compressed(path: str, filename: str) -> bool:
+    """Guess from the MIME type and the file signature if the file is compressed."""
+    mimetype = mimetypes.guess_type(filename)[0] or ""
+    if mimetype.startswith(_COMPRESSED_TYPES) and mimetype != "audio/x-wav":
+        return True
+    with open(path, "rb") as file:
+        head = file.read(16)
+    return any(head[offset:].startswith(sig) for offset, sig in _SIGNATURES)
+
+
+def probe_ratio(path: str, size: int) -> float:
+    """Estimate the compression ratio of the file compressing a few samples of it."""
+    if not size:
+        return 1.0
+    sample_size = min(PROBE_SAMPLE_SIZE, size)
+    samples = min(PROBE_SAMPLES, -(-size // sample_size))
+    step = (size - sample_size) // max(samples - 1, 1)
+    raw = compressed = 0
+    with open(path, "rb") as file:
+        for i in range(samples):
+            file.seek(i * step)
+            data = file.read(sample_size)
+            raw += len(data)
+            compressed += len(zlib.compress(data, 1))
+    return min(compressed / raw, 1.0) if raw else 1.0
+
+
+def choose_method(files: List[Tuple[str, str]]) -> Tuple[str, float]:
+    """Pick if the files should be compressed, return the method and estimated ratio.
+
+    ``files`` is a list of ``(path, name)`` tuples.
+    """
+    total = packed = 0.0
+    for path, name in files:
+        size = os.path.getsize(path)
+        ratio = 1.0 if is_compressed(path, name) else probe_ratio(path, size)
+        total += size
+        packed += size * ratio
+    ratio = packed / total if total else 1.0
+    if ratio <= 1 - MIN_SAVING:
+        return COMPRESS, min(ratio * ESTIMATE_MARGIN, 1.0)
+    return COPY, 1.0
+
+
+def plan_packing(
+    files: List[Tuple[str, str]],
+    max_part_size: int,
+    max_uploads: int,
+    upload_delay: float,
+    throughput: float,
+) -> Tuple[str, int, int]:
+    """Return the packing method, the estimated part count and the part size.
+
+    A single file that is not worth compressing and is uploaded faster
+    in a single part is uploaded as it is, without 7z. Empty files are
+    always packed, an empty part can't be uploaded.
+    """
+    size = sum(os.path.getsize(path) for path, _ in files)
+    method, ratio = choose_method(files)
+    if method == COPY and len(files) == 1 and 0 < size <= max_part_size:
+        count, part_size = plan_parts(
+            size, max_part_size, max_uploads, upload_delay, throughput
+        )
+        if count == 1:
+            return DIRECT, 1, size
+    packed = int(size * ratio) + ARCHIVE_OVERHEAD
+    count, part_size = plan_parts(
+        packed, max_part_size, max_uploads, upload_delay, throughput
+    )
+    return method, count, part_size
+
+
+def plan_parts(
+    size: int,
+    max_part_size: int,
+    max_uploads: int,
+    upload_delay: float,
+    throughput: float,
+) -> Tuple[int, int]:
+    """Return the part count and size that minimize the estimated upload time.
+
+    Parts are uploaded ``max_uploads`` at a time, starting one every
+    ``upload_delay`` seconds, each at ``throughput`` bytes/second, so
+    more parts upload in parallel but wait longer to start.
+    """
+    min_parts = max(-(-size // max_part_size), 1)
+    max_parts = max(min_parts, min(min_parts * max_uploads, size // MIN_PART_SIZE))
+    best = (float("inf"), min_parts)
+    for count in range(min_parts, max_parts + 1):
+        part_size = -(-size // count)
+        duration = part_size / throughput
+        ends = [0.0] * max_uploads
+        for i in range(count):
+            slot = min(range(max_uploads), key=ends.__getitem__)
+            ends[slot] = max(ends[slot], i * upload_delay) + duration
+        best = min(best, (max(ends), count))
+    count = best[1]
+    return count, -(-size // count)
+
+
+class ThroughputEstimator:
+    """Moving average of the upload speed of a single part, in bytes/second."""
+
+    def __init__(self, initial: float, alpha: float = 0.2) -> None:
+        self.value = initial
+        self.alpha = alpha
+
+    def update(self, size: int, seconds: float) -> None:
+        if seconds > 0 and size >= MIN_PART_SIZE:
+            self.value += self.alpha * (size / seconds - self.value)
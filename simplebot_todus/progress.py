@@ -0,0 +1,145 @@
+import hashlib
+import io
+import time
+from collections import deque
+from threading import Lock
+from typing import Callable, Deque, Optional, Tuple
+
+from .bandwidth import TokenBucket
+
+# shared counters of the current worker process: bytes done, total and
+# rate limit
+_counters = None
+_lock = Lock()
+_bucket = TokenBucket()
+
+
+def set_counters(counters) -> None:
+    """Set the shared array where the worker process reports its progress."""
+    global _counters
+    _counters = counters
+
+
+def add_bytes(count: int) -> None:
+    if _counters is not None:
+        with _lock:
+            _counters[0] += count
+        _throttle(count)
+
+
+def set_bytes(done: int, total: Optional[int] = None) -> None:
+    if _counters is not None:
+        with _lock:
+            count = done - _counters[0]
+            _counters[0] = done
+            if total is not None:
+                _counters[1] = total
+        _throttle(count)
+
+
+def _throttle(count: int) -> None:
+    """Wait as needed to keep the task under its rate limit."""
+    if count > 0:
+        _bucket.rate = _counters[2]
+        _bucket.throttle(count)
+
+
+def set_total(total: int) -> None:
+    if _counters is not None:
+        _counters[1] = total
+
+
+class Rate:
+    """Transfer speed over the last ``window`` seconds, fed with byte counts."""
+
+    def __init__(self, window: float = 30) -> None:
+        self.window = window
+        self.start = time.monotonic()
+        self.done = 0
+        self.total: Optional[int] = None
+        self._samples: Deque[Tuple[float, int]] = deque()
+        self._lock = Lock()
+
+    def update(self, done: int, total: Optional[int] = None) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self.done = done
+            if total is not None and total >= 0:
+                self.total = total
+            self._samples.append((now, done))
+            while len(self._samples) > 2 and self._samples[1][0] < now - self.window:
+                self._samples.popleft()
+
+    def get_speed(self) -> float:
+        """Bytes per second."""
+        with self._lock:
+            now = time.monotonic()
+            if len(self._samples) >= 2:
+                (start, first), (end, last) = self._samples[0], self._samples[-1]
+                if end - start >= 1:
+                    return (last - first) / (end - start)
+            elapsed = now - self.start
+            return self.done / elapsed if elapsed >= 1 else 0.0
+
+    def get_eta(self) -> Optional[float]:
+        """Seconds left, or None if the total size or the speed are unknown."""
+        speed = self.get_speed()
+        if not self.total or not speed:
+            return None
+        return max(self.total - self.done, 0) / speed
+
+
+class CountingReader:
+    """Read-only file object over a buffer that reports the bytes read so far.
+
+    The MD5 of the buffer is computed while it is read, see ``get_md5()``.
+    """
+
+    def __init__(
+        self,
+        data,
+        on_read: Callable[[int], None],
+        bucket: Optional[TokenBucket] = None,
+    ) -> None:
+        self._data = data
+        self._pos = 0
+        self._on_read = on_read
+        self._bucket = bucket
+        self._md5 = hashlib.md5()
+        self._hashed = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._data)
+        self._pos = min(max(offset, 0), len(self._data))
+        return self._pos
+
+    def read(self, size: int = -1) -> bytes:
+        end = len(self._data)
+        if size is not None and size >= 0:
+            end = min(self._pos + size, end)
+        chunk = self._data[self._pos : end]
+        if self._pos == self._hashed:
+            self._md5.update(chunk)
+            self._hashed = end
+        self._pos = end
+        self._on_read(end)
+        if self._bucket is not None:
+            self._bucket.throttle(len(chunk))
+        return chunk
+
+    def get_md5(self) -> str:
+        """Return the MD5 of the whole buffer."""
+        if self._hashed < len(self._data):
+            # the buffer wasn't read sequentially to the end
+            self._md5 = hashlib.md5(self._data)
+            self._hashed = len(self._data)
+        return self._md5.hexdigest()
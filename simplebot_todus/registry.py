@@ -0,0 +1,90 @@
+from threading import Lock
+from typing import Any, Dict, Iterable, List, Optional
+
+# a job is any object with ``job_id``, ``addr`` and ``state`` attributes
+J = Any
+
+
+class JobRegistry:
+    """Thread-safe index of the active petitions.
+
+    Jobs are found by ID, by account address or by state in constant
+    time, every change happens under a single lock so readers always see
+    a consistent view, and listing methods return snapshots that are
+    safe to iterate while other threads modify the registry.
+    """
+
+    def __init__(self) -> None:
+        self._jobs: Dict[int, J] = {}
+        self._by_addr: Dict[str, Dict[int, J]] = {}
+        self._by_state: Dict[str, Dict[int, J]] = {}
+        self._lock = Lock()
+
+    def add(self, job: J) -> None:
+        with self._lock:
+            if job.job_id in self._jobs:
+                raise ValueError(f"job #{job.job_id} already registered")
+            self._jobs[job.job_id] = job
+            self._by_addr.setdefault(job.addr, {})[job.job_id] = job
+            self._by_state.setdefault(job.state, {})[job.job_id] = job
+
+    def remove(self, job_id: int) -> Optional[J]:
+        with self._lock:
+            job = self._jobs.pop(job_id, None)
+            if job is not None:
+                self._discard(self._by_addr, job.addr, job_id)
+                self._discard(self._by_state, job.state, job_id)
+            return job
+
+    def get(self, job_id: int) -> Optional[J]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def get_by_addr(self, addr: str) -> List[J]:
+        """Return the jobs of the given account, oldest first."""
+        with self._lock:
+            return sorted(self._by_addr.get(addr, {}).values(), key=_get_id)
+
+    def has_jobs(self, addr: str) -> bool:
+        with self._lock:
+            return addr in self._by_addr
+
+    def get_by_state(self, *states: str) -> List[J]:
+        with self._lock:
+            jobs = [j for s in states for j in self._by_state.get(s, {}).values()]
+        return sorted(jobs, key=_get_id)
+
+    def snapshot(self) -> List[J]:
+        """Return all the jobs, oldest first."""
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return sorted(jobs, key=_get_id)
+
+    def set_state(
+        self, job_id: int, state: str, expected: Optional[Iterable[str]] = None
+    ) -> bool:
+        """Move a job to a new state.
+
+        If ``expected`` is given the job only changes if it is in one of
+        those states. Return False if the job wasn't changed.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or (expected is not None and job.state not in expected):
+                return False
+            self._discard(self._by_state, job.state, job_id)
+            job.state = state
+            self._by_state.setdefault(state, {})[job_id] = job
+            return True
+
+    @staticmethod
+    def _discard(index: Dict[str, Dict[int, J]], key: str, job_id: int) -> None:
+        jobs = index.get(key)
+        if jobs is not None:
+            jobs.pop(job_id, None)
+            if not jobs:
+                del index[key]
+
+
+def _get_id(job: J) -> int:
+    return job.job_id
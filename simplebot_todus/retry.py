@@ -0,0 +1,165 @@
+import asyncio
+import random
+import time
+from threading import Lock
+from typing import Awaitable, Callable, Optional, TypeVar
+
+import requests
+from todus.errors import AbortError
+
+from .errors import CorruptUpload
+
+AUTH = "auth"
+TRANSIENT = "transient"
+THROTTLE = "throttle"
+CORRUPT = "corrupt"
+FATAL = "fatal"
+
+T = TypeVar("T")
+
+
+def classify(ex: Exception) -> str:
+    """Tell if a failed ToDus request is worth retrying and how."""
+    if isinstance(ex, AbortError):
+        return FATAL
+    if isinstance(ex, requests.HTTPError) and ex.response is not None:
+        status = ex.response.status_code
+        if status in (401, 403):
+            return AUTH
+        if status in (429, 503):
+            return THROTTLE
+        if status == 408 or status >= 500:
+            return TRANSIENT
+        return FATAL
+    if isinstance(ex, CorruptUpload):
+        return CORRUPT
+    if isinstance(ex, (requests.ConnectionError, requests.Timeout)):
+        return TRANSIENT
+    # invalid URLs, too many redirects...
+    if isinstance(ex, requests.RequestException):
+        return FATAL
+    # socket errors of the ToDus connection, not errors of local files
+    if isinstance(ex, OSError) and not isinstance(
+        ex, (FileNotFoundError, PermissionError)
+    ):
+        return TRANSIENT
+    # bugs and unexpected answers, retrying won't help
+    return FATAL
+
+
+def get_retry_after(ex: Exception) -> Optional[float]:
+    response = getattr(ex, "response", None)
+    if response is None:
+        return None
+    try:
+        return max(float(response.headers["retry-after"]), 0)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """Stop calling ToDus for a while when it is failing for everybody.
+
+    After ``threshold`` consecutive failures the circuit opens for
+    ``cooldown`` seconds, then a single failure is enough to open it
+    again until a request succeeds.
+    """
+
+    def __init__(self, threshold: int, cooldown: float) -> None:
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._open_until = 0.0
+        self._lock = Lock()
+
+    def is_open(self) -> bool:
+        return self.get_wait() > 0
+
+    def get_wait(self) -> float:
+        """Seconds until requests are allowed again."""
+        with self._lock:
+            return max(self._open_until - time.monotonic(), 0)
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.threshold:
+                self._open_until = time.monotonic() + self.cooldown
+                self._failures = self.threshold - 1
+
+
+class RetryPolicy:
+    """Retry failed ToDus requests with exponential backoff and jitter.
+
+    A call is tried at most ``attempts`` times. Authentication errors
+    are only retried if the caller can fix them (e.g. logging in again),
+    throttling honors the server's ``Retry-After`` and only transient and
+    throttling errors count towards the shared circuit breaker, a corrupt
+    upload is retried but doesn't mean ToDus is failing.
+    """
+
+    def __init__(
+        self,
+        attempts: int,
+        base_delay: float,
+        max_delay: float,
+        breaker: CircuitBreaker,
+    ) -> None:
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker
+        self._random = random.Random()
+
+    def get_delay(self, attempt: int, kind: str, ex: Exception) -> float:
+        """Seconds to wait before the next attempt, ``attempt`` starts at 1."""
+        if kind == AUTH:
+            return 0
+        if kind == THROTTLE:
+            retry_after = get_retry_after(ex)
+            if retry_after is not None:
+                return min(retry_after, self.max_delay) + self._random.uniform(0, 1)
+            attempt += 2
+        backoff = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return self._random.uniform(backoff / 2, backoff)
+
+    async def call(
+        self,
+        func: Callable[[], Awaitable[T]],
+        retry_auth: bool = False,
+        classify: Callable[[Exception], str] = classify,
+        on_retry: Optional[Callable[[Exception, str, float], None]] = None,
+    ) -> T:
+        """Await ``func()`` until it succeeds or the attempts run out."""
+        attempt = 0
+        while True:
+            attempt += 1
+            wait = self.breaker.get_wait()
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = self.breaker.get_wait()
+            try:
+                result = await func()
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                kind = classify(ex)
+                if kind in (TRANSIENT, THROTTLE):
+                    self.breaker.record_failure()
+                if (
+                    kind == FATAL
+                    or (kind == AUTH and not retry_auth)
+                    or attempt >= self.attempts
+                ):
+                    raise
+                delay = self.get_delay(attempt, kind, ex)
+                if on_retry:
+                    on_retry(ex, kind, delay)
+                await asyncio.sleep(delay)
+                continue
+            self.breaker.record_success()
+            return result
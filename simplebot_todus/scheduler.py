@@ -0,0 +1,196 @@
+import logging
+import time
+from contextlib import contextmanager
+from threading import Condition, Lock, Semaphore, Thread
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+
+class _Job:
+    def __init__(self, key: int, weight: float, func: Callable, args: tuple) -> None:
+        self.key = key
+        self.weight = weight
+        self.func = func
+        self.args = args
+        self.queued = time.monotonic()
+
+    def priority(self, now: float, aging: float) -> float:
+        return self.weight - aging * (now - self.queued)
+
+
+class Scheduler:
+    """Run jobs in a fixed number of worker threads, lightest jobs first.
+
+    The weight of a job is its expected size in bytes, jobs that wait in
+    the queue get lighter with time (``aging`` bytes per second) so big
+    jobs are not postponed forever. Besides the number of workers, every
+    stage of a job can have its own concurrency limit, see ``stage()``.
+
+    ``remaining(key)`` can return the seconds a running job still needs,
+    to improve the estimated waiting time of queued jobs. ``admit(key)``
+    can hold a job in the queue (e.g. until there is enough disk space
+    for it) by returning False, then the next job that is admitted runs
+    instead, and held jobs are checked again every ``admit_interval``
+    seconds and whenever a job ends. ``admit()`` is called without
+    holding the scheduler lock, one job at a time, and the job is out of
+    the queue while it is checked.
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        queue_size: int,
+        stages: Dict[str, int],
+        default_weight: float,
+        aging: float = 1024 * 1024,
+        logger: Optional[logging.Logger] = None,
+        remaining: Optional[Callable[[int], Optional[float]]] = None,
+        admit: Optional[Callable[[int], bool]] = None,
+        admit_interval: float = 5,
+    ) -> None:
+        self.logger = logger or logging.getLogger(__name__)
+        self.remaining = remaining
+        self.admit = admit
+        self.admit_interval = admit_interval
+        self.workers = workers
+        self.queue_size = queue_size
+        self.default_weight = default_weight
+        self.aging = aging
+        self._stages = {name: Semaphore(limit) for name, limit in stages.items()}
+        self._queue: List[_Job] = []
+        self._running: Dict[int, float] = {}
+        self._avg_duration: Optional[float] = None
+        self._cond = Condition(Lock())
+        self._admitting = Lock()
+        # incremented when a job is queued or ends, to tell if a held job
+        # should be checked again
+        self._changes = 0
+        for _ in range(workers):
+            Thread(target=self._worker, daemon=True).start()
+
+    def is_full(self) -> bool:
+        with self._cond:
+            return len(self._queue) >= self.queue_size
+
+    def submit(
+        self,
+        key: int,
+        func: Callable,
+        *args,
+        weight: Optional[float] = None,
+        force: bool = False,
+    ) -> bool:
+        """Queue a job, return False if the queue is full."""
+        with self._cond:
+            if not force and len(self._queue) >= self.queue_size:
+                return False
+            if weight is None:
+                weight = self.default_weight
+            self._queue.append(_Job(key, weight, func, args))
+            self._changes += 1
+            self._cond.notify()
+        return True
+
+    def set_weight(self, key: int, weight: float) -> None:
+        with self._cond:
+            for job in self._queue:
+                if job.key == key:
+                    job.weight = weight
+
+    def remove(self, key: int) -> bool:
+        """Drop a queued job, return False if it isn't in the queue."""
+        with self._cond:
+            for job in self._queue:
+                if job.key == key:
+                    self._queue.remove(job)
+                    return True
+        return False
+
+    def get_position(self, key: int) -> Optional[Tuple[int, Optional[float]]]:
+        """Return the position of a queued job and its estimated wait in seconds."""
+        with self._cond:
+            now = time.monotonic()
+            queue = sorted(self._queue, key=lambda j: j.priority(now, self.aging))
+            for pos, job in enumerate(queue):
+                if job.key == key:
+                    break
+            else:
+                return None
+            if self._avg_duration is None:
+                return pos, None
+            # time left of the running jobs plus the jobs ahead, spread among
+            # the workers
+            busy = 0.0
+            for running, started in self._running.items():
+                left = self.remaining(running) if self.remaining else None
+                if left is None:
+                    left = max(self._avg_duration - (now - started), 0)
+                busy += left
+            return pos, (busy + pos * self._avg_duration) / self.workers
+
+    def get_load(self) -> Tuple[int, int]:
+        """Return the number of queued and running jobs."""
+        with self._cond:
+            return len(self._queue), len(self._running)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[Semaphore]:
+        """Hold a slot of the given stage while the block runs."""
+        slot = self._stages[name]
+        with slot:
+            yield slot
+
+    def _pop(self) -> _Job:
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                now = time.monotonic()
+                queue = sorted(self._queue, key=lambda j: j.priority(now, self.aging))
+                if self.admit is None:
+                    return self._start(queue[0])
+                changes = self._changes
+            with self._admitting:
+                for job in queue:
+                    with self._cond:
+                        if job not in self._queue:
+                            continue
+                        self._queue.remove(job)
+                    if self._admit(job):
+                        with self._cond:
+                            self._running[job.key] = time.monotonic()
+                        return job
+                    with self._cond:
+                        self._queue.append(job)
+            with self._cond:
+                if changes == self._changes:
+                    self._cond.wait(self.admit_interval)
+
+    def _start(self, job: _Job) -> _Job:
+        self._queue.remove(job)
+        self._running[job.key] = time.monotonic()
+        return job
+
+    def _admit(self, job: _Job) -> bool:
+        try:
+            return self.admit(job.key)
+        except Exception as ex:
+            self.logger.exception(ex)
+            return True
+
+    def _worker(self) -> None:
+        while True:
+            job = self._pop()
+            try:
+                job.func(*job.args)
+            except Exception as ex:
+                self.logger.exception(ex)
+            finally:
+                with self._cond:
+                    duration = time.monotonic() - self._running.pop(job.key)
+                    if self._avg_duration is None:
+                        self._avg_duration = duration
+                    else:
+                        self._avg_duration = 0.8 * self._avg_duration + 0.2 * duration
+                    # the job could have been holding what others are waiting for
+                    self._changes += 1
+                    self._cond.notify_all()
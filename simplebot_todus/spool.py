@@ -0,0 +1,101 @@
+import os
+import shutil
+from threading import Lock
+from typing import Dict, Iterable, Tuple
+
+
+class Spool:
+    """Disk space of the folder where the petitions keep their files.
+
+    Every petition reserves the bytes it will write before it starts and
+    releases them when it ends. A reservation is only accepted if the
+    disk keeps at least ``min_free`` bytes free after all the reserved
+    bytes are written, and if ``max_size`` (0 means no limit) is not
+    exceeded, so petitions wait for space instead of filling the disk and
+    failing all at once.
+    """
+
+    def __init__(self, path: str, min_free: int, max_size: int = 0) -> None:
+        self.path = path
+        self.min_free = min_free
+        self.max_size = max_size
+        self._reserved: Dict[int, int] = {}
+        self._lock = Lock()
+
+    def get_path(self, job_id: int) -> str:
+        return os.path.join(self.path, str(job_id))
+
+    def reserve(self, job_id: int, size: int, force: bool = False) -> bool:
+        """Reserve ``size`` bytes for the given job, replacing its old reservation.
+
+        Return False if there is no space, unless ``force`` is True or
+        there are no other reservations, a job that doesn't fit in an
+        empty spool must still be tried.
+        """
+        with self._lock:
+            others = {k: v for k, v in self._reserved.items() if k != job_id}
+            if not force and others:
+                used = {k: _get_size(self.get_path(k)) for k in self._reserved}
+                # space still to be written by the running jobs
+                pending = sum(max(v - used.get(k, 0), 0) for k, v in others.items())
+                need = max(size - used.get(job_id, 0), 0)
+                free = shutil.disk_usage(self.path).free - pending - self.min_free
+                if need > free:
+                    return False
+                if self.max_size:
+                    total = sum(max(v, used.get(k, 0)) for k, v in others.items())
+                    if total + size > self.max_size:
+                        return False
+            self._reserved[job_id] = size
+            return True
+
+    def release(self, job_id: int) -> None:
+        with self._lock:
+            self._reserved.pop(job_id, None)
+
+    def cleanup(self, keep: Iterable[int]) -> Tuple[int, int]:
+        """Remove the files of the jobs not in ``keep``.
+
+        Return the number of removed entries and the bytes they used.
+        """
+        keep = {str(job_id) for job_id in keep}
+        count = size = 0
+        for name in os.listdir(self.path):
+            if name in keep:
+                continue
+            path = os.path.join(self.path, name)
+            size += _get_size(path)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+            count += 1
+        return count, size
+
+    def get_usage(self) -> Tuple[int, int, int]:
+        """Return the bytes used by the spool, reserved and free in the disk."""
+        with self._lock:
+            reserved = sum(self._reserved.values())
+        return _get_size(self.path), reserved, shutil.disk_usage(self.path).free
+
+
+def _get_size(path: str) -> int:
+    # links are not followed, like os.walk() does
+    if os.path.islink(path) or not os.path.isdir(path):
+        try:
+            return os.lstat(path).st_size
+        except OSError:
+            return 0
+    total = 0
+    # hard links of the same file are only counted once
+    seen = set()
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                stat = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if (stat.st_dev, stat.st_ino) not in seen:
+                seen.add((stat.st_dev, stat.st_ino))
+                total += stat.st_size
+    return total
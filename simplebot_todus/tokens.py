@@ -0,0 +1,149 @@
+import base64
+import json
+import time
+from threading import Event, Lock
+from typing import TYPE_CHECKING, Any, Callable, Dict, Optional
+
+from . import lazy
+
+if TYPE_CHECKING:
+    from todus.client import ToDusClient
+
+
+def _login(client: "ToDusClient", phone: str, password: str) -> str:
+    return client.login(phone, password)
+
+
+def _new_client() -> "ToDusClient":
+    return lazy.load("todus.client").ToDusClient()
+
+
+class _Token:
+    def __init__(self, password: str, token: str, expires: float) -> None:
+        self.password = password
+        self.token = token
+        self.expires = expires
+
+
+class _Flight:
+    def __init__(self, password: str) -> None:
+        self.password = password
+        self.done = Event()
+        self.token: Optional[str] = None
+        self.error: Optional[Exception] = None
+
+
+class TokenCache:
+    """Cache of ToDus session tokens, one per account.
+
+    Tokens are reused until ``ttl`` seconds pass or the token's own
+    expiration date is reached, whatever happens first. Tokens close to
+    expire are refreshed in the background while the old token is still
+    served, and concurrent logins for the same account share a single
+    request to the server.
+
+    Logins always use a new client from ``new_client()``, never the
+    client of a caller, so cancelling one petition doesn't fail the
+    logins of the others. Background refreshes are passed to
+    ``submit(func, *args)``; without it the caller that notices the
+    token is about to expire refreshes it.
+    """
+
+    def __init__(
+        self,
+        ttl: float,
+        refresh_margin: float,
+        login: Callable[["ToDusClient", str, str], str] = None,
+        new_client: Callable[[], "ToDusClient"] = None,
+        submit: Callable[..., Any] = None,
+    ) -> None:
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.login = login or _login
+        self.new_client = new_client or _new_client
+        self.submit = submit
+        self._tokens: Dict[str, _Token] = {}
+        self._flights: Dict[str, _Flight] = {}
+        self._lock = Lock()
+
+    def get(self, phone: str, password: str) -> str:
+        with self._lock:
+            now = time.monotonic()
+            entry = self._tokens.get(phone)
+            if entry and entry.password == password and now < entry.expires:
+                refresh = None
+                if now >= entry.expires - self.refresh_margin:
+                    refresh = self._start_flight(phone, password)
+                token = entry.token
+            else:
+                token = None
+                flight = self._start_flight(phone, password)
+                if flight is None:
+                    flight = self._flights[phone]
+                    leader = False
+                else:
+                    leader = True
+        if token is not None:
+            if refresh is not None:
+                if self.submit is None:
+                    self._login(phone, refresh)
+                else:
+                    self.submit(self._login, phone, refresh)
+            return token
+        if leader:
+            self._login(phone, flight)
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        assert flight.token is not None
+        return flight.token
+
+    def put(self, phone: str, password: str, token: str) -> None:
+        with self._lock:
+            self._tokens[phone] = _Token(password, token, self._get_expiration(token))
+
+    def invalidate(self, phone: str, token: Optional[str] = None) -> None:
+        """Forget the token of the given account.
+
+        If ``token`` is given, the cached token is only dropped if it is
+        still the same, so a token refreshed meanwhile is kept.
+        """
+        with self._lock:
+            entry = self._tokens.get(phone)
+            if entry and (token is None or entry.token == token):
+                del self._tokens[phone]
+
+    def _start_flight(self, phone: str, password: str) -> Optional[_Flight]:
+        flight = self._flights.get(phone)
+        if flight is not None and flight.password == password:
+            return None
+        flight = self._flights[phone] = _Flight(password)
+        return flight
+
+    def _login(self, phone: str, flight: _Flight) -> None:
+        try:
+            token = self.login(self.new_client(), phone, flight.password)
+            with self._lock:
+                self._tokens[phone] = _Token(
+                    flight.password, token, self._get_expiration(token)
+                )
+            flight.token = token
+        except Exception as ex:
+            flight.error = ex
+        finally:
+            with self._lock:
+                if self._flights.get(phone) is flight:
+                    del self._flights[phone]
+            flight.done.set()
+
+    def _get_expiration(self, token: str) -> float:
+        now = time.monotonic()
+        expires = now + self.ttl
+        try:
+            payload = token.split(".")[1]
+            payload += "=" * (-len(payload) % 4)
+            exp = json.loads(base64.urlsafe_b64decode(payload))["exp"]
+            expires = min(expires, now + float(exp) - time.time())
+        except (IndexError, KeyError, TypeError, ValueError):
+            pass
+        return expires
@@ -1,16 +1,21 @@
 import functools
+import hashlib
 import logging
 import mimetypes
 import os
 import re
-from tempfile import TemporaryDirectory
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, parse_qsl, urlencode, urlsplit, urlunsplit
 
 import requests
-import youtube_dl
 from simplebot.bot import DeltaBot
 
+from . import lazy, progress
 from .db import DBManager
-from .errors import FileTooBig
+from .errors import FileTooBig, RangeIgnored
 
 session = requests.Session()
 session.headers.update(
@@ -19,6 +24,34 @@ session.headers.update(
     }
 )
 session.request = functools.partial(session.request, timeout=15)
+MIN_SEGMENT_SIZE = 1024 * 1024 * 5
+SEGMENT_RETRIES = 5
+# segment responses that are retried, besides 5xx
+RETRY_STATUSES = (408, 429)
+MAX_FILENAME = 200
+# the media URLs in the video info expire after some hours
+YTINFO_TTL = 60 * 30
+_ytinfo: Dict[str, Tuple[float, dict]] = {}
+_ytinfo_lock = Lock()
+
+
+class RateLimiter:
+    """Space operations on the same key at least ``interval`` seconds apart."""
+
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self._next: Dict[str, float] = {}
+        self._lock = Lock()
+
+    def reserve(self, key: str) -> float:
+        """Take the next slot for ``key``, return the seconds to wait for it."""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next.get(key, now))
+            self._next[key] = slot + self.interval
+            for k in [k for k, t in self._next.items() if t < now]:
+                del self._next[k]
+        return slot - now
 
 
 def is_ytlink(url: str) -> bool:
@@ -31,59 +64,380 @@ def is_ytlink(url: str) -> bool:
     )
 
 
+def normalize_url(url: str) -> str:
+    """Return a canonical form of the URL to be used as cache key.
+
+    Raise ValueError for YouTube links without a video ID.
+    """
+    if "://" not in url:
+        url = "http://" + url
+    if is_ytlink(url):
+        parts = urlsplit(url)
+        if parts.netloc == "youtu.be":
+            video_id = parts.path.strip("/")
+        else:
+            video_id = parse_qs(parts.query).get("v", [""])[0]
+        if not re.fullmatch(r"[\w-]+", video_id):
+            raise ValueError(f"El enlace de YouTube no tiene el ID del video: {url}")
+        return "yt:" + video_id
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    default_port = {"http": ":80", "https": ":443"}.get(scheme)
+    if default_port and netloc.endswith(default_port):
+        netloc = netloc[: -len(default_port)]
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, parts.path or "/", query, ""))
+
+
+def parse_urls(text: str) -> List[str]:
+    """Get the URLs of a petition, one or more separated by spaces or lines.
+
+    Raise ValueError if one of the URLs is invalid.
+    """
+    urls: Dict[str, str] = {}
+    for url in text.split():
+        urls.setdefault(normalize_url(url), url)
+    return list(urls.values())
+
+
+def get_urls_key(urls: List[str]) -> str:
+    """Return the cache key of a petition with the given URLs."""
+    return "\n".join(sorted(normalize_url(url) for url in urls))
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(functools.partial(file.read, 1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 def parse_phone(phone: str) -> str:
     phone = phone.lstrip("+").replace(" ", "")
     return "53" + re.match(r"(53)?(\d{8})", phone).group(2)
 
 
 def get_db(bot: DeltaBot) -> DBManager:
+    return DBManager(os.path.join(_get_plugin_dir(bot), "sqlite.db"))
+
+
+def get_spool_dir(bot: DeltaBot) -> str:
+    path = os.path.join(_get_plugin_dir(bot), "spool")
+    if not os.path.exists(path):
+        os.makedirs(path)
+    return path
+
+
+def _get_plugin_dir(bot: DeltaBot) -> str:
     path = os.path.join(os.path.dirname(bot.account.db_path), __name__.split(".")[0])
     if not os.path.exists(path):
         os.makedirs(path)
-    return DBManager(os.path.join(path, "sqlite.db"))
-
-
-def download_ytvideo(url: str, max_size: int, is_admin: bool) -> tuple:
-    with TemporaryDirectory() as tempdir:
-        opts = {
-            "format": "best" if is_admin else f"best[filesize<{max_size}]",
-            "max_downloads": 1,
-            "socket_timeout": 15,
-            "outtmpl": tempdir + "/%(title)s.%(ext)s",
-        }
-        with youtube_dl.YoutubeDL(opts) as yt:
-            yt.download([url])
-        files = os.listdir(tempdir)
-        if len(files) > 1:
-            raise FileTooBig()
-        filename = files[0]
-        data = b""
-        size = 0
-        chunk_size = 1024 * 1024 * 5
-        with open(os.path.join(tempdir, filename), "rb") as f:
-            chunk = f.read(chunk_size)
-            while chunk:
-                size += len(chunk)
-                if not is_admin and size > max_size:
-                    raise FileTooBig()
-                data += chunk
-                chunk = f.read(chunk_size)
-    return (filename, data, size)
-
-
-def download_file(url: str, max_size: int, is_admin: bool) -> tuple:
+    return path
+
+
+def get_cached_ytinfo(url: str) -> Optional[dict]:
+    """Return the cached metadata of a YouTube video, None if it isn't cached."""
+    with _ytinfo_lock:
+        entry = _ytinfo.get(normalize_url(url))
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+    return None
+
+
+def get_ytinfo(url: str) -> dict:
+    """Get the metadata of a YouTube video, cached by video ID."""
+    info = get_cached_ytinfo(url)
+    if info is not None:
+        return info
+    key = normalize_url(url)
+    opts = {"socket_timeout": 15, "noplaylist": True, "quiet": True}
+    with lazy.load("youtube_dl").YoutubeDL(opts) as yt:
+        info = yt.extract_info(url, download=False)
+    with _ytinfo_lock:
+        now = time.monotonic()
+        for k in [k for k, (expires, _) in _ytinfo.items() if expires <= now]:
+            del _ytinfo[k]
+        _ytinfo[key] = (now + YTINFO_TTL, info)
+    return info
+
+
+def select_ytformat(info: dict, max_size: Optional[int]) -> Tuple[dict, Optional[int]]:
+    """Pick the best format with audio and video that isn't bigger than ``max_size``.
+
+    Return the format and its expected size, raise FileTooBig if no
+    format fits.
+    """
+    formats = [
+        fmt
+        for fmt in info.get("formats") or [info]
+        if fmt.get("vcodec") != "none" and fmt.get("acodec") != "none"
+    ]
+    duration = info.get("duration")
+    # youtube_dl sorts the formats from worst to best
+    for fmt in reversed(formats):
+        size = fmt.get("filesize") or fmt.get("filesize_approx")
+        if not size and fmt.get("tbr") and duration:
+            size = fmt["tbr"] * 1000 / 8 * duration
+        size = int(size) if size else None
+        if max_size is None or (size is not None and size <= max_size):
+            return fmt, size
+    raise FileTooBig()
+
+
+def probe_ytvideo(url: str, max_size: Optional[int]) -> Optional[int]:
+    """Get the expected size of the video that would be downloaded.
+
+    Raise FileTooBig if no format fits in ``max_size``.
+    """
+    try:
+        info = get_ytinfo(url)
+    except Exception:  # noqa
+        return None
+    return select_ytformat(info, max_size)[1]
+
+
+def download_ytvideo(
+    url: str, folder: str, max_size: int, is_admin: bool, info: dict = None
+) -> tuple:
+    """Download a YouTube video.
+
+    ``info`` is the metadata of the video if the caller already has it,
+    download workers don't share the metadata cache.
+    """
+    if info is None:
+        info = get_ytinfo(url)
+    fmt = select_ytformat(info, None if is_admin else max_size)[0]
+    outdir = os.path.join(folder, "ytdl")
+    opts = {
+        "format": fmt["format_id"],
+        "max_downloads": 1,
+        "socket_timeout": 15,
+        "quiet": True,
+        "outtmpl": outdir + "/%(title)s.%(ext)s",
+        "progress_hooks": [_report_ytprogress],
+    }
+    with lazy.load("youtube_dl").YoutubeDL(opts) as yt:
+        # reuse the extracted info instead of fetching the video page again
+        yt.process_ie_result(dict(info), download=True)
+    files = os.listdir(outdir)
+    if len(files) > 1:
+        raise FileTooBig()
+    filename = files[0]
+    path = os.path.join(outdir, filename)
+    size = os.stat(path).st_size
+    if not is_admin and size > max_size:
+        raise FileTooBig()
+    return (filename, path, size, file_digest(path), None)
+
+
+def _report_ytprogress(status: dict) -> None:
+    total = status.get("total_bytes") or status.get("total_bytes_estimate")
+    progress.set_bytes(status.get("downloaded_bytes") or 0, int(total or -1))
+
+
+def download_file(
+    url: str, folder: str, max_size: int, is_admin: bool, segments: int = 4
+) -> tuple:
     if "://" not in url:
         url = "http://" + url
+    path = os.path.join(folder, "download")
+    # ask only for the first segment, servers without range support send the
+    # whole file, so big files are never requested in full and then aborted
+    headers = {
+        "range": f"bytes=0-{MIN_SEGMENT_SIZE - 1}",
+        "accept-encoding": "identity",
+    }
+    with session.get(url, headers=headers, stream=True) as r:
+        if r.status_code == 206:
+            first = _get_content_range(r)
+            if first and not r.headers.get("content-encoding"):
+                try:
+                    return _download_ranges(
+                        r, path, first[0], first[1], max_size, is_admin, segments
+                    )
+                except RangeIgnored as ex:
+                    logging.debug("Downloading %s without ranges: %s", url, ex)
+                    progress.set_bytes(0)
+        elif r.status_code != 416:
+            r.raise_for_status()
+            return _download_stream(r, path, max_size, is_admin)
+    # the range couldn't be served (e.g. an empty file) or the server stopped
+    # honoring ranges, get the whole file
     with session.get(url, stream=True) as r:
         r.raise_for_status()
-        data = b""
-        size = 0
+        return _download_stream(r, path, max_size, is_admin)
+
+
+def _get_content_range(r) -> Optional[Tuple[int, int]]:
+    """Return the size of the first range of the file and the file size."""
+    match = re.fullmatch(
+        r"bytes 0-(\d+)/(\d+)", r.headers.get("content-range", "").strip()
+    )
+    if not match:
+        return None
+    return int(match.group(1)) + 1, int(match.group(2))
+
+
+def _download_stream(r, path: str, max_size: int, is_admin: bool) -> tuple:
+    length = int(r.headers.get("content-length") or -1)
+    if not is_admin and length > max_size:
+        raise FileTooBig()
+    progress.set_total(length)
+    digest = hashlib.sha256()
+    with open(path, "wb") as file:
+        size = _copy_stream(r, file, digest, 0, max_size, is_admin)
+    filename = get_filename(r) or "file"
+    return (filename, path, size, digest.hexdigest(), get_validator(r))
+
+
+def _copy_stream(r, file, digest, size: int, max_size: int, is_admin: bool) -> int:
+    for chunk in r.iter_content(chunk_size=1024 * 1024):
+        size += len(chunk)
+        if not is_admin and size > max_size:
+            raise FileTooBig()
+        digest.update(chunk)
+        file.write(chunk)
+        progress.add_bytes(len(chunk))
+    return size
+
+
+def _download_ranges(
+    r, path: str, first: int, length: int, max_size: int, is_admin: bool, segments: int
+) -> tuple:
+    """Download a file whose first ``first`` bytes are in the response ``r``.
+
+    The rest of the file is split in up to ``segments - 1`` ranges that
+    are downloaded while the response is read.
+    """
+    if not is_admin and length > max_size:
+        raise FileTooBig()
+    filename = get_filename(r) or "file"
+    validator = get_validator(r)
+    if_range = _get_if_range(r)
+    progress.set_total(length)
+    rest = length - first
+    count = min(max(segments - 1, 1), max(rest // MIN_SEGMENT_SIZE, 1)) if rest else 0
+    bounds = [first + rest * i // count for i in range(count + 1)] if count else []
+    digest = hashlib.sha256()
+    # set when a segment fails, so the others don't go on downloading
+    stop = Event()
+    with open(path, "w+b") as file:
+        file.truncate(length)
+        with ThreadPoolExecutor(max_workers=max(min(segments, count + 1), 1)) as pool:
+            futures = [
+                pool.submit(_read_first_segment, r, file, first, if_range, digest, stop)
+            ]
+            futures.extend(
+                pool.submit(
+                    _download_segment, r.url, file, start, end - 1, if_range, stop
+                )
+                for start, end in zip(bounds, bounds[1:])
+            )
+            try:
+                hashed = futures[0].result()
+                for future in futures[1:]:
+                    future.result()
+            except BaseException:
+                stop.set()
+                raise
+        # SHA-256 can't be combined from the hashes of the segments, the rest
+        # is hashed once written (the file was just written, it is in cache)
+        file.seek(hashed)
+        for chunk in iter(functools.partial(file.read, 1024 * 1024), b""):
+            digest.update(chunk)
+    return (filename, path, length, digest.hexdigest(), validator)
+
+
+def _read_first_segment(
+    r, file, end: int, if_range: Optional[str], digest, stop: Event
+) -> int:
+    """Write the body of ``r`` at the start of the file, hashing it.
+
+    If the connection is interrupted, the rest of the segment is
+    downloaded with range requests. Return the bytes hashed.
+    """
+    pos = 0
+    try:
         for chunk in r.iter_content(chunk_size=1024 * 1024):
-            size += len(chunk)
-            if not is_admin and size > max_size:
-                raise FileTooBig()
-            data += chunk
-        return (get_filename(r) or "file", data, size)
+            if stop.is_set():
+                return pos
+            chunk = chunk[: end - pos]
+            os.pwrite(file.fileno(), chunk, pos)
+            digest.update(chunk)
+            pos += len(chunk)
+            progress.add_bytes(len(chunk))
+    except requests.RequestException as ex:
+        logging.debug("First segment interrupted at %s: %s", pos, ex)
+    if pos < end:
+        _download_segment(r.url, file, pos, end - 1, if_range, stop)
+    return pos
+
+
+def _download_segment(
+    url: str, file, start: int, end: int, if_range: Optional[str], stop: Event
+) -> None:
+    """Download bytes ``start`` to ``end`` of the file, retrying failures.
+
+    Raise RangeIgnored if the server answers with anything but the
+    requested range, e.g. because the file changed.
+    """
+    pos = start
+    for attempt in range(SEGMENT_RETRIES):
+        if attempt:
+            stop.wait(2**attempt)
+        if stop.is_set():
+            return
+        try:
+            with session.get(
+                url, headers=_range_headers(pos, end, if_range), stream=True
+            ) as r:
+                if r.status_code >= 400 and r.status_code != 416:
+                    r.raise_for_status()
+                content_range = r.headers.get("content-range", "")
+                if r.status_code != 206 or not content_range.startswith(
+                    f"bytes {pos}-"
+                ):
+                    raise RangeIgnored(f"Range request not honored ({r.status_code})")
+                for chunk in r.iter_content(chunk_size=1024 * 1024):
+                    if stop.is_set():
+                        return
+                    chunk = chunk[: end + 1 - pos]
+                    os.pwrite(file.fileno(), chunk, pos)
+                    pos += len(chunk)
+                    progress.add_bytes(len(chunk))
+            if pos > end:
+                return
+        except requests.RequestException as ex:
+            status = getattr(ex.response, "status_code", None)
+            if status is not None and status not in RETRY_STATUSES and status < 500:
+                raise
+            logging.debug("Segment %s-%s interrupted at %s: %s", start, end, pos, ex)
+    raise IOError(f"Failed to download bytes {start}-{end}")
+
+
+def _range_headers(start: int, end: int, if_range: Optional[str]) -> dict:
+    headers = {"range": f"bytes={start}-{end}"}
+    if if_range:
+        headers["if-range"] = if_range
+    return headers
+
+
+def _get_if_range(r) -> Optional[str]:
+    """Return the validator to send in If-Range.
+
+    Servers must ignore the range if If-Range has a weak ETag, so
+    Last-Modified is used for those, or nothing.
+    """
+    etag = r.headers.get("etag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return r.headers.get("last-modified")
+
+
+def get_validator(r) -> Optional[str]:
+    return r.headers.get("etag") or r.headers.get("last-modified")
 
 
 def get_filename(r) -> str:
@@ -92,6 +446,7 @@ def get_filename(r) -> str:
         fname = re.findall("filename=(.+)", d)[0].strip('"')
     else:
         fname = r.url.split("/")[-1].split("?")[0].split("#")[0]
+    fname = safe_filename(fname)
 
     if "." in fname:
         return fname
@@ -104,3 +459,36 @@ def get_filename(r) -> str:
     else:
         ext = mimetypes.guess_extension(ctype) or ""
     return (fname or "file") + ext
+
+
+def safe_filename(name: str) -> str:
+    """Reduce a file name given by a remote server to a plain name.
+
+    Directories and ``..`` are dropped, so the name can't point outside
+    the folder it is joined to. Return an empty string if nothing is left.
+    """
+    name = re.split(r"[/\\]", name)[-1]
+    name = "".join(char for char in name if char.isprintable()).strip()
+    if not name.strip("."):
+        return ""
+    # file systems limit names to 255 bytes, leave room for a " (2)" suffix
+    if len(name.encode()) > MAX_FILENAME:
+        stem, ext = os.path.splitext(name)
+        if len(ext) > 16:
+            stem, ext = name, ""
+        limit = MAX_FILENAME - len(ext.encode())
+        name = stem.encode()[:limit].decode(errors="ignore") + ext
+    return name
+
+
+def probe_url(url: str) -> Tuple[Optional[int], Optional[str]]:
+    """Get the size and the ETag/Last-Modified validator of the given URL."""
+    if "://" not in url:
+        url = "http://" + url
+    try:
+        with session.head(url, allow_redirects=True) as r:
+            r.raise_for_status()
+            size = r.headers.get("content-length")
+            return int(size) if size else None, get_validator(r)
+    except (requests.RequestException, ValueError):
+        return None, None
@@ -0,0 +1,40 @@
+import functools
+import hashlib
+import logging
+import os
+from contextlib import suppress
+from typing import Callable, Optional
+
+import requests
+
+
+def verify_part(
+    download: Callable[[str], object], path: str, size: int, md5: str
+) -> Optional[bool]:
+    """Check that the uploaded copy of a part matches the local one.
+
+    s3 only serves the parts to requests signed with the account's
+    token, so ``download(path)`` must download the part to ``path`` with
+    the ToDus client. The whole part is downloaded and its size and MD5
+    compared, so damage anywhere in the part is found. Return None if
+    the part couldn't be downloaded for a reason other than it missing.
+    """
+    try:
+        download(path)
+        digest = hashlib.md5()
+        with open(path, "rb") as file:
+            for chunk in iter(functools.partial(file.read, 1024 * 1024), b""):
+                digest.update(chunk)
+            received = file.tell()
+        return received == size and digest.hexdigest() == md5
+    except requests.HTTPError as ex:
+        if ex.response is not None and ex.response.status_code == 404:
+            return False
+        logging.debug("Failed to verify %s: %r", path, ex)
+        return None
+    except (requests.RequestException, OSError) as ex:
+        logging.debug("Failed to verify %s: %r", path, ex)
+        return None
+    finally:
+        with suppress(FileNotFoundError):
+            os.remove(path)
@@ -0,0 +1,184 @@
+import multiprocessing
+import queue
+import time
+from multiprocessing.connection import Connection
+from threading import Lock
+from typing import Any, Callable, Optional, Tuple
+
+from . import progress
+from .errors import TaskAborted
+
+# the plugin runs several threads that use locks and pooled HTTP connections,
+# forking it while they are busy could leave them broken in the worker, so
+# workers are started from a clean process that only imported the downloader
+if "forkserver" in multiprocessing.get_all_start_methods():
+    _context = multiprocessing.get_context("forkserver")
+    _context.set_forkserver_preload([__package__ + ".util"])
+else:
+    _context = multiprocessing.get_context("spawn")
+
+
+def _worker_main(conn: Connection, counters) -> None:
+    progress.set_counters(counters)
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        func, args = job
+        try:
+            result = (True, func(*args))
+        except Exception as ex:
+            result = (False, ex)
+        try:
+            conn.send(result)
+        except Exception as ex:  # the exception or result couldn't be pickled
+            conn.send((False, RuntimeError(f"{result[1]!r} ({ex})")))
+
+
+class _Worker:
+    def __init__(self) -> None:
+        self.conn, child_conn = _context.Pipe()
+        # bytes done and total of the current task, written by the worker,
+        # and its rate limit in bytes/second (0 = no limit)
+        self.counters = _context.RawArray("q", 3)
+        self.process = _context.Process(
+            target=_worker_main, args=(child_conn, self.counters), daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.jobs = 0
+        self.broken = False
+
+    def stop(self) -> None:
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+
+class Task:
+    """Handle to cancel a function running in the pool."""
+
+    def __init__(self) -> None:
+        self.killed = False
+        self._worker: Optional[_Worker] = None
+        self._progress = (0, -1)
+        self.rate = 0.0
+
+    def get_progress(self) -> Tuple[int, int]:
+        """Return the bytes done and the total bytes (-1 if unknown)."""
+        worker = self._worker
+        if worker is not None:
+            self._progress = (worker.counters[0], worker.counters[1])
+        return self._progress
+
+    def set_rate(self, rate: float) -> None:
+        """Limit the bytes/second the task can download, 0 means no limit."""
+        self.rate = rate
+        worker = self._worker
+        if worker is not None:
+            worker.counters[2] = int(rate)
+
+    def kill(self) -> None:
+        self.killed = True
+        worker = self._worker
+        if worker is not None and worker.process.is_alive():
+            worker.process.terminate()
+
+
+class WorkerPool:
+    """Pool of long-lived processes to run downloads.
+
+    Workers keep their imports and HTTP connections between jobs and
+    are replaced after ``max_jobs`` jobs, or when a job is killed or
+    times out.
+    """
+
+    def __init__(self, size: int, max_jobs: int) -> None:
+        self.size = size
+        self.max_jobs = max_jobs
+        self._idle: queue.Queue = queue.Queue()
+        self._count = 0
+        self._lock = Lock()
+        for _ in range(size):
+            self._count += 1
+            self._idle.put(_Worker())
+
+    def get_busy(self) -> int:
+        """Return the number of workers running a task."""
+        with self._lock:
+            return self._count - self._idle.qsize()
+
+    def run(
+        self, func: Callable, args: tuple, timeout: float, task: Task = None
+    ) -> Any:
+        task = task or Task()
+        worker = self._acquire()
+        task._worker = worker
+        try:
+            if task.killed:
+                raise TaskAborted()
+            worker.jobs += 1
+            worker.counters[0], worker.counters[1] = 0, -1
+            worker.counters[2] = int(task.rate)
+            worker.conn.send((func, args))
+            deadline = time.monotonic() + timeout
+            while not worker.conn.poll(0.5):
+                if task.killed:
+                    raise TaskAborted()
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"task took more than {timeout} seconds")
+                if not worker.process.is_alive():
+                    raise RuntimeError(
+                        f"worker died with exit code {worker.process.exitcode}"
+                    )
+            try:
+                ok, result = worker.conn.recv()
+            except (EOFError, OSError):
+                if task.killed:
+                    raise TaskAborted()
+                raise
+        except BaseException:
+            worker.broken = True
+            raise
+        finally:
+            task.get_progress()
+            task._worker = None
+            self._release(worker)
+        if not ok:
+            raise result
+        return result
+
+    def _acquire(self) -> _Worker:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._count < self.size:
+                self._count += 1
+                spawn = True
+            else:
+                spawn = False
+        if spawn:
+            try:
+                return _Worker()
+            except BaseException:
+                with self._lock:
+                    self._count -= 1
+                raise
+        return self._idle.get()
+
+    def _release(self, worker: _Worker) -> None:
+        if worker.broken or worker.jobs >= self.max_jobs:
+            worker.stop()
+            try:
+                worker = _Worker()
+            except Exception:  # noqa
+                with self._lock:
+                    self._count -= 1
+                return
+        self._idle.put(worker)
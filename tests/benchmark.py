@@ -0,0 +1,358 @@
+"""Offline benchmark of the petition pipeline.
+
+Runs the plugin against a local HTTP origin, a fake ToDus client and a
+fake s3 server, sends ``/s3_get`` from N simulated users at once and
+reports throughput, per-stage latencies and peak memory and disk use.
+
+Example::
+
+  python tests/benchmark.py --users 10 --size 50MB --part-size 15MB \\
+      --upload-bandwidth 2MB --max-p99 300
+
+The ``--max-*``/``--min-*`` options turn it into a regression gate: the
+exit code is 1 if any of the limits is exceeded.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from threading import Event, Lock, Thread
+from typing import Dict, List
+
+from fakes import FakeToDusClient, OriginServer, S3Server
+
+UNITS = {"": 1, "B": 1, "KB": 1024, "MB": 1024**2, "GB": 1024**3}
+
+
+def parse_size(text: str) -> int:
+    match = re.fullmatch(r"([\d.]+)\s*([KMG]?B?)", text.strip().upper())
+    if not match:
+        raise argparse.ArgumentTypeError(f"invalid size: {text}")
+    return int(float(match[1]) * UNITS[match[2]])
+
+
+class FakeContact:
+    def __init__(self, addr: str) -> None:
+        self.addr = addr
+
+
+class FakeChat:
+    def is_group(self) -> bool:
+        return False
+
+
+class FakeMessage:
+    def __init__(self, msg_id: int, addr: str) -> None:
+        self.id = msg_id
+        self.chat = FakeChat()
+        self._contact = FakeContact(addr)
+
+    def get_sender_contact(self) -> FakeContact:
+        return self._contact
+
+
+class FakeAccount:
+    def __init__(self, folder: str) -> None:
+        self.db_path = os.path.join(folder, "bot.db")
+        self.messages: Dict[int, FakeMessage] = {}
+
+    def get_message_by_id(self, msg_id: int) -> FakeMessage:
+        return self.messages[msg_id]
+
+
+class FakeBot:
+    def __init__(self, folder: str, settings: dict) -> None:
+        self.logger = logging.getLogger("benchmark")
+        self.account = FakeAccount(folder)
+        self._settings = dict(settings)
+
+    def get(self, key: str, default=None, scope: str = None):
+        return self._settings.get(key, default)
+
+    def set(self, key: str, value, scope: str = None) -> None:
+        self._settings[key] = value
+
+    def is_admin(self, addr: str) -> bool:
+        return False
+
+
+class RecordingReplies:
+    """Replaces simplebot's Replies, records when each petition is answered."""
+
+    finished: Dict[int, float] = {}
+    failed: Dict[int, str] = {}
+    lock = Lock()
+    done = Event()
+    expected = 0
+
+    def __init__(self, message, logger=None) -> None:
+        self.message = message
+        self.texts: List[str] = []
+
+    def add(self, text: str = None, **kwargs) -> None:
+        self.texts.append(text or "")
+
+    def send_reply_messages(self) -> None:
+        cls = type(self)
+        with cls.lock:
+            cls.finished[self.message.id] = time.monotonic()
+            errors = [text for text in self.texts if text.startswith("❌")]
+            if errors:
+                cls.failed[self.message.id] = errors[0]
+            if len(cls.finished) >= cls.expected:
+                cls.done.set()
+
+
+def get_rss() -> int:
+    """Resident memory of this process and its children, in bytes."""
+    pids = [os.getpid()] + [p.pid for p in multiprocessing.active_children()]
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/statm") as file:
+                total += int(file.read().split()[1]) * resource.getpagesize()
+        except (OSError, IndexError, ValueError):
+            pass
+    return total
+
+
+def get_disk_usage(folder: str) -> int:
+    total = 0
+    for root, _, files in os.walk(folder):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+def measure_import() -> dict:
+    """Import the plugin in a new interpreter, report the time and memory it takes.
+
+    ``heavy`` lists the heavy dependencies that were imported eagerly,
+    they should only be loaded by the petitions that need them.
+    """
+    code = (
+        "import json, resource, sys, time\n"
+        "start = time.perf_counter()\n"
+        "import simplebot_todus\n"
+        "seconds = time.perf_counter() - start\n"
+        "from simplebot_todus.lazy import HEAVY_MODULES\n"
+        "with open('/proc/self/statm') as file:\n"
+        "    rss = int(file.read().split()[1]) * resource.getpagesize()\n"
+        "print(json.dumps({'seconds': seconds, 'rss': rss,"
+        " 'heavy': [m for m in HEAVY_MODULES if m in sys.modules]}))\n"
+    )
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=root,
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def run(args: argparse.Namespace) -> dict:
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import simplebot_todus as plugin
+
+    origin = OriginServer(latency=args.origin_latency, bandwidth=args.origin_bandwidth)
+    s3 = S3Server()
+    FakeToDusClient.s3 = s3
+    FakeToDusClient.latency = args.todus_latency
+    FakeToDusClient.bandwidth = args.upload_bandwidth
+    FakeToDusClient.failure_rate = args.failure_rate
+    FakeToDusClient.corrupt_rate = args.corrupt_rate
+    plugin._new_client = FakeToDusClient
+    plugin.tokens.new_client = FakeToDusClient
+    plugin.Replies = RecordingReplies
+
+    samples: Dict[str, List[float]] = {}
+    observe = plugin.metrics.observe
+
+    def record(name: str, value: float, **labels: str) -> None:
+        samples.setdefault(labels.get("stage", name), []).append(value)
+        observe(name, value, **labels)
+
+    plugin.metrics.observe = record
+
+    settings = {
+        "max_size": str(args.size * 2),
+        "part_size": str(args.part_size),
+        "max_uploads": str(args.max_uploads),
+        "upload_delay": str(args.upload_delay),
+        "retry_delay": str(args.retry_delay),
+        "max_workers": str(args.workers),
+        "queue_size": str(args.users),
+        "verify_uploads": "1" if args.verify else "0",
+    }
+    with tempfile.TemporaryDirectory() as folder:
+        bot = FakeBot(folder, settings)
+        plugin.deltabot_init(bot)
+        plugin.deltabot_start(bot)
+        spool = os.path.join(folder, "simplebot_todus", "spool")
+
+        RecordingReplies.expected = args.users
+        messages = []
+        for i in range(args.users):
+            addr = f"user{i}@example.org"
+            plugin.db.add_account(addr, f"5355{i:06}", f"password{i}")
+            msg = FakeMessage(i + 1, addr)
+            bot.account.messages[msg.id] = msg
+            messages.append(msg)
+
+        peak = {"rss": get_rss(), "disk": 0}
+        stop = Event()
+
+        def sample() -> None:
+            while not stop.wait(0.2):
+                peak["rss"] = max(peak["rss"], get_rss())
+                peak["disk"] = max(peak["disk"], get_disk_usage(spool))
+
+        sampler = Thread(target=sample, daemon=True)
+        sampler.start()
+        start = time.monotonic()
+        for i, msg in enumerate(messages):
+            url = origin.get_url(i, args.size)
+            plugin.s3_get(bot, url, msg, RecordingReplies(msg))
+        finished = RecordingReplies.done.wait(args.timeout)
+        elapsed = time.monotonic() - start
+        stop.set()
+        sampler.join()
+
+    origin.close()
+    s3.close()
+    latencies = [t - start for t in RecordingReplies.finished.values()]
+    done = len(RecordingReplies.finished) - len(RecordingReplies.failed)
+    return {
+        "finished": finished,
+        "users": args.users,
+        "succeeded": done,
+        "failed": len(RecordingReplies.failed),
+        "errors": sorted(set(RecordingReplies.failed.values())),
+        "elapsed": elapsed,
+        "jobs_per_hour": done / elapsed * 3600 if elapsed else 0,
+        "latency": {
+            "p50": percentile(latencies, 50),
+            "p99": percentile(latencies, 99),
+        },
+        "stages": {
+            stage: {
+                "count": len(values),
+                "p50": percentile(values, 50),
+                "p99": percentile(values, 99),
+            }
+            for stage, values in sorted(samples.items())
+        },
+        "logins": FakeToDusClient.logins,
+        "uploads": FakeToDusClient.uploads,
+        "peak_rss": peak["rss"],
+        "peak_disk": peak["disk"],
+        "import": measure_import(),
+    }
+
+
+def check(report: dict, args: argparse.Namespace) -> List[str]:
+    errors = []
+    if not report["finished"]:
+        errors.append(f"timed out after {args.timeout}s")
+    if report["failed"]:
+        errors.append(f"{report['failed']} petitions failed: {report['errors']}")
+    if args.max_p99 and report["latency"]["p99"] > args.max_p99:
+        errors.append(f"p99 latency {report['latency']['p99']:.1f}s > {args.max_p99}s")
+    if args.min_throughput and report["jobs_per_hour"] < args.min_throughput:
+        errors.append(
+            f"throughput {report['jobs_per_hour']:.1f} jobs/h < {args.min_throughput}"
+        )
+    if args.max_rss and report["peak_rss"] > args.max_rss:
+        errors.append(f"peak RSS {report['peak_rss']:,}B > {args.max_rss:,}B")
+    if args.max_disk and report["peak_disk"] > args.max_disk:
+        errors.append(f"peak disk {report['peak_disk']:,}B > {args.max_disk:,}B")
+    imported = report["import"]
+    if imported["heavy"]:
+        errors.append(f"heavy modules imported eagerly: {imported['heavy']}")
+    if args.max_import and imported["seconds"] > args.max_import:
+        errors.append(
+            f"plugin import took {imported['seconds']:.2f}s > {args.max_import}s"
+        )
+    return errors
+
+
+def print_report(report: dict) -> None:
+    print(f"petitions: {report['succeeded']}/{report['users']} succeeded")
+    print(f"elapsed: {report['elapsed']:.1f}s ({report['jobs_per_hour']:.1f} jobs/h)")
+    print("latency: p50 {p50:.1f}s, p99 {p99:.1f}s".format(**report["latency"]))
+    for stage, stats in report["stages"].items():
+        print(
+            f"  {stage}: {stats['count']} samples,"
+            f" p50 {stats['p50']:.2f}s, p99 {stats['p99']:.2f}s"
+        )
+    print(f"logins: {report['logins']}, uploads: {report['uploads']}")
+    print(f"peak RSS: {report['peak_rss'] / 1024**2:.1f}MB")
+    print(f"peak spool disk use: {report['peak_disk'] / 1024**2:.1f}MB")
+    imported = report["import"]
+    print(
+        f"plugin import: {imported['seconds']:.2f}s,"
+        f" {imported['rss'] / 1024**2:.1f}MB RSS,"
+        f" eager heavy modules: {', '.join(imported['heavy']) or 'none'}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=5, help="concurrent users")
+    parser.add_argument("--size", type=parse_size, default="20MB", help="file size")
+    parser.add_argument("--part-size", type=parse_size, default="15MB")
+    parser.add_argument("--max-uploads", type=int, default=3)
+    parser.add_argument("--upload-delay", type=float, default=0)
+    parser.add_argument("--workers", type=int, default=10)
+    parser.add_argument("--retry-delay", type=float, default=1)
+    parser.add_argument("--origin-latency", type=float, default=0.05)
+    parser.add_argument("--origin-bandwidth", type=parse_size, default="0")
+    parser.add_argument("--todus-latency", type=float, default=0.1)
+    parser.add_argument("--upload-bandwidth", type=parse_size, default="0")
+    parser.add_argument("--failure-rate", type=float, default=0)
+    parser.add_argument("--corrupt-rate", type=float, default=0)
+    parser.add_argument("--verify", action="store_true", help="verify uploads")
+    parser.add_argument("--timeout", type=float, default=3600)
+    parser.add_argument("--json", action="store_true", help="print a JSON report")
+    parser.add_argument("--max-p99", type=float, help="max p99 latency in seconds")
+    parser.add_argument("--min-throughput", type=float, help="min jobs per hour")
+    parser.add_argument("--max-rss", type=parse_size, help="max peak RSS")
+    parser.add_argument("--max-disk", type=parse_size, help="max peak spool disk use")
+    parser.add_argument("--max-import", type=float, help="max plugin import seconds")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    errors = check(report, args)
+    for error in errors:
+        print(f"FAIL: {error}", file=sys.stderr)
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+"""Local stand-ins for the HTTP origins, the ToDus server and its s3 storage."""
+
+import base64
+import hashlib
+import json
+import os
+import random
+import re
+import tempfile
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+import requests
+
+BLOCK_SIZE = 1024 * 1024
+_BLOCK = random.Random(0).getrandbits(8 * BLOCK_SIZE).to_bytes(BLOCK_SIZE, "big")
+
+
+# http.server.ThreadingHTTPServer is only available since Python 3.7
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Server:
+    def __init__(self, handler: type) -> None:
+        self.httpd = _ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def _throttled_write(wfile, data: bytes, bandwidth: float) -> None:
+    chunk_size = 64 * 1024
+    for i in range(0, len(data), chunk_size):
+        chunk = data[i : i + chunk_size]
+        wfile.write(chunk)
+        if bandwidth:
+            time.sleep(len(chunk) / bandwidth)
+
+
+def file_content(seed: int, start: int, end: int) -> bytes:
+    """Bytes ``start`` to ``end`` (exclusive) of the file served for ``seed``.
+
+    Every 1MB block is random data stamped with the seed and the block
+    number, so different files are not deduplicated by content.
+    """
+    data = bytearray()
+    for block in range(start // BLOCK_SIZE, (end - 1) // BLOCK_SIZE + 1):
+        buf = bytearray(_BLOCK)
+        buf[:16] = seed.to_bytes(8, "big") + block.to_bytes(8, "big")
+        lo = max(start - block * BLOCK_SIZE, 0)
+        hi = min(end - block * BLOCK_SIZE, BLOCK_SIZE)
+        data += buf[lo:hi]
+    return bytes(data)
+
+
+class OriginServer(_Server):
+    """HTTP file server, ``/<seed>/<size>/<name>`` returns ``size`` bytes.
+
+    Supports HEAD and byte ranges, and can add latency and limit the
+    bandwidth of every response. Like real servers, it can send weak
+    ETags (``weak_etag``), stop honoring ranges not starting at 0
+    (``honor_ranges``) or fail the next ``range_failures`` of them with
+    ``range_status``. The status of every response is kept in ``statuses``.
+    """
+
+    LAST_MODIFIED = "Wed, 21 Oct 2015 07:28:00 GMT"
+
+    def __init__(self, latency: float = 0, bandwidth: float = 0) -> None:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_HEAD(self) -> None:  # noqa
+                self._serve(body=False)
+
+            def do_GET(self) -> None:  # noqa
+                self._serve(body=True)
+
+            def _serve(self, body: bool) -> None:
+                match = re.match(r"/(\d+)/(\d+)/([^/?]+)", self.path)
+                if not match:
+                    self.send_error(404)
+                    return
+                seed, size, name = int(match[1]), int(match[2]), match[3]
+                name = parse_qs(urlsplit(self.path).query).get("filename", [name])[0]
+                time.sleep(server.latency)
+                start, end = 0, size
+                etag = ("W/" if server.weak_etag else "") + f'"{seed}-{size}"'
+                rng = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("range", ""))
+                if_range = self.headers.get("if-range")
+                # RFC 7233: ignore the range if If-Range doesn't match strongly
+                if if_range is not None and (
+                    if_range.startswith("W/")
+                    or if_range not in (etag, server.LAST_MODIFIED)
+                ):
+                    rng = None
+                if rng and int(rng[1]) and not server.honor_ranges:
+                    rng = None
+                if rng and int(rng[1]):
+                    with server.lock:
+                        failed = server.range_failures > 0
+                        server.range_failures -= failed
+                    if failed:
+                        server.statuses.append(server.range_status)
+                        self.send_error(server.range_status)
+                        return
+                if rng:
+                    start = int(rng[1])
+                    end = min(int(rng[2]) + 1 if rng[2] else size, size)
+                    server.statuses.append(206)
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{end-1}/{size}")
+                else:
+                    server.statuses.append(200)
+                    self.send_response(200)
+                self.send_header("Content-Length", str(end - start))
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Accept-Ranges", "bytes")
+                self.send_header("ETag", etag)
+                self.send_header("Last-Modified", server.LAST_MODIFIED)
+                self.send_header(
+                    "Content-Disposition", f'attachment; filename="{name}"'
+                )
+                self.end_headers()
+                if body:
+                    for pos in range(start, end, BLOCK_SIZE):
+                        chunk = file_content(seed, pos, min(pos + BLOCK_SIZE, end))
+                        _throttled_write(self.wfile, chunk, server.bandwidth)
+
+            def log_message(self, *args) -> None:  # noqa
+                pass
+
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.weak_etag = False
+        self.honor_ranges = True
+        self.range_failures = 0
+        self.range_status = 503
+        self.statuses: list = []
+        self.lock = Lock()
+        super().__init__(Handler)
+
+    def get_url(
+        self, seed: int, size: int, name: str = "file.bin", filename: str = None
+    ) -> str:
+        """Return the URL of a file, ``filename`` overrides its Content-Disposition."""
+        url = f"{self.url}/{seed}/{size}/{name}"
+        if filename is not None:
+            url += "?" + urlencode({"filename": filename})
+        return url
+
+
+class S3Server(_Server):
+    """Minimal s3 stand-in: PUT stores an object, GET and HEAD serve it.
+
+    Objects are kept in a temporary directory, GET and HEAD need an URL
+    signed with ``sign()`` like ToDus does with the account's token,
+    return the MD5 of the object as ETag like s3 does for single part
+    uploads and GET supports byte ranges.
+    """
+
+    def __init__(self) -> None:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_PUT(self) -> None:  # noqa
+                size = int(self.headers["content-length"])
+                md5 = hashlib.md5()
+                with open(server.get_path(self.path), "wb") as file:
+                    while size:
+                        chunk = self.rfile.read(min(size, 64 * 1024))
+                        if not chunk:
+                            break
+                        md5.update(chunk)
+                        file.write(chunk)
+                        size -= len(chunk)
+                with server.lock:
+                    server.etags[self.path] = md5.hexdigest()
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_HEAD(self) -> None:  # noqa
+                self._serve(body=False)
+
+            def do_GET(self) -> None:  # noqa
+                self._serve(body=True)
+
+            def _serve(self, body: bool) -> None:
+                url = urlsplit(self.path)
+                if parse_qs(url.query).get("sig") != [server.get_signature(url.path)]:
+                    self.send_error(403)
+                    return
+                path = server.get_path(url.path)
+                if not os.path.exists(path):
+                    self.send_error(404)
+                    return
+                size = os.path.getsize(path)
+                start, end = 0, size
+                rng = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("range", ""))
+                if rng:
+                    start = int(rng[1])
+                    end = min(int(rng[2]) + 1 if rng[2] else size, size)
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{end-1}/{size}")
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Length", str(end - start))
+                self.send_header("ETag", f'"{server.etags[url.path]}"')
+                self.end_headers()
+                if body:
+                    with open(path, "rb") as file:
+                        file.seek(start)
+                        self.wfile.write(file.read(end - start))
+
+            def log_message(self, *args) -> None:  # noqa
+                pass
+
+        self.lock = Lock()
+        self.etags: dict = {}
+        self._secret = os.urandom(16)
+        self._random = random.Random(0)
+        self._dir = tempfile.TemporaryDirectory()
+        super().__init__(Handler)
+
+    def get_path(self, path: str) -> str:
+        return os.path.join(self._dir.name, path.strip("/").replace("/", "_"))
+
+    def get_signature(self, path: str) -> str:
+        return hashlib.sha256(self._secret + path.encode()).hexdigest()
+
+    def sign(self, url: str) -> str:
+        """Return the URL to download an object, like ToDus signs it."""
+        return f"{url}?sig={self.get_signature(urlsplit(url).path)}"
+
+    def corrupt(self, url: str, size: int = None) -> None:
+        """Damage a byte at a random offset of an object, or truncate it.
+
+        The ETag is updated, like if the object was damaged on its way
+        to the server.
+        """
+        key = url[len(self.url) :]
+        path = self.get_path(key)
+        with open(path, "r+b") as file:
+            if size is not None:
+                file.truncate(size)
+            else:
+                offset = self._random.randrange(os.fstat(file.fileno()).st_size)
+                file.seek(offset)
+                byte = file.read(1)
+                file.seek(offset)
+                file.write(bytes([byte[0] ^ 0xFF]))
+        with open(path, "rb") as file, self.lock:
+            self.etags[key] = hashlib.md5(file.read()).hexdigest()
+
+    def close(self) -> None:
+        super().close()
+        self._dir.cleanup()
+
+
+class FakeToDusClient:
+    """Drop-in replacement of ``todus.client.ToDusClient``.
+
+    Configure the class attributes before use: ``s3`` is the S3Server
+    where parts are stored, ``latency`` is added to every request,
+    ``bandwidth`` (bytes/s) limits uploads, ``failure_rate`` is the
+    probability of an upload failing with a connection error and
+    ``corrupt_rate`` the probability of an uploaded part being damaged.
+    """
+
+    s3: S3Server = None
+    latency = 0.0
+    bandwidth = 0.0
+    failure_rate = 0.0
+    corrupt_rate = 0.0
+    logins = 0
+    uploads = 0
+    _lock = Lock()
+    _random = random.Random(0)
+
+    def __init__(self, *args, **kwargs) -> None:
+        self.session = requests.Session()
+        self._aborted = False
+
+    def abort(self) -> None:
+        self._aborted = True
+        self.session.close()
+
+    def request_code(self, phone: str) -> None:
+        time.sleep(self.latency)
+
+    def validate_code(self, phone: str, code: str) -> str:
+        time.sleep(self.latency)
+        return "password-" + phone
+
+    def login(self, phone: str, password: str) -> str:
+        time.sleep(self.latency)
+        with self._lock:
+            type(self).logins += 1
+        payload = json.dumps({"username": phone, "exp": int(time.time()) + 3600})
+        encoded = base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+        return f"header.{encoded}.signature"
+
+    def upload_file(self, token: str, data, size: int = None) -> str:
+        time.sleep(self.latency)
+        with self._lock:
+            type(self).uploads += 1
+            failed = self._random.random() < self.failure_rate
+            corrupt = self._random.random() < self.corrupt_rate
+        if failed:
+            raise requests.ConnectionError("simulated upload failure")
+        size = size if size is not None else len(data)
+        if self.bandwidth:
+            time.sleep(size / self.bandwidth)
+        name = "%032x" % self._random.getrandbits(128)
+        url = f"{self.s3.url}/{name}"
+        with self.session.put(
+            url, data=data, headers={"content-length": str(size)}
+        ) as r:
+            r.raise_for_status()
+        if corrupt:
+            self.s3.corrupt(url)
+        return url
+
+    def download_file(self, token: str, url: str, path: str) -> int:
+        time.sleep(self.latency)
+        with self.session.get(self.s3.sign(url), stream=True) as r:
+            r.raise_for_status()
+            size = 0
+            with open(path, "wb") as file:
+                for chunk in r.iter_content(chunk_size=64 * 1024):
+                    file.write(chunk)
+                    size += len(chunk)
+        return size
@@ -0,0 +1,89 @@
+import io
+import os
+
+import py7zr
+import pytest
+from fakes import file_content
+
+from simplebot_todus.archive import HEADER_VOLUME, VolumeWriter
+
+
+def _write_archive(tmp_path, files: dict, volume_size: int) -> tuple:
+    published = []
+    writer = VolumeWriter(
+        str(tmp_path / "out.7z"),
+        volume_size,
+        lambda index, path: published.append((index, path)),
+    )
+    with py7zr.SevenZipFile(
+        writer, "w", filters=[{"id": py7zr.FILTER_COPY}]
+    ) as archive:
+        for name, data in files.items():
+            path = tmp_path / name
+            path.write_bytes(data)
+            archive.write(str(path), name)
+    before_close = list(published)
+    writer.close()
+    assert writer.volumes == len(published)
+    return before_close, published
+
+
+class TestVolumeWriter:
+    def test_round_trip(self, tmp_path) -> None:
+        files = {
+            "a.bin": file_content(1, 0, 300 * 1024),
+            "b.bin": file_content(2, 0, 150 * 1024),
+        }
+        before_close, published = _write_archive(tmp_path, files, 64 * 1024)
+        count = len(published)
+        assert count > 3
+        # volumes are published as soon as they are complete, except the
+        # header volume that is rewritten when the archive is closed
+        assert [index for index, _ in before_close] == list(range(2, count))
+        assert [index for index, _ in published[len(before_close) :]] == [
+            HEADER_VOLUME,
+            count,
+        ]
+        for index, path in published:
+            assert os.path.getsize(path) == 64 * 1024 or index == count
+
+        data = b"".join(open(path, "rb").read() for _, path in sorted(published))
+        out = tmp_path / "extracted"
+        with py7zr.SevenZipFile(io.BytesIO(data)) as archive:
+            archive.extractall(str(out))
+        for name, content in files.items():
+            assert (out / name).read_bytes() == content
+
+    def test_single_volume(self, tmp_path) -> None:
+        _, published = _write_archive(tmp_path, {"a.txt": b"hello"}, 1024 * 1024)
+        assert [index for index, _ in published] == [HEADER_VOLUME]
+
+    def test_published_volume_is_read_only(self, tmp_path) -> None:
+        published = []
+        writer = VolumeWriter(
+            str(tmp_path / "out.7z"), 10, lambda *args: published.append(args)
+        )
+        writer.write(b"x" * 35)
+        assert [index for index, _ in published] == [2, 3]
+        # the header volume can still be rewritten
+        writer.seek(0)
+        writer.write(b"y" * 10)
+        writer.seek(15)
+        with pytest.raises(io.UnsupportedOperation):
+            writer.write(b"z")
+        writer.seek(0, io.SEEK_END)
+        writer.write(b"w" * 5)
+        writer.close()
+        assert [index for index, _ in published] == [2, 3, 1, 4]
+        assert (tmp_path / "out.7z.0001").read_bytes() == b"y" * 10
+        assert (tmp_path / "out.7z.0004").read_bytes() == b"x" * 5 + b"w" * 5
+
+    def test_discard(self, tmp_path) -> None:
+        published = []
+        writer = VolumeWriter(
+            str(tmp_path / "out.7z"), 10, lambda *args: published.append(args)
+        )
+        writer.write(b"x" * 15)
+        writer.discard()
+        assert [index for index, _ in published] == []
+        assert writer.closed
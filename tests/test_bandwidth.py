@@ -0,0 +1,94 @@
+import time
+
+import pytest
+
+from simplebot_todus.bandwidth import (
+    MIN_RATE,
+    BandwidthManager,
+    TokenBucket,
+    allocate,
+)
+
+MB = 1024 * 1024
+
+
+class TestAllocate:
+    def test_proportional(self) -> None:
+        shares = allocate(3 * MB, {1: 1, 2: 2}, {})
+        assert shares == {1: pytest.approx(MB), 2: pytest.approx(2 * MB)}
+
+    def test_max_min_fair(self) -> None:
+        # 1 only needs 0.5MB/s, the rest is split between the others
+        shares = allocate(3 * MB, {1: 1, 2: 1, 3: 1}, {1: MB / 2})
+        assert shares[1] == pytest.approx(MB / 2)
+        assert shares[2] == shares[3] == pytest.approx(1.25 * MB)
+        assert sum(shares.values()) == pytest.approx(3 * MB)
+
+    def test_cascade(self) -> None:
+        # once 1 is capped, 2 needs less than its new share too
+        shares = allocate(4 * MB, {1: 1, 2: 1, 3: 1, 4: 1}, {1: MB / 4, 2: 1.2 * MB})
+        assert shares[1] == pytest.approx(MB / 4)
+        assert shares[2] == pytest.approx(1.2 * MB)
+        assert shares[3] == shares[4] == pytest.approx(1.275 * MB)
+
+    def test_min_rate(self) -> None:
+        shares = allocate(MIN_RATE, {key: 1 for key in range(10)}, {0: 1})
+        assert all(share >= MIN_RATE for share in shares.values())
+
+    def test_empty(self) -> None:
+        assert allocate(MB, {}, {}) == {}
+
+
+class TestBandwidthManager:
+    def test_unlimited(self) -> None:
+        manager = BandwidthManager()
+        assert manager.split({1: (1, MB, 0), 2: (1, MB, 0)}) == {1: 0, 2: 0}
+
+    def test_split(self) -> None:
+        manager = BandwidthManager(4 * MB)
+        rates = manager.split({1: (1, 0, 0), 2: (3, 0, 0)})
+        assert rates == {1: pytest.approx(MB), 2: pytest.approx(3 * MB)}
+
+    def test_slow_transfer(self) -> None:
+        manager = BandwidthManager(4 * MB)
+        # 1 is limited by its origin, it keeps a margin to grow
+        rates = manager.split({1: (1, MB / 4, 2 * MB), 2: (1, 2 * MB, 2 * MB)})
+        assert rates[1] == pytest.approx(MB / 4 * 1.25 + MIN_RATE)
+        assert rates[2] == pytest.approx(4 * MB - rates[1])
+
+    def test_backoff_and_recover(self) -> None:
+        manager = BandwidthManager(4 * MB)
+        manager.backoff(2 * MB)
+        assert manager.get_budget() == pytest.approx(1.4 * MB)
+        manager.backoff(0)
+        assert manager.get_budget() == pytest.approx(0.98 * MB)
+        for _ in range(100):
+            manager.recover(MB)
+        assert manager.ceiling is None
+        assert manager.get_budget() == 4 * MB
+
+    def test_backoff_unlimited(self) -> None:
+        manager = BandwidthManager()
+        manager.backoff(MB)
+        assert manager.get_budget() == pytest.approx(0.7 * MB)
+        manager.recover(MB)
+        assert manager.get_budget() == pytest.approx(0.77 * MB)
+        while manager.ceiling is not None:
+            manager.recover(MB / 4)
+        assert manager.get_budget() == 0
+
+
+class TestTokenBucket:
+    def test_unlimited(self) -> None:
+        bucket = TokenBucket()
+        assert bucket.consume(10 * MB) == 0
+
+    def test_rate(self) -> None:
+        bucket = TokenBucket(MB)
+        time.sleep(0.1)
+        # unused bytes of the last second are sent at once
+        assert bucket.consume(MB // 20) == 0
+        wait = bucket.consume(MB)
+        assert 0.5 < wait <= 1
+        bucket.rate = 0
+        assert bucket.consume(MB) == 0
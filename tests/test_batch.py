@@ -0,0 +1,128 @@
+import hashlib
+import logging
+import os
+import time
+
+import pytest
+from fakes import OriginServer, file_content
+
+import simplebot_todus as plugin
+from simplebot_todus.errors import FileTooBig
+from simplebot_todus.util import parse_urls
+from simplebot_todus.workers import WorkerPool
+
+MB = 1024 * 1024
+
+
+class FakeBot:
+    logger = logging.getLogger("test")
+
+    def __init__(self, settings: dict, admin: bool = False) -> None:
+        self.settings = settings
+        self.admin = admin
+
+    def get(self, key: str, default=None, scope: str = None):
+        return self.settings.get(key, default)
+
+    def set(self, key: str, value, scope: str = None) -> None:
+        pass
+
+    def is_admin(self, addr: str) -> bool:
+        return self.admin
+
+
+@pytest.fixture(scope="module")
+def origin():
+    server = OriginServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture(scope="module")
+def slow_origin():
+    server = OriginServer(bandwidth=MB)
+    yield server
+    server.close()
+
+
+@pytest.fixture(scope="module", autouse=True)
+def workers():
+    pool = WorkerPool(size=3, max_jobs=100)
+    old, plugin.workers = plugin.workers, pool
+    yield pool
+    plugin.workers = old
+
+
+def _download_batch(urls: list, folder: str, max_size: int, admin: bool = False):
+    bot = FakeBot({"max_size": str(max_size), "batch_downloads": "3"}, admin)
+    d = plugin.Download("a@example.org", 1)
+    return d, plugin._download_batch(bot, d, 1, urls, folder)
+
+
+class TestParseUrls:
+    def test_split(self) -> None:
+        text = "https://example.org/a\nhttps://example.org/b  example.org/c"
+        assert parse_urls(text) == [
+            "https://example.org/a",
+            "https://example.org/b",
+            "example.org/c",
+        ]
+
+    def test_duplicates(self) -> None:
+        urls = parse_urls(
+            "https://example.org/a?x=1&y=2 HTTPS://EXAMPLE.ORG:443/a?y=2&x=1"
+            " https://youtu.be/abc https://www.youtube.com/watch?v=abc"
+        )
+        assert urls == ["https://example.org/a?x=1&y=2", "https://youtu.be/abc"]
+
+
+class TestBatch:
+    def test_batch(self, origin, tmp_path) -> None:
+        sizes = [1000, 2 * MB, 5000]
+        urls = [
+            origin.get_url(1, sizes[0], "file.bin"),
+            origin.get_url(2, sizes[1], "file.bin"),
+            origin.get_url(3, sizes[2], filename="../../x.bin"),
+        ]
+        folder = tmp_path / "download"
+        _, result = _download_batch(urls, str(folder), 10 * MB)
+        filename, path, size, _, validator = result
+        assert filename == "archivos-1"
+        assert size == sum(sizes)
+        assert validator is None
+        files = {
+            "file.bin": file_content(1, 0, sizes[0]),
+            "file (2).bin": file_content(2, 0, sizes[1]),
+            "x.bin": file_content(3, 0, sizes[2]),
+        }
+        assert sorted(os.listdir(path)) == sorted(files)
+        for name, data in files.items():
+            with open(os.path.join(path, name), "rb") as file:
+                assert file.read() == data
+        assert not (tmp_path / "x.bin").exists()
+
+    def test_shared_budget(self, origin, tmp_path) -> None:
+        # every file fits in max_size, but not all of them together
+        urls = [origin.get_url(i, 4 * MB) for i in range(1, 4)]
+        with pytest.raises(FileTooBig):
+            _download_batch(urls, str(tmp_path / "download"), 10 * MB)
+        _, result = _download_batch(
+            urls, str(tmp_path / "download"), 10 * MB, admin=True
+        )
+        assert result[2] == 12 * MB
+
+    def test_first_error(self, origin, slow_origin, tmp_path) -> None:
+        urls = [slow_origin.get_url(1, 30 * MB), f"{origin.url}/missing"]
+        start = time.monotonic()
+        with pytest.raises(Exception) as info:
+            _download_batch(urls, str(tmp_path / "download"), 100 * MB)
+        assert "404" in str(info.value)
+        # the slow download is killed instead of waited for
+        assert time.monotonic() - start < 15
+
+    def test_digest(self, origin, tmp_path) -> None:
+        url = origin.get_url(1, 1000)
+        _, result = _download_batch([url], str(tmp_path / "download"), MB)
+        data = file_content(1, 0, 1000)
+        expected = "file.bin\t" + hashlib.sha256(data).hexdigest()
+        assert result[3] == hashlib.sha256(expected.encode()).hexdigest()
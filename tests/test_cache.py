@@ -0,0 +1,210 @@
+import hashlib
+import logging
+import time
+
+import pytest
+from fakes import OriginServer, file_content
+
+import simplebot_todus as plugin
+from simplebot_todus.db import DBManager
+from simplebot_todus.scheduler import Scheduler
+from simplebot_todus.spool import Spool
+from simplebot_todus.util import get_urls_key, normalize_url, parse_urls
+from simplebot_todus.workers import WorkerPool
+
+
+class FakeBot:
+    logger = logging.getLogger("test")
+
+    def __init__(self, settings: dict = None) -> None:
+        self.settings = settings or {}
+
+    def get(self, key: str, default=None, scope: str = None):
+        return self.settings.get(key, default)
+
+    def set(self, key: str, value, scope: str = None) -> None:
+        self.settings[key] = value
+
+    def is_admin(self, addr: str) -> bool:
+        return False
+
+
+class FakeContact:
+    addr = "a@example.org"
+
+
+class FakeMessage:
+    id = 1
+
+    def get_sender_contact(self) -> FakeContact:
+        return FakeContact()
+
+
+class RecordingReplies:
+    sent: list = []
+
+    def __init__(self, message, logger=None) -> None:
+        self.replies: list = []
+
+    def add(self, text: str = None, **kwargs) -> None:
+        self.replies.append(dict(kwargs, text=text))
+
+    def send_reply_messages(self) -> None:
+        self.sent.extend(self.replies)
+
+
+@pytest.fixture(scope="module")
+def origin():
+    server = OriginServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    db = DBManager(str(tmp_path / "sqlite.db"))
+    monkeypatch.setattr(plugin, "db", db)
+    return db
+
+
+class TestNormalizeUrl:
+    @pytest.mark.parametrize(
+        "url,expected",
+        [
+            ("example.org", "http://example.org/"),
+            ("HTTP://Example.ORG:80/a", "http://example.org/a"),
+            ("https://example.org:443/a?b=2&a=1#top", "https://example.org/a?a=1&b=2"),
+            ("https://example.org:8443/A", "https://example.org:8443/A"),
+            ("https://example.org/?a=&b=1", "https://example.org/?a=&b=1"),
+            ("https://www.youtube.com/watch?v=abc_-1&t=10", "yt:abc_-1"),
+            ("https://m.youtube.com/watch?v=abc", "yt:abc"),
+            ("https://youtu.be/abc", "yt:abc"),
+            ("https://youtu.be/abc/", "yt:abc"),
+        ],
+    )
+    def test_normalize(self, url: str, expected: str) -> None:
+        assert normalize_url(url) == expected
+
+    @pytest.mark.parametrize(
+        "url",
+        [
+            "https://www.youtube.com/watch?v=",
+            "https://www.youtube.com/watch?v=&list=abc",
+            "https://youtu.be/",
+            "https://youtu.be/abc/def",
+        ],
+    )
+    def test_no_video_id(self, url: str) -> None:
+        with pytest.raises(ValueError):
+            normalize_url(url)
+        with pytest.raises(ValueError):
+            parse_urls(f"https://example.org {url}")
+
+    def test_s3_get(self, db) -> None:
+        db.add_account("a@example.org", "5355555555", "password")
+        replies = RecordingReplies(None)
+        plugin.s3_get(FakeBot(), "https://youtu.be/", FakeMessage(), replies)
+        assert replies.replies[0]["text"].startswith("❌ El enlace de YouTube")
+
+    def test_urls_key(self) -> None:
+        assert get_urls_key(["https://b.org", "https://A.org"]) == (
+            "https://a.org/\nhttps://b.org/"
+        )
+
+
+class TestCacheDB:
+    def test_ttl(self, db) -> None:
+        db.add_cached(["a", "b"], "a.bin", 10, "parts", '"etag"', 100)
+        assert db.get_cached("a", 100)["filename"] == "a.bin"
+        assert db.get_cached("b", 100)["validator"] == '"etag"'
+        assert db.get_cached("a", 101) is None
+        db.touch_cached("a", 200, created=150)
+        assert db.get_cached("a", 101)["last_used"] == 200
+        assert db.get_cached("b", 101) is None
+
+    def test_evict(self, db) -> None:
+        for i in range(5):
+            db.add_cached([str(i)], "a.bin", 10, "parts", None, 100 + i)
+        db.touch_cached("1", 200)
+        # 0 is expired, 2 is the least recently used of the rest
+        db.evict_cached(100.5, 3)
+        assert [k for k in "01234" if db.get_cached(k, 0)] == ["1", "3", "4"]
+
+    def test_get_cached(self, db) -> None:
+        bot = FakeBot({"cache_ttl": "60"})
+        now = time.time()
+        db.add_cached(["new"], "a.bin", 10, "parts", None, now - 30)
+        db.add_cached(["old"], "a.bin", 10, "parts", None, now - 90)
+        assert plugin._get_cached(bot, "new")["last_used"] == now - 30
+        assert db.get_cached("new", 0)["last_used"] >= now
+        assert plugin._get_cached(bot, "old") is None
+
+    def test_add_cached(self, db) -> None:
+        bot = FakeBot({"cache_ttl": "60", "cache_size": "2"})
+        job = dict(filename="a.bin", size=10, validator=None)
+        for key in "abc":
+            plugin._add_cached(bot, [key], job, "parts")
+        assert [k for k in "abc" if db.get_cached(k, 0)] == ["b", "c"]
+
+
+class TestRevalidate:
+    def test_revalidate(self, db, origin) -> None:
+        url = origin.get_url(7, 1000)
+        key = get_urls_key([url])
+        db.add_cached([key], "file.bin", 1000, "parts", '"7-1000"', 100)
+        cached = plugin._revalidate_cached(FakeBot(), key, url)
+        assert cached["parts"] == "parts"
+        # the entry is valid again for cache_ttl seconds
+        assert db.get_cached(key, time.time() - 10)
+
+    def test_changed(self, db, origin) -> None:
+        url = origin.get_url(7, 1000)
+        key = get_urls_key([url])
+        db.add_cached([key], "file.bin", 1000, "parts", '"7-999"', 100)
+        assert plugin._revalidate_cached(FakeBot(), key, url) is None
+        assert db.get_cached(key, 101) is None
+
+    def test_no_validator(self, db, origin) -> None:
+        url = origin.get_url(7, 1000)
+        key = get_urls_key([url])
+        db.add_cached([key], "file.bin", 1000, "parts", None, 100)
+        assert plugin._revalidate_cached(FakeBot(), key, url) is None
+        url = "https://youtu.be/abc"
+        db.add_cached(["yt:abc"], "video.mp4", 1000, "parts", '"etag"', 100)
+        assert plugin._revalidate_cached(FakeBot(), "yt:abc", url) is None
+
+
+class TestContentHit:
+    def test_same_content(self, db, origin, tmp_path, monkeypatch) -> None:
+        """A new URL with already uploaded content is answered from the cache."""
+
+        def upload(*args) -> dict:
+            raise AssertionError("the file was uploaded again")
+
+        pool = WorkerPool(size=1, max_jobs=10)
+        monkeypatch.setattr(plugin, "workers", pool)
+        monkeypatch.setattr(plugin, "spool", Spool(str(tmp_path / "spool"), 0))
+        monkeypatch.setattr(
+            plugin, "scheduler", Scheduler(1, 1, {"download": 1}, default_weight=1)
+        )
+        monkeypatch.setattr(plugin, "Replies", RecordingReplies)
+        monkeypatch.setattr(plugin, "_upload", upload)
+        RecordingReplies.sent.clear()
+        bot = FakeBot()
+        addr = "a@example.org"
+        db.add_account(addr, "5355555555", "password")
+        digest = hashlib.sha256(file_content(7, 0, 1000)).hexdigest()
+        db.add_cached(["sha256:" + digest], "old.bin", 1000, "parts", None, time.time())
+        url = origin.get_url(7, 1000, "new.bin")
+        job_id = db.add_job(addr, url, 1)
+        plugin.jobs.add(plugin.Download(addr, job_id))
+        plugin._process_request(bot, FakeMessage(), job_id, time.monotonic())
+        assert len(RecordingReplies.sent) == 1
+        reply = RecordingReplies.sent[0]
+        assert reply["text"].startswith("new.bin")
+        assert reply["bytefile"].read() == b"parts"
+        assert db.get_job(job_id)["state"] == "done"
+        assert plugin.jobs.get(job_id) is None
+        # the URL is cached too
+        assert db.get_cached(get_urls_key([url]), 0)["parts"] == "parts"
+        assert not (tmp_path / "spool" / str(job_id)).exists()
@@ -0,0 +1,147 @@
+import sqlite3
+from threading import Barrier, Thread
+
+import pytest
+
+from simplebot_todus.db import DBManager
+
+
+@pytest.fixture
+def db(tmp_path):
+    return DBManager(str(tmp_path / "sqlite.db"))
+
+
+class StaleConnection:
+    """Connection whose next account read returns the row from before
+    ``write`` runs, like a read racing with a write in another thread."""
+
+    def __init__(self, conn: sqlite3.Connection, write) -> None:
+        self.conn = conn
+        self.write = write
+
+    def execute(self, sql: str, *args):
+        cursor = self.conn.execute(sql, *args)
+        if not sql.startswith("SELECT * FROM accounts") or self.write is None:
+            return cursor
+        row = cursor.fetchone()
+        write, self.write = self.write, None
+        write()
+        return StaleCursor(row)
+
+    def __enter__(self):
+        return self.conn.__enter__()
+
+    def __exit__(self, *args):
+        return self.conn.__exit__(*args)
+
+
+class StaleCursor:
+    def __init__(self, row) -> None:
+        self.row = row
+
+    def fetchone(self):
+        return self.row
+
+
+class TestAccounts:
+    def test_unknown_cached(self, db) -> None:
+        assert db.get_account("a@example.org") is None
+        # written behind the back of the cache
+        with sqlite3.connect(db.db_path) as conn:
+            conn.execute(
+                "INSERT INTO accounts VALUES (?,?,?)", ("a@example.org", "53", "")
+            )
+        assert db.get_account("a@example.org") is None
+        db.delete_account("b@example.org")
+        assert db.get_account("a@example.org") is None
+        db._forget_account("a@example.org")
+        assert db.get_account("a@example.org")["phone"] == "53"
+
+    def test_add_account(self, db) -> None:
+        assert db.get_account("a@example.org") is None
+        db.add_account("a@example.org", "5355555555")
+        acc = db.get_account("a@example.org")
+        assert (acc["phone"], acc["password"]) == ("5355555555", "")
+        with pytest.raises(sqlite3.IntegrityError):
+            db.add_account("a@example.org", "5355555556")
+        assert db.get_account("a@example.org")["phone"] == "5355555555"
+
+    def test_set_password(self, db) -> None:
+        db.add_account("a@example.org", "5355555555")
+        assert db.get_account("a@example.org")["password"] == ""
+        db.set_password("a@example.org", "secret")
+        assert db.get_account("a@example.org")["password"] == "secret"
+
+    def test_delete_account(self, db) -> None:
+        db.add_account("a@example.org", "5355555555", "secret")
+        assert db.get_account("a@example.org")
+        db.delete_account("a@example.org")
+        assert db.get_account("a@example.org") is None
+
+    def test_lru(self, tmp_path) -> None:
+        db = DBManager(str(tmp_path / "sqlite.db"), cache_size=2)
+        for addr in "abc":
+            db.add_account(addr, "53")
+        db.get_account("a")
+        db.get_account("b")
+        db.get_account("a")
+        db.get_account("c")
+        assert list(db._accounts) == ["a", "c"]
+
+    def test_stale_read(self, db) -> None:
+        """A row read before a write to the account is not cached."""
+        db.add_account("a@example.org", "5355555555")
+        db._local.conn = StaleConnection(
+            db.db, lambda: db.set_password("a@example.org", "secret")
+        )
+        assert db.get_account("a@example.org")["password"] == ""
+        assert db.get_account("a@example.org")["password"] == "secret"
+
+
+class TestThreads:
+    def test_connections(self, db) -> None:
+        conns = []
+
+        def get_conn() -> None:
+            conns.append(db.db)
+            conns.append(db.db)
+
+        threads = [Thread(target=get_conn) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len({id(conn) for conn in conns}) == 3
+        assert db.db not in conns
+
+    def test_concurrent(self, db) -> None:
+        barrier = Barrier(8)
+        errors = []
+
+        def worker(n: int) -> None:
+            try:
+                barrier.wait()
+                for i in range(20):
+                    addr = f"user{n}-{i}@example.org"
+                    db.add_account(addr, "53")
+                    assert db.get_account(addr)["password"] == ""
+                    db.set_password(addr, f"secret{i}")
+                    assert db.get_account(addr)["password"] == f"secret{i}"
+                    job_id = db.add_job(addr, "https://example.org", i)
+                    db.add_part(job_id, 1, "a.7z.0001", "http://s3/1", "md5")
+                    if i % 2:
+                        db.delete_account(addr)
+                        assert db.get_account(addr) is None
+            except Exception as ex:  # noqa
+                errors.append(ex)
+
+        threads = [Thread(target=worker, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors
+        assert len(db.get_jobs(["queued"])) == 8 * 20
+        count = db.db.execute("SELECT COUNT(*) FROM accounts").fetchone()[0]
+        assert count == 8 * 10
+        assert db.get_account("user0-0@example.org")["password"] == "secret0"
@@ -0,0 +1,120 @@
+import hashlib
+import os
+
+import pytest
+import requests
+from fakes import OriginServer, file_content
+
+from simplebot_todus.errors import FileTooBig
+from simplebot_todus.util import MIN_SEGMENT_SIZE, download_file, safe_filename
+
+
+@pytest.fixture(scope="module")
+def origin():
+    server = OriginServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def server():
+    server = OriginServer()
+    yield server
+    server.close()
+
+
+class TestDownload:
+    @pytest.mark.parametrize(
+        "size,segments",
+        [
+            (0, 4),
+            (1000, 4),
+            (MIN_SEGMENT_SIZE, 4),
+            (MIN_SEGMENT_SIZE * 3 + 12345, 4),
+            (MIN_SEGMENT_SIZE * 2 + 1, 1),
+        ],
+    )
+    def test_download(self, origin, tmp_path, size: int, segments: int) -> None:
+        url = origin.get_url(7, size, "file.bin")
+        filename, path, got_size, digest, validator = download_file(
+            url, str(tmp_path), size, False, segments
+        )
+        data = file_content(7, 0, size)
+        assert filename == "file.bin"
+        assert got_size == size
+        assert digest == hashlib.sha256(data).hexdigest()
+        assert validator == f'"7-{size}"'
+        with open(path, "rb") as file:
+            assert file.read() == data
+
+    def test_too_big(self, origin, tmp_path) -> None:
+        url = origin.get_url(7, MIN_SEGMENT_SIZE * 2)
+        with pytest.raises(FileTooBig):
+            download_file(url, str(tmp_path), MIN_SEGMENT_SIZE, False)
+        download_file(url, str(tmp_path), MIN_SEGMENT_SIZE, True)
+
+    @pytest.mark.parametrize("size", [1000, MIN_SEGMENT_SIZE * 2])
+    def test_hostile_filename(self, origin, tmp_path, size: int) -> None:
+        (tmp_path / "sqlite.db").write_bytes(b"accounts")
+        folder = tmp_path / "spool" / "download"
+        folder.mkdir(parents=True)
+        url = origin.get_url(7, size, filename="../../sqlite.db")
+        filename, path, *_ = download_file(url, str(folder), size, False)
+        assert filename == "sqlite.db"
+        assert os.path.dirname(path) == str(folder)
+        assert (tmp_path / "sqlite.db").read_bytes() == b"accounts"
+
+    def test_weak_etag(self, server, tmp_path) -> None:
+        server.weak_etag = True
+        size = MIN_SEGMENT_SIZE * 3
+        url = server.get_url(7, size)
+        _, path, _, digest, validator = download_file(url, str(tmp_path), size, False)
+        assert validator == f'W/"7-{size}"'
+        assert digest == hashlib.sha256(file_content(7, 0, size)).hexdigest()
+        # the segments are sent If-Range with Last-Modified, not the weak ETag
+        assert server.statuses == [206] * 3
+
+    def test_segment_errors(self, server, tmp_path) -> None:
+        server.range_failures = 2
+        size = MIN_SEGMENT_SIZE * 3
+        url = server.get_url(7, size)
+        digest = download_file(url, str(tmp_path), size, False)[3]
+        assert digest == hashlib.sha256(file_content(7, 0, size)).hexdigest()
+        assert server.statuses.count(503) == 2
+
+    def test_segment_not_found(self, server, tmp_path) -> None:
+        server.range_failures = 1
+        server.range_status = 404
+        url = server.get_url(7, MIN_SEGMENT_SIZE * 2)
+        with pytest.raises(requests.HTTPError):
+            download_file(url, str(tmp_path), MIN_SEGMENT_SIZE * 2, False)
+        assert server.statuses.count(404) == 1
+
+    def test_ranges_ignored(self, server, tmp_path) -> None:
+        server.honor_ranges = False
+        size = MIN_SEGMENT_SIZE * 3
+        url = server.get_url(7, size)
+        _, path, got_size, digest, _ = download_file(url, str(tmp_path), size, False)
+        data = file_content(7, 0, size)
+        assert got_size == size
+        assert digest == hashlib.sha256(data).hexdigest()
+        with open(path, "rb") as file:
+            assert file.read() == data
+        assert server.statuses[-1] == 200
+
+
+@pytest.mark.parametrize(
+    "name,expected",
+    [
+        ("file.bin", "file.bin"),
+        ("../../sqlite.db", "sqlite.db"),
+        ("..\\..\\sqlite.db", "sqlite.db"),
+        ("/etc/passwd", "passwd"),
+        ("a/..", ""),
+        ("..", ""),
+        (" name\x00.txt ", "name.txt"),
+        ("a" * 300 + ".txt", "a" * 196 + ".txt"),
+    ],
+)
+def test_safe_filename(name: str, expected: str) -> None:
+    assert safe_filename(name) == expected
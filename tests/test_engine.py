@@ -0,0 +1,85 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+import pytest
+
+from simplebot_todus.engine import Engine
+
+
+@pytest.fixture
+def engine():
+    engine = Engine(io_threads=2)
+    yield engine
+    engine.stop()
+
+
+class TestEngine:
+    def test_submit(self, engine) -> None:
+        async def task(value: int) -> tuple:
+            await asyncio.sleep(0)
+            return value, threading.current_thread().name
+
+        assert engine.submit(task(2)).result(timeout=5) == (2, "todus-engine")
+
+    def test_run(self, engine) -> None:
+        async def task() -> str:
+            return await engine.run(lambda: threading.current_thread().name)
+
+        assert engine.submit(task()).result(timeout=5).startswith("todus-io")
+
+    def test_error(self, engine) -> None:
+        async def task() -> None:
+            await engine.run(divmod, 1, 0)
+
+        with pytest.raises(ZeroDivisionError):
+            engine.submit(task()).result(timeout=5)
+
+    def test_loop_not_blocked(self, engine) -> None:
+        """Blocking calls don't stop the other coroutines."""
+        release = threading.Event()
+
+        async def blocked() -> None:
+            await engine.run(release.wait, 5)
+
+        async def ticker() -> int:
+            ticks = 0
+            for _ in range(5):
+                await asyncio.sleep(0.01)
+                ticks += 1
+            return ticks
+
+        fut = engine.submit(blocked())
+        assert engine.submit(ticker()).result(timeout=2) == 5
+        assert not fut.done()
+        release.set()
+        fut.result(timeout=5)
+
+    def test_cancel_running(self, engine) -> None:
+        """A cancelled coroutine waits for its blocking call to return."""
+        started = threading.Event()
+        events: list = []
+
+        def call() -> None:
+            started.set()
+            time.sleep(0.5)
+            events.append("returned")
+
+        async def task() -> None:
+            try:
+                await engine.run(call)
+            except asyncio.CancelledError:
+                events.append("cancelled")
+                raise
+            events.append("finished")
+
+        fut = engine.submit(task())
+        assert started.wait(5)
+        fut.cancel()
+        with pytest.raises(concurrent.futures.CancelledError):
+            fut.result(timeout=5)
+        deadline = time.monotonic() + 5
+        while len(events) < 2 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert events == ["returned", "cancelled"]
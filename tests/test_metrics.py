@@ -0,0 +1,34 @@
+import requests
+
+from simplebot_todus.metrics import Metrics, serve
+
+
+class TestMetrics:
+    def test_render(self) -> None:
+        metrics = Metrics()
+        metrics.describe("jobs_total", "Finished jobs")
+        metrics.inc("jobs_total", result="done")
+        metrics.inc("jobs_total", 2, result="done")
+        metrics.observe("stage_seconds", 0.3, stage="upload")
+        metrics.gauge("queue_depth", lambda: 4)
+        text = metrics.render()
+        assert "# HELP jobs_total Finished jobs\n# TYPE jobs_total counter" in text
+        assert 'jobs_total{result="done"} 3' in text
+        assert 'stage_seconds_bucket{stage="upload",le="0.1"} 0' in text
+        assert 'stage_seconds_bucket{stage="upload",le="0.5"} 1' in text
+        assert 'stage_seconds_count{stage="upload"} 1' in text
+        assert "queue_depth 4" in text
+
+    def test_serve(self) -> None:
+        metrics = Metrics()
+        metrics.inc("jobs_total")
+        server = serve(metrics, 0)
+        try:
+            url = f"http://127.0.0.1:{server.server_address[1]}"
+            r = requests.get(url + "/metrics")
+            assert r.status_code == 200
+            assert "jobs_total 1" in r.text
+            assert requests.get(url + "/other").status_code == 404
+        finally:
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,61 @@
+from fakes import file_content
+
+from simplebot_todus.packing import (
+    ARCHIVE_OVERHEAD,
+    COMPRESS,
+    COPY,
+    DIRECT,
+    choose_method,
+    is_compressed,
+    plan_packing,
+    plan_parts,
+)
+
+MB = 1024 * 1024
+
+
+def _write(tmp_path, name: str, data: bytes) -> tuple:
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path), name
+
+
+class TestPacking:
+    def test_is_compressed(self, tmp_path) -> None:
+        path, _ = _write(tmp_path, "file", b"PK\x03\x04" + b"\x00" * 100)
+        assert is_compressed(path, "file")
+        path, _ = _write(tmp_path, "video.mp4", b"")
+        assert is_compressed(path, "video.mp4")
+        path, _ = _write(tmp_path, "notes.txt", b"hello")
+        assert not is_compressed(path, "notes.txt")
+
+    def test_choose_method(self, tmp_path) -> None:
+        text = _write(tmp_path, "notes.txt", b"hello world\n" * 100000)
+        assert choose_method([text])[0] == COMPRESS
+        random = _write(tmp_path, "data.bin", file_content(1, 0, MB))
+        assert choose_method([random]) == (COPY, 1.0)
+
+    def test_direct(self, tmp_path) -> None:
+        files = [_write(tmp_path, "data.bin", file_content(1, 0, MB))]
+        assert plan_packing(files, 15 * MB, 3, 0, 100 * 1024) == (DIRECT, 1, MB)
+        # a file bigger than a part is split in volumes
+        method, count, _ = plan_packing(files, MB // 2, 3, 0, 100 * 1024)
+        assert (method, count) == (COPY, 3)
+
+    def test_empty_file(self, tmp_path) -> None:
+        files = [_write(tmp_path, "empty.bin", b"")]
+        method, count, part_size = plan_packing(files, 15 * MB, 3, 0, 100 * 1024)
+        assert method == COPY
+        assert count == 1
+        assert part_size == ARCHIVE_OVERHEAD
+
+    def test_plan_parts(self) -> None:
+        # every part must fit in max_part_size
+        count, part_size = plan_parts(100 * MB, 15 * MB, 3, 20, 100 * 1024)
+        assert count >= 7
+        assert part_size * count >= 100 * MB
+        assert part_size <= 15 * MB
+        # without delay between uploads, parallel parts finish sooner
+        assert plan_parts(10 * MB, 15 * MB, 3, 0, 100 * 1024)[0] == 3
+        # a long delay makes a single part faster
+        assert plan_parts(10 * MB, 15 * MB, 3, 3600, 100 * 1024)[0] == 1
@@ -10,3 +10,11 @@ class TestPlugin:
     def test_get(self, mocker) -> None:
         msg = mocker.get_one_reply("/s3_get https://fsf.org")
         assert "No estás registrado" in msg.text
+
+    def test_status(self, mocker) -> None:
+        msg = mocker.get_one_reply("/s3_status")
+        assert "No tienes ninguna petición" in msg.text
+
+    def test_cancel(self, mocker) -> None:
+        msg = mocker.get_one_reply("/s3_cancel")
+        assert "No tienes ninguna petición" in msg.text
@@ -0,0 +1,217 @@
+import logging
+from threading import Barrier, Thread
+
+import pytest
+
+import simplebot_todus as plugin
+from simplebot_todus.registry import JobRegistry
+from simplebot_todus.scheduler import Scheduler
+
+MB = 1024 * 1024
+
+
+class Job:
+    def __init__(self, job_id: int, addr: str, state: str = "queued") -> None:
+        self.job_id = job_id
+        self.addr = addr
+        self.state = state
+
+
+class FakeBot:
+    logger = logging.getLogger("test")
+
+    def __init__(self, settings: dict, admins: tuple = ()) -> None:
+        self.settings = settings
+        self.admins = admins
+
+    def get(self, key: str, default=None, scope: str = None):
+        return self.settings.get(key, default)
+
+    def set(self, key: str, value, scope: str = None) -> None:
+        pass
+
+    def is_admin(self, addr: str) -> bool:
+        return addr in self.admins
+
+
+class FakeMessage:
+    pass
+
+
+class RecordingReplies:
+    def __init__(self) -> None:
+        self.texts: list = []
+
+    def add(self, text: str = None, **kwargs) -> None:
+        self.texts.append(text)
+
+
+def check_indexes(registry: JobRegistry) -> None:
+    """The indexes have exactly the registered jobs, without empty entries."""
+    jobs = registry._jobs
+    by_addr = {i: j for index in registry._by_addr.values() for i, j in index.items()}
+    by_state = {i: j for index in registry._by_state.values() for i, j in index.items()}
+    assert by_addr == jobs
+    assert by_state == jobs
+    for addr, index in registry._by_addr.items():
+        assert index and all(j.addr == addr for j in index.values())
+    for state, index in registry._by_state.items():
+        assert index and all(j.state == state for j in index.values())
+
+
+class TestJobRegistry:
+    def test_add_remove(self) -> None:
+        registry = JobRegistry()
+        jobs = [Job(3, "a"), Job(1, "a"), Job(2, "b", "uploading")]
+        for job in jobs:
+            registry.add(job)
+        with pytest.raises(ValueError):
+            registry.add(Job(1, "c"))
+        assert registry.get(1) is jobs[1]
+        assert registry.get_by_addr("a") == [jobs[1], jobs[0]]
+        assert registry.get_by_state("uploading", "queued") == [
+            jobs[1],
+            jobs[2],
+            jobs[0],
+        ]
+        assert registry.snapshot() == [jobs[1], jobs[2], jobs[0]]
+        assert registry.remove(1) is jobs[1]
+        assert registry.remove(1) is None
+        assert registry.get(1) is None
+        assert registry.remove(2) is jobs[2]
+        assert not registry.has_jobs("b")
+        assert registry.get_by_state("uploading") == []
+        assert registry.has_jobs("a")
+        check_indexes(registry)
+
+    def test_set_state(self) -> None:
+        registry = JobRegistry()
+        job = Job(1, "a")
+        registry.add(job)
+        assert registry.set_state(1, "downloading", expected=["queued"])
+        assert job.state == "downloading"
+        assert not registry.set_state(1, "downloading", expected=["queued"])
+        assert registry.set_state(1, "uploading")
+        assert registry.get_by_state("queued", "downloading") == []
+        assert registry.get_by_state("uploading") == [job]
+        assert not registry.set_state(2, "uploading")
+        check_indexes(registry)
+
+    def test_single_winner(self) -> None:
+        """Only one of the threads moving a job out of a state succeeds."""
+        registry = JobRegistry()
+        registry.add(Job(1, "a"))
+        barrier = Barrier(8)
+        results = []
+
+        def start() -> None:
+            barrier.wait()
+            results.append(registry.set_state(1, "downloading", expected=["queued"]))
+
+        threads = [Thread(target=start) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sorted(results) == [False] * 7 + [True]
+
+    def test_concurrent(self) -> None:
+        registry = JobRegistry()
+        states = ["queued", "downloading", "archiving", "uploading"]
+        errors = []
+
+        def worker(n: int) -> None:
+            try:
+                for i in range(200):
+                    job_id = n * 1000 + i
+                    registry.add(Job(job_id, f"user{i % 3}"))
+                    for old, new in zip(states, states[1:]):
+                        assert registry.set_state(job_id, new, expected=[old])
+                        registry.get_by_addr(f"user{i % 3}")
+                        registry.get_by_state(*states)
+                    if i % 2:
+                        registry.remove(job_id)
+            except Exception as ex:  # noqa
+                errors.append(ex)
+
+        threads = [Thread(target=worker, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors
+        assert len(registry.snapshot()) == 8 * 100
+        assert len(registry.get_by_state("uploading")) == 8 * 100
+        check_indexes(registry)
+
+
+class TestQuota:
+    @pytest.fixture
+    def registry(self, monkeypatch) -> JobRegistry:
+        registry = JobRegistry()
+        monkeypatch.setattr(plugin, "jobs", registry)
+        return registry
+
+    def _add(self, registry: JobRegistry, job_id: int, addr: str, size=None):
+        d = plugin.Download(addr, job_id)
+        d.expected_size = size
+        registry.add(d)
+        return d
+
+    def test_quota(self, registry) -> None:
+        bot = FakeBot({"max_size": str(10 * MB), "user_quota": str(30 * MB)})
+        assert plugin._has_quota(bot, "a")
+        self._add(registry, 1, "a", 12 * MB)
+        self._add(registry, 2, "a", 8 * MB)
+        # the next petition counts as half max_size
+        assert plugin._has_quota(bot, "a")
+        self._add(registry, 3, "a", 6 * MB)
+        assert not plugin._has_quota(bot, "a")
+        assert plugin._has_quota(bot, "b")
+        registry.remove(1)
+        assert plugin._has_quota(bot, "a")
+
+    def test_unknown_size(self, registry) -> None:
+        bot = FakeBot({"max_size": str(10 * MB), "user_quota": str(20 * MB)})
+        # every petition of unknown size counts as half max_size
+        for job_id in range(4):
+            self._add(registry, job_id, "a")
+        assert not plugin._has_quota(bot, "a")
+        registry.remove(0)
+        assert plugin._has_quota(bot, "a")
+
+    def test_downloaded_size(self, registry) -> None:
+        """The real size replaces the expected one once it is known."""
+        bot = FakeBot({"max_size": str(10 * MB), "user_quota": str(20 * MB)})
+        d = self._add(registry, 1, "a", 2 * MB)
+        assert plugin._has_quota(bot, "a")
+        d.size = 16 * MB
+        assert not plugin._has_quota(bot, "a")
+
+    def test_admin(self, registry) -> None:
+        bot = FakeBot({"max_size": str(10 * MB), "user_quota": "0"}, admins=("a",))
+        self._add(registry, 1, "a", 10 * MB)
+        assert plugin._has_quota(bot, "a")
+
+
+class TestJobsCommand:
+    def test_s3_jobs(self, monkeypatch) -> None:
+        registry = JobRegistry()
+        monkeypatch.setattr(plugin, "jobs", registry)
+        monkeypatch.setattr(
+            plugin, "scheduler", Scheduler(1, 1, {"download": 1}, default_weight=1)
+        )
+        registry.add(plugin.Download("a@example.org", 1))
+        registry.add(plugin.Download("b@example.org", 2, state="downloading"))
+        d = plugin.Download("c@example.org", 3, state="uploading")
+        d.parts = 2
+        registry.add(d)
+        replies = RecordingReplies()
+        plugin.s3_jobs(FakeMessage(), replies)
+        text = replies.texts[0]
+        assert "Descargando: 1, empaquetando: 0, subiendo: 1" in text
+        lines = text.split("\n\n")[-1].split("\n")
+        assert [line.split()[:3] for line in lines] == [
+            ["#2", "b@example.org", "⬇️"],
+            ["#3", "c@example.org", "⬆️"],
+        ]
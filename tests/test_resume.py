@@ -0,0 +1,146 @@
+import logging
+import os
+
+import pytest
+from fakes import file_content
+
+import simplebot_todus as plugin
+from simplebot_todus.db import DBManager
+from simplebot_todus.engine import Engine
+from simplebot_todus.packing import COPY, DIRECT
+from simplebot_todus.scheduler import Scheduler
+
+
+class FakeBot:
+    logger = logging.getLogger("test")
+
+    def get(self, key: str, default=None, scope: str = None):
+        return {"max_uploads": "2"}.get(key, default)
+
+    def set(self, key: str, value, scope: str = None) -> None:
+        pass
+
+
+@pytest.fixture
+def db(tmp_path):
+    return DBManager(str(tmp_path / "sqlite.db"))
+
+
+@pytest.fixture
+def uploader(db, monkeypatch):
+    """Replace the part upload with a function that records the parts."""
+    uploads = []
+
+    async def upload_part(bot, d, acc, job_id, i, path, name, verify):
+        uploads.append(i)
+        os.remove(path)
+        d.advance(1)
+        return f"http://s3/{i}", name, "md5"
+
+    engine = Engine(io_threads=2)
+    monkeypatch.setattr(plugin, "db", db)
+    monkeypatch.setattr(plugin, "engine", engine)
+    monkeypatch.setattr(
+        plugin, "scheduler", Scheduler(0, 1, {"archive": 1}, default_weight=1)
+    )
+    monkeypatch.setattr(plugin, "_upload_part", upload_part)
+    yield uploads
+    engine.stop()
+
+
+class TestJobs:
+    def test_jobs(self, db) -> None:
+        job_id = db.add_job("a@example.org", "https://example.org/a", 5)
+        other = db.add_job("b@example.org", "https://example.org/b", 6)
+        assert db.get_job(job_id)["state"] == "queued"
+        db.set_job_file(job_id, "a.bin", "/spool/a.bin", 10, "sha", "etag")
+        db.set_job_packing(job_id, COPY, 2, 5)
+        db.set_job_state(job_id, "uploading")
+        db.set_job_state(other, "done")
+        job = db.get_job(job_id)
+        assert (job["path"], job["method"], job["part_count"]) == (
+            "/spool/a.bin",
+            COPY,
+            2,
+        )
+        assert [j["id"] for j in db.get_jobs(["queued", "uploading"])] == [job_id]
+
+    def test_parts(self, db) -> None:
+        job_id = db.add_job("a@example.org", "https://example.org/a", 5)
+        db.add_part(job_id, 2, "a.7z.0002", "http://s3/2", "md5-2")
+        db.add_part(job_id, 1, "a.7z.0001", "http://s3/1", "md5-1")
+        db.add_part(job_id, 1, "a.7z.0001", "http://s3/1b", "md5-1b")
+        parts = db.get_parts(job_id)
+        assert [(p["number"], p["url"]) for p in parts] == [
+            (1, "http://s3/1b"),
+            (2, "http://s3/2"),
+        ]
+        db.set_job_state(job_id, "done")
+        db.delete_jobs(["done"])
+        assert db.get_job(job_id) is None
+        assert db.get_parts(job_id) == []
+
+
+class TestResume:
+    def test_skip_uploaded_parts(self, db, uploader, tmp_path) -> None:
+        path = tmp_path / "file.bin"
+        path.write_bytes(file_content(1, 0, 200 * 1024))
+        job_id = db.add_job("a@example.org", "https://example.org/a", 5)
+        job = dict(
+            id=job_id,
+            filename="file.bin",
+            path=str(path),
+            method=COPY,
+            part_count=4,
+            part_size=64 * 1024,
+        )
+        # the first run uploaded part 2 before it was interrupted
+        db.add_part(job_id, 2, "file.bin.7z.0002", "http://s3/old2", "md5-old")
+        d = plugin.Download("a@example.org", job_id, state="archiving")
+        d.step = 0
+        plugin.jobs.add(d)
+        try:
+            parts = plugin._upload(FakeBot(), d, {}, job, str(tmp_path / "parts"))
+        finally:
+            plugin.jobs.remove(job_id)
+        assert 2 not in uploader
+        assert sorted(uploader) == [i for i in sorted(parts) if i != 2]
+        assert parts[2] == ("http://s3/old2", "file.bin.7z.0002", "md5-old")
+        assert parts[1][1] == "file.bin.7z.0001"
+        assert d.step == len(parts)
+        assert not list((tmp_path / "parts").iterdir())
+
+    def test_spool_names(self, db, uploader, tmp_path, monkeypatch) -> None:
+        """The part files are named by the plugin, not by the origin server."""
+        paths = []
+
+        async def upload_part(bot, d, acc, job_id, i, path, name, verify):
+            paths.append(path)
+            os.remove(path)
+            d.advance(1)
+            return f"http://s3/{i}", name, "md5"
+
+        monkeypatch.setattr(plugin, "_upload_part", upload_part)
+        (tmp_path / "sqlite.db").write_bytes(b"accounts")
+        path = tmp_path / "download"
+        path.write_bytes(file_content(1, 0, 1000))
+        folder = tmp_path / "spool" / "parts"
+        job_id = db.add_job("a@example.org", "https://example.org/a", 5)
+        job = dict(
+            id=job_id,
+            filename="../../sqlite.db",
+            path=str(path),
+            method=DIRECT,
+            part_count=1,
+            part_size=1000,
+        )
+        d = plugin.Download("a@example.org", job_id, state="archiving")
+        d.step = 0
+        plugin.jobs.add(d)
+        try:
+            parts = plugin._upload(FakeBot(), d, {}, job, str(folder))
+        finally:
+            plugin.jobs.remove(job_id)
+        assert paths == [str(folder / "part.0001")]
+        assert parts[1][1] == "../../sqlite.db"
+        assert (tmp_path / "sqlite.db").read_bytes() == b"accounts"
@@ -0,0 +1,162 @@
+import asyncio
+import time
+
+import pytest
+import requests
+from todus.errors import AbortError
+
+from simplebot_todus.errors import CorruptUpload
+from simplebot_todus.retry import (
+    AUTH,
+    CORRUPT,
+    FATAL,
+    THROTTLE,
+    TRANSIENT,
+    CircuitBreaker,
+    RetryPolicy,
+    classify,
+)
+
+
+def _http_error(status: int, headers: dict = None) -> requests.HTTPError:
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    return requests.HTTPError(response=response)
+
+
+def _run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def _failing(errors: list):
+    calls = []
+
+    async def func():
+        calls.append(time.monotonic())
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return "ok"
+
+    return func, calls
+
+
+class TestClassify:
+    @pytest.mark.parametrize(
+        "ex,kind",
+        [
+            (_http_error(401), AUTH),
+            (_http_error(403), AUTH),
+            (_http_error(429), THROTTLE),
+            (_http_error(503), THROTTLE),
+            (_http_error(500), TRANSIENT),
+            (_http_error(408), TRANSIENT),
+            (_http_error(404), FATAL),
+            (requests.ConnectionError(), TRANSIENT),
+            (requests.Timeout(), TRANSIENT),
+            (ConnectionResetError(), TRANSIENT),
+            (requests.exceptions.InvalidURL(), FATAL),
+            (FileNotFoundError(), FATAL),
+            (CorruptUpload(), CORRUPT),
+            (AbortError(), FATAL),
+            (ValueError(), FATAL),
+            (KeyError(), FATAL),
+        ],
+    )
+    def test_classify(self, ex: Exception, kind: str) -> None:
+        assert classify(ex) == kind
+
+
+class TestCircuitBreaker:
+    def test_open(self) -> None:
+        breaker = CircuitBreaker(threshold=3, cooldown=60)
+        breaker.record_failure()
+        breaker.record_failure()
+        assert not breaker.is_open()
+        breaker.record_success()
+        breaker.record_failure()
+        breaker.record_failure()
+        assert not breaker.is_open()
+        breaker.record_failure()
+        assert breaker.is_open()
+        assert 59 < breaker.get_wait() <= 60
+
+    def test_half_open(self) -> None:
+        breaker = CircuitBreaker(threshold=3, cooldown=0.05)
+        for _ in range(3):
+            breaker.record_failure()
+        time.sleep(0.1)
+        assert not breaker.is_open()
+        # a single failure opens it again until a request succeeds
+        breaker.record_failure()
+        assert breaker.is_open()
+
+
+class TestRetryPolicy:
+    def _policy(self, attempts: int = 3, threshold: int = 100) -> RetryPolicy:
+        return RetryPolicy(attempts, 0.01, 0.05, CircuitBreaker(threshold, 60))
+
+    def test_delay(self) -> None:
+        policy = RetryPolicy(10, 1, 8, CircuitBreaker(10, 60))
+        for attempt in range(1, 10):
+            delay = policy.get_delay(attempt, TRANSIENT, ValueError())
+            backoff = min(8, 2 ** (attempt - 1))
+            assert backoff / 2 <= delay <= backoff
+        assert policy.get_delay(1, AUTH, ValueError()) == 0
+        ex = _http_error(429, {"retry-after": "3"})
+        assert 3 <= policy.get_delay(1, THROTTLE, ex) <= 4
+        ex = _http_error(429, {"retry-after": "600"})
+        assert policy.get_delay(1, THROTTLE, ex) <= 9
+
+    def test_retry_transient(self) -> None:
+        policy = self._policy()
+        func, calls = _failing([requests.ConnectionError()])
+        assert _run(policy.call(func)) == "ok"
+        assert len(calls) == 2
+
+    def test_attempts(self) -> None:
+        policy = self._policy(attempts=3)
+        func, calls = _failing([requests.ConnectionError()] * 5)
+        with pytest.raises(requests.ConnectionError):
+            _run(policy.call(func))
+        assert len(calls) == 3
+
+    def test_fatal(self) -> None:
+        policy = self._policy()
+        func, calls = _failing([ValueError("bug")])
+        with pytest.raises(ValueError):
+            _run(policy.call(func))
+        assert len(calls) == 1
+        assert not policy.breaker._failures
+
+    def test_auth(self) -> None:
+        retried = []
+        policy = self._policy()
+        func, calls = _failing([_http_error(401)])
+        with pytest.raises(requests.HTTPError):
+            _run(policy.call(func))
+        func, calls = _failing([_http_error(401)])
+
+        def on_retry(ex, kind, wait):
+            retried.append(kind)
+
+        assert _run(policy.call(func, retry_auth=True, on_retry=on_retry)) == "ok"
+        assert retried == [AUTH]
+
+    def test_corrupt_not_counted(self) -> None:
+        policy = self._policy(attempts=5, threshold=2)
+        func, calls = _failing([CorruptUpload()] * 3)
+        assert _run(policy.call(func)) == "ok"
+        assert len(calls) == 4
+        assert not policy.breaker.is_open()
+
+    def test_breaker_opens(self) -> None:
+        policy = self._policy(attempts=2, threshold=2)
+        func, calls = _failing([requests.ConnectionError()] * 2)
+        with pytest.raises(requests.ConnectionError):
+            _run(policy.call(func))
+        assert policy.breaker.is_open()
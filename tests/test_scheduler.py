@@ -0,0 +1,136 @@
+import time
+from threading import Event
+
+from simplebot_todus.scheduler import Scheduler
+
+
+def _blocked(scheduler: Scheduler) -> Event:
+    """Occupy the only worker until the returned event is set."""
+    started, release = Event(), Event()
+
+    def block():
+        started.set()
+        release.wait(5)
+
+    scheduler.submit(0, block, weight=0)
+    assert started.wait(5)
+    return release
+
+
+def _wait_done(scheduler: Scheduler) -> None:
+    deadline = time.monotonic() + 5
+    while scheduler.get_load() != (0, 0) and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+class TestScheduler:
+    def test_lightest_first(self) -> None:
+        scheduler = Scheduler(1, 10, {}, default_weight=50)
+        release = _blocked(scheduler)
+        order = []
+        scheduler.submit(1, order.append, 1, weight=300)
+        scheduler.submit(2, order.append, 2)
+        scheduler.submit(3, order.append, 3, weight=10)
+        assert scheduler.get_position(3) == (0, None)
+        assert scheduler.get_position(1)[0] == 2
+        scheduler.set_weight(1, 0)
+        assert scheduler.get_position(1)[0] == 0
+        release.set()
+        _wait_done(scheduler)
+        assert order == [1, 3, 2]
+
+    def test_aging(self) -> None:
+        scheduler = Scheduler(1, 10, {}, default_weight=50, aging=1000)
+        release = _blocked(scheduler)
+        order = []
+        scheduler.submit(1, order.append, 1, weight=500)
+        # the big job waited long enough to go before a fresh small one
+        scheduler._queue[0].queued -= 1
+        scheduler.submit(2, order.append, 2, weight=100)
+        release.set()
+        _wait_done(scheduler)
+        assert order == [1, 2]
+
+    def test_queue_full(self) -> None:
+        scheduler = Scheduler(1, 2, {}, default_weight=50)
+        release = _blocked(scheduler)
+        assert scheduler.submit(1, print)
+        assert not scheduler.is_full()
+        assert scheduler.submit(2, print)
+        assert scheduler.is_full()
+        assert not scheduler.submit(3, print)
+        assert scheduler.submit(3, print, force=True)
+        assert scheduler.get_load() == (3, 1)
+        assert scheduler.remove(3)
+        assert not scheduler.remove(3)
+        assert scheduler.get_position(3) is None
+        release.set()
+        _wait_done(scheduler)
+
+    def test_estimated_wait(self) -> None:
+        scheduler = Scheduler(1, 10, {}, default_weight=50, remaining=lambda key: 10.0)
+        scheduler.submit(1, time.sleep, 0)
+        _wait_done(scheduler)
+        release = _blocked(scheduler)
+        scheduler.submit(2, print, weight=1)
+        scheduler.submit(3, print, weight=2)
+        avg = scheduler._avg_duration
+        assert scheduler.get_position(3) == (1, 10.0 + avg)
+        release.set()
+        _wait_done(scheduler)
+
+    def test_admission(self) -> None:
+        allowed = {1: False, 2: True}
+        scheduler = Scheduler(
+            1,
+            10,
+            {},
+            default_weight=50,
+            admit=lambda key: allowed.get(key, True),
+            admit_interval=0.05,
+        )
+        release = _blocked(scheduler)
+        order = []
+        scheduler.submit(1, order.append, 1, weight=1)
+        scheduler.submit(2, order.append, 2, weight=2)
+        release.set()
+        # the held job doesn't block the ones behind it
+        deadline = time.monotonic() + 5
+        while order != [2] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert order == [2]
+        assert scheduler.get_load() == (1, 0)
+        allowed[1] = True
+        _wait_done(scheduler)
+        assert order == [2, 1]
+
+    def test_admission_error(self) -> None:
+        def admit(key):
+            raise ValueError()
+
+        scheduler = Scheduler(1, 10, {}, default_weight=50, admit=admit)
+        done = Event()
+        scheduler.submit(1, done.set)
+        assert done.wait(5)
+
+    def test_stage(self) -> None:
+        scheduler = Scheduler(0, 10, {"upload": 1}, default_weight=50)
+        with scheduler.stage("upload") as slot:
+            assert not slot.acquire(blocking=False)
+        assert slot.acquire(blocking=False)
+        slot.release()
+
+    def test_admit_without_lock(self) -> None:
+        loads = []
+
+        def admit(key):
+            # would deadlock if admit() was called holding the scheduler lock
+            loads.append(scheduler.get_load())
+            return True
+
+        scheduler = Scheduler(1, 10, {}, default_weight=50, admit=admit)
+        done = Event()
+        scheduler.submit(1, done.set)
+        assert done.wait(5)
+        # the job is out of the queue while it is checked
+        assert loads == [(0, 0)]
@@ -0,0 +1,116 @@
+import os
+import shutil
+from collections import namedtuple
+
+import pytest
+
+from simplebot_todus.spool import Spool, _get_size
+
+DiskUsage = namedtuple("DiskUsage", "total used free")
+
+
+@pytest.fixture
+def disk(monkeypatch):
+    """Fake the free disk space, tests set ``disk.free``."""
+
+    class Disk:
+        free = 1000
+
+    monkeypatch.setattr(
+        shutil, "disk_usage", lambda path: DiskUsage(10**6, 0, Disk.free)
+    )
+    return Disk
+
+
+def write(spool: Spool, job_id: int, size: int, name: str = "file") -> None:
+    path = spool.get_path(job_id)
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, name), "wb") as file:
+        file.write(b"x" * size)
+
+
+class TestReserve:
+    def test_reserve_release(self, tmp_path, disk) -> None:
+        disk.free = 110
+        spool = Spool(str(tmp_path), min_free=10)
+        assert spool.reserve(1, 60)
+        assert not spool.reserve(2, 50)
+        assert spool.reserve(2, 40)
+        # a new reservation replaces the old one of the same job
+        assert spool.reserve(2, 40)
+        assert spool.get_usage() == (0, 100, 110)
+        spool.release(1)
+        spool.release(1)
+        assert spool.reserve(3, 60)
+
+    def test_alone(self, tmp_path, disk) -> None:
+        """A job is always admitted when nothing else is reserved."""
+        disk.free = 10
+        spool = Spool(str(tmp_path), min_free=100, max_size=10)
+        assert spool.reserve(1, 1000)
+        assert not spool.reserve(2, 1)
+        assert spool.reserve(1, 2000)
+
+    def test_force(self, tmp_path, disk) -> None:
+        disk.free = 100
+        spool = Spool(str(tmp_path), min_free=0, max_size=100)
+        assert spool.reserve(1, 100)
+        assert not spool.reserve(2, 100)
+        assert spool.reserve(2, 100, force=True)
+        assert spool.get_usage()[1] == 200
+
+    def test_pending_writes(self, tmp_path, disk) -> None:
+        """Only the bytes the other jobs still have to write are taken."""
+        disk.free = 100
+        spool = Spool(str(tmp_path), min_free=10)
+        assert spool.reserve(1, 50)
+        write(spool, 1, 30)
+        # 100 free - 20 still to be written by job 1 - 10 min_free
+        assert not spool.reserve(2, 71)
+        assert spool.reserve(2, 70)
+        # what job 2 already wrote doesn't need space anymore
+        write(spool, 2, 30)
+        assert spool.reserve(2, 100)
+        assert not spool.reserve(2, 101)
+
+    def test_max_size(self, tmp_path, disk) -> None:
+        disk.free = 10**6
+        spool = Spool(str(tmp_path), min_free=0, max_size=100)
+        assert spool.reserve(1, 60)
+        assert not spool.reserve(2, 41)
+        assert spool.reserve(2, 40)
+        # jobs that wrote more than they reserved count what they use
+        write(spool, 1, 70)
+        assert not spool.reserve(3, 1)
+        assert not spool.reserve(2, 31)
+        assert spool.reserve(2, 30)
+
+
+class TestCleanup:
+    def test_cleanup(self, tmp_path) -> None:
+        spool = Spool(str(tmp_path / "spool"), min_free=0)
+        os.makedirs(spool.path)
+        write(spool, 1, 10)
+        write(spool, 2, 20)
+        write(spool, 3, 30)
+        with open(os.path.join(spool.path, "stray"), "wb") as file:
+            file.write(b"x" * 5)
+        outside = tmp_path / "outside"
+        outside.mkdir()
+        (outside / "file").write_bytes(b"keep")
+        os.symlink(str(outside), os.path.join(spool.path, "link"))
+        assert spool.cleanup([2, 4]) == (4, 45 + len(str(outside)))
+        assert sorted(os.listdir(spool.path)) == ["2"]
+        assert os.listdir(spool.get_path(2)) == ["file"]
+        assert (outside / "file").read_bytes() == b"keep"
+
+
+class TestSize:
+    def test_hard_links(self, tmp_path) -> None:
+        (tmp_path / "a").write_bytes(b"x" * 100)
+        (tmp_path / "sub").mkdir()
+        os.link(str(tmp_path / "a"), str(tmp_path / "sub" / "b"))
+        (tmp_path / "c").write_bytes(b"x" * 10)
+        assert _get_size(str(tmp_path)) == 110
+        assert _get_size(str(tmp_path / "a")) == 100
+        assert _get_size(str(tmp_path / "missing")) == 0
@@ -0,0 +1,91 @@
+import time
+from threading import Event, Thread
+
+import pytest
+
+from simplebot_todus.tokens import TokenCache
+
+
+class FakeClient:
+    def __init__(self) -> None:
+        self.aborted = False
+
+
+def _cache(login, **kwargs) -> TokenCache:
+    return TokenCache(
+        60, refresh_margin=10, login=login, new_client=FakeClient, **kwargs
+    )
+
+
+class TestTokenCache:
+    def test_cached(self) -> None:
+        logins = []
+        cache = _cache(lambda client, phone, password: logins.append(phone) or "t1")
+        assert cache.get("5355", "pass") == "t1"
+        assert cache.get("5355", "pass") == "t1"
+        assert logins == ["5355"]
+        cache.invalidate("5355", "other")
+        assert cache.get("5355", "pass") == "t1"
+        cache.invalidate("5355", "t1")
+        assert cache.get("5355", "pass") == "t1"
+        assert logins == ["5355", "5355"]
+
+    def test_password_changed(self) -> None:
+        cache = _cache(lambda client, phone, password: password)
+        assert cache.get("5355", "a") == "a"
+        assert cache.get("5355", "b") == "b"
+
+    def test_single_flight(self) -> None:
+        started, release = Event(), Event()
+        clients = []
+
+        def login(client, phone, password):
+            clients.append(client)
+            started.set()
+            release.wait(5)
+            if not client.aborted:
+                return "token"
+            raise ValueError("aborted")
+
+        cache = _cache(login)
+        results = []
+        threads = [
+            Thread(target=lambda: results.append(cache.get("5355", "p")))
+            for _ in range(3)
+        ]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        # one login, with a client that no petition can abort
+        assert len(clients) == 1
+        assert results == ["token"] * 3
+
+    def test_error_is_shared(self) -> None:
+        def login(client, phone, password):
+            raise ValueError("wrong password")
+
+        cache = _cache(login)
+        with pytest.raises(ValueError):
+            cache.get("5355", "p")
+
+    def test_refresh_submitted(self) -> None:
+        submitted = []
+        tokens = iter(["t1", "t2"])
+        cache = _cache(
+            lambda client, phone, password: next(tokens),
+            submit=lambda func, *args: submitted.append((func, args)),
+        )
+        cache.refresh_margin = 60
+        assert cache.get("5355", "p") == "t1"
+        # the old token is served while it is refreshed
+        assert cache.get("5355", "p") == "t1"
+        assert cache.get("5355", "p") == "t1"
+        assert len(submitted) == 1
+        func, args = submitted[0]
+        func(*args)
+        assert cache.get("5355", "p") == "t2"
@@ -0,0 +1,65 @@
+import hashlib
+
+import pytest
+import requests
+from fakes import FakeToDusClient, S3Server, file_content
+
+from simplebot_todus.verify import verify_part
+
+
+@pytest.fixture
+def s3():
+    server = S3Server()
+    FakeToDusClient.s3 = server
+    yield server
+    server.close()
+
+
+def _upload(data: bytes) -> str:
+    return FakeToDusClient().upload_file("token", data, len(data))
+
+
+def _verify(url: str, tmp_path, data: bytes, md5: str):
+    client = FakeToDusClient()
+    return verify_part(
+        lambda path: client.download_file("token", url, path),
+        str(tmp_path / "part.check"),
+        len(data),
+        md5,
+    )
+
+
+class TestVerify:
+    data = file_content(1, 0, 200 * 1024)
+    md5 = hashlib.md5(data).hexdigest()
+
+    def test_intact(self, s3, tmp_path) -> None:
+        url = _upload(self.data)
+        assert _verify(url, tmp_path, self.data, self.md5) is True
+        assert not list(tmp_path.iterdir())
+
+    def test_missing(self, s3, tmp_path) -> None:
+        url = f"{s3.url}/missing"
+        assert _verify(url, tmp_path, self.data, self.md5) is False
+
+    def test_truncated(self, s3, tmp_path) -> None:
+        url = _upload(self.data)
+        s3.corrupt(url, size=1000)
+        assert _verify(url, tmp_path, self.data, self.md5) is False
+
+    def test_corrupted(self, s3, tmp_path) -> None:
+        for _ in range(5):
+            url = _upload(self.data)
+            s3.corrupt(url)
+            assert _verify(url, tmp_path, self.data, self.md5) is False
+
+    def test_unsigned(self, s3, tmp_path) -> None:
+        url = _upload(self.data)
+        assert requests.head(url).status_code == 403
+
+        def download(path):
+            with requests.get(url) as r:
+                r.raise_for_status()
+
+        # the part can't be checked, but it isn't known to be broken
+        assert verify_part(download, str(tmp_path / "check"), 1, self.md5) is None
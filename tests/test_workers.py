@@ -0,0 +1,49 @@
+import os
+import time
+from threading import Timer
+
+import pytest
+
+from simplebot_todus.errors import TaskAborted
+from simplebot_todus.workers import Task, WorkerPool
+
+
+@pytest.fixture
+def pool():
+    return WorkerPool(size=1, max_jobs=2)
+
+
+class TestWorkerPool:
+    def test_run(self, pool) -> None:
+        assert pool.run(pow, (2, 10), timeout=30) == 1024
+        assert pool.get_busy() == 0
+
+    def test_error(self, pool) -> None:
+        with pytest.raises(ZeroDivisionError):
+            pool.run(divmod, (1, 0), timeout=30)
+        assert pool.run(pow, (2, 3), timeout=30) == 8
+
+    def test_recycled(self, pool) -> None:
+        pids = [pool.run(os.getpid, (), timeout=30) for _ in range(3)]
+        assert pids[0] == pids[1] != pids[2]
+        assert os.getpid() not in pids
+
+    def test_timeout(self, pool) -> None:
+        with pytest.raises(TimeoutError):
+            pool.run(time.sleep, (30,), timeout=1)
+        assert pool.run(pow, (2, 3), timeout=30) == 8
+
+    def test_killed(self, pool) -> None:
+        task = Task()
+        task.kill()
+        with pytest.raises(TaskAborted):
+            pool.run(time.sleep, (30,), timeout=30, task=task)
+
+    def test_kill_running(self, pool) -> None:
+        task = Task()
+        Timer(0.5, task.kill).start()
+        start = time.monotonic()
+        with pytest.raises(TaskAborted):
+            pool.run(time.sleep, (30,), timeout=30, task=task)
+        assert time.monotonic() - start < 10
+        assert pool.run(pow, (2, 3), timeout=30) == 8
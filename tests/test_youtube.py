@@ -0,0 +1,44 @@
+import pytest
+
+from simplebot_todus import util
+from simplebot_todus.errors import FileTooBig
+
+URL = "https://www.youtube.com/watch?v=abc"
+INFO = {
+    "duration": 100,
+    "formats": [
+        {"format_id": "audio", "vcodec": "none", "acodec": "opus", "filesize": 10},
+        {"format_id": "small", "vcodec": "avc1", "acodec": "mp4a", "filesize": 1000},
+        {"format_id": "medium", "vcodec": "avc1", "acodec": "mp4a", "tbr": 800},
+        {"format_id": "video", "vcodec": "avc1", "acodec": "none", "filesize": 50},
+    ],
+}
+
+
+class TestYouTube:
+    def test_select_format(self) -> None:
+        assert util.select_ytformat(INFO, None) == (INFO["formats"][2], 10000000)
+        assert util.select_ytformat(INFO, 10000000)[0]["format_id"] == "medium"
+        assert util.select_ytformat(INFO, 9999999) == (INFO["formats"][1], 1000)
+        with pytest.raises(FileTooBig):
+            util.select_ytformat(INFO, 999)
+
+    def test_probe(self, monkeypatch) -> None:
+        monkeypatch.setattr(util, "get_ytinfo", lambda url: INFO)
+        assert util.probe_ytvideo(URL, 5000) == 1000
+        # too big petitions fail when they are queued
+        with pytest.raises(FileTooBig):
+            util.probe_ytvideo(URL, 999)
+
+    def test_probe_error(self, monkeypatch) -> None:
+        def get_ytinfo(url):
+            raise OSError("network error")
+
+        monkeypatch.setattr(util, "get_ytinfo", get_ytinfo)
+        assert util.probe_ytvideo(URL, 999) is None
+
+    def test_cache(self, monkeypatch) -> None:
+        assert util.get_cached_ytinfo(URL) is None
+        monkeypatch.setitem(util._ytinfo, "yt:abc", (float("inf"), INFO))
+        assert util.get_cached_ytinfo("https://youtu.be/abc") is INFO
+        assert util.get_ytinfo(URL) is INFO